@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : coco_index.py
+# @ Description: streaming parser of coco instance json and compact array-backed image to annotation index
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 PM 14:10
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import json
+import array
+from collections import OrderedDict
+import numpy as np
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.index.npz'
+
+_WHITESPACE = ' \t\n\r'
+
+
+class JsonStream(object):
+    """
+    incremental json reader, decode the items of a large top level array one by one without load the whole file
+    """
+    def __init__(self, fr, chunk_size=1 << 20):
+        self.fr = fr
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        read next chunk to buffer and drop the consumed part of buffer
+        :return: False if reach end of file
+        """
+        if self.eof:
+            return False
+        chunk = self.fr.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        skip whitespace and get the next char, '' if reach end of file
+        :return:
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError('expect "{0}" at {1}, get "{2}"'.format(char, self.pos, self.peek()))
+        self.pos += 1
+
+    def decode_value(self):
+        """
+        decode the next json value
+        :return:
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # a number at the end of buffer may be truncated
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+    def iter_array(self):
+        """
+        decode items of the next json array one by one
+        :return:
+        """
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.decode_value()
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect(']')
+                return
+
+    def iter_object(self):
+        """
+        iterate keys of the next json object, the caller must consume the value of every key by decode_value or
+        iter_array before next key
+        :return:
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.decode_value()
+            self.expect(':')
+            yield key
+            if self.peek() == ',':
+                self.pos += 1
+            else:
+                self.expect('}')
+                return
+
+
+def iter_coco_json(json_path, array_keys=('images', 'annotations'), chunk_size=1 << 20):
+    """
+    stream coco json, yield (key, item) for every item of the top level arrays in array_keys
+    and (key, value) for other top level keys
+    :param json_path:
+    :param array_keys:
+    :param chunk_size:
+    :return:
+    """
+    with open(json_path, 'r', encoding='utf-8') as fr:
+        stream = JsonStream(fr, chunk_size=chunk_size)
+        for key in stream.iter_object():
+            if key in array_keys and stream.peek() == '[':
+                for item in stream.iter_array():
+                    yield key, item
+            else:
+                yield key, stream.decode_value()
+
+
+class CocoIndex(object):
+    """
+    image to annotation index of coco, annotation boxes of image i are
+    boxes[ann_index[ann_offsets[i]:ann_offsets[i+1]]]
+    """
+    def __init__(self, image_ids, file_names, heights, widths, ann_ids, boxes, ann_index, ann_offsets,
+                 categories, info=None, licenses=None):
+        """
+        :param image_ids: int64 [num_images]
+        :param file_names: str [num_images]
+        :param heights: int32 [num_images]
+        :param widths: int32 [num_images]
+        :param ann_ids: int64 [num_annotations], in the order of json
+        :param boxes: int32 [num_annotations, 5], (x_min, y_min, x_max, y_max, category_id)
+        :param ann_index: int64 [num_annotations], annotation index sorted by image
+        :param ann_offsets: int64 [num_images+1]
+        :param categories: category list of json
+        :param info:
+        :param licenses:
+        """
+        self.image_ids = image_ids
+        self.file_names = file_names
+        self.heights = heights
+        self.widths = widths
+        self.ann_ids = ann_ids
+        self.boxes = boxes
+        self.ann_index = ann_index
+        self.ann_offsets = ann_offsets
+        self.categories = categories
+        self.info = info
+        self.licenses = licenses
+
+    @property
+    def num_images(self):
+        return len(self.image_ids)
+
+    @property
+    def num_annotations(self):
+        return len(self.ann_ids)
+
+    def get_num_objects(self, index):
+        return int(self.ann_offsets[index + 1] - self.ann_offsets[index])
+
+    def get_image_annotations(self, index):
+        """
+        get gtbox and label of image
+        :param index: image index, not image id
+        :return: int32 [num_objects, 5], (x_min, y_min, x_max, y_max, category_id)
+        """
+        return self.boxes[self.ann_index[self.ann_offsets[index]:self.ann_offsets[index + 1]]]
+
+    def get_category_images(self):
+        """
+        get image ids of every category in the order of annotations, same as cate_imgs of the old create_index
+        :return: OrderedDict {category_id: [image_id]}
+        """
+        ann_image_index = np.empty(self.num_annotations, dtype=np.int64)
+        ann_image_index[self.ann_index] = np.repeat(np.arange(self.num_images), np.diff(self.ann_offsets))
+        category_images = OrderedDict()
+        for category_id, image_id in zip(self.boxes[:, 4].tolist(), self.image_ids[ann_image_index].tolist()):
+            category_images.setdefault(category_id, []).append(image_id)
+        return category_images
+
+    def save(self, index_path, source_size=0, source_mtime=0):
+        """
+        save index as npz, the source size and mtime are used to check whether index is outdated
+        :param index_path:
+        :param source_size:
+        :param source_mtime:
+        :return:
+        """
+        tmp_path = index_path + '.tmp.npz'
+        np.savez(tmp_path, version=INDEX_VERSION, source_size=source_size, source_mtime=source_mtime,
+                 image_ids=self.image_ids, file_names=self.file_names, heights=self.heights, widths=self.widths,
+                 ann_ids=self.ann_ids, boxes=self.boxes, ann_index=self.ann_index, ann_offsets=self.ann_offsets,
+                 categories=json.dumps(self.categories), info=json.dumps(self.info),
+                 licenses=json.dumps(self.licenses))
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path):
+        """
+        load index from npz
+        :param index_path:
+        :return: (index, source size, source mtime), index is None if the index version changed
+        """
+        with np.load(index_path) as data:
+            if int(data['version']) != INDEX_VERSION:
+                return None, 0, 0
+            index = cls(image_ids=data['image_ids'], file_names=data['file_names'], heights=data['heights'],
+                        widths=data['widths'], ann_ids=data['ann_ids'], boxes=data['boxes'],
+                        ann_index=data['ann_index'], ann_offsets=data['ann_offsets'],
+                        categories=json.loads(str(data['categories'])), info=json.loads(str(data['info'])),
+                        licenses=json.loads(str(data['licenses'])))
+            return index, int(data['source_size']), int(data['source_mtime'])
+
+
+def build_coco_index(json_path, chunk_size=1 << 20):
+    """
+    build index by streaming the instance json, only the fields used by conversion are kept in typed arrays
+    :param json_path:
+    :param chunk_size:
+    :return: CocoIndex
+    """
+    print('creating index...')
+    image_ids, heights, widths = array.array('q'), array.array('i'), array.array('i')
+    file_names = []
+    ann_ids, ann_image_ids, ann_category_ids = array.array('q'), array.array('q'), array.array('i')
+    ann_bboxes = array.array('d')
+    categories, info, licenses = [], None, None
+    for key, item in iter_coco_json(json_path, chunk_size=chunk_size):
+        if key == 'images':
+            image_ids.append(item['id'])
+            file_names.append(item.get('file_name', ''))
+            heights.append(item.get('height', 0))
+            widths.append(item.get('width', 0))
+        elif key == 'annotations':
+            ann_ids.append(item.get('id', len(ann_ids)))
+            ann_image_ids.append(item['image_id'])
+            ann_category_ids.append(item['category_id'])
+            ann_bboxes.extend(item['bbox'][:4])
+        elif key == 'categories':
+            categories = item
+        elif key == 'info':
+            info = item
+        elif key == 'licenses':
+            licenses = item
+
+    image_ids = np.array(image_ids, dtype=np.int64)
+    ann_image_ids = np.array(ann_image_ids, dtype=np.int64)
+    # the format of coco bounding boxs is [xmin, ymin, width, height] -> (x_min, y_min, x_max, y_max)
+    bboxes = np.array(ann_bboxes, dtype=np.float64).reshape(-1, 4)
+    boxes = np.zeros((len(bboxes), 5), dtype=np.int32)
+    boxes[:, 0] = np.rint(bboxes[:, 0])
+    boxes[:, 1] = np.rint(bboxes[:, 1])
+    boxes[:, 2] = np.rint(bboxes[:, 0] + bboxes[:, 2])
+    boxes[:, 3] = np.rint(bboxes[:, 1] + bboxes[:, 3])
+    boxes[:, 4] = np.array(ann_category_ids, dtype=np.int32)
+
+    # map annotation to image index, annotations of unknown image are dropped
+    if len(image_ids) > 0:
+        image_order = np.argsort(image_ids, kind='stable')
+        sorted_image_ids = image_ids[image_order]
+        position = np.minimum(np.searchsorted(sorted_image_ids, ann_image_ids), len(image_ids) - 1)
+        valid = sorted_image_ids[position] == ann_image_ids
+        ann_image_index = np.where(valid, image_order[position], len(image_ids))
+    else:
+        valid = np.zeros(len(ann_image_ids), dtype=np.bool_)
+        ann_image_index = np.zeros(len(ann_image_ids), dtype=np.int64)
+    if not np.all(valid):
+        print('{0} annotations of unknown image are dropped'.format(int(np.sum(~valid))))
+    ann_ids = np.array(ann_ids, dtype=np.int64)[valid]
+    boxes = boxes[valid]
+    ann_image_index = ann_image_index[valid]
+    # stable sort keep the json order of annotations of every image
+    ann_index = np.argsort(ann_image_index, kind='stable')
+    ann_offsets = np.zeros(len(image_ids) + 1, dtype=np.int64)
+    ann_offsets[1:] = np.cumsum(np.bincount(ann_image_index, minlength=len(image_ids)))
+
+    print('index created!')
+    return CocoIndex(image_ids=image_ids, file_names=np.array(file_names, dtype=np.str_),
+                     heights=np.array(heights, dtype=np.int32), widths=np.array(widths, dtype=np.int32),
+                     ann_ids=ann_ids, boxes=boxes, ann_index=ann_index.astype(np.int64),
+                     ann_offsets=ann_offsets, categories=categories, info=info, licenses=licenses)
+
+
+def load_coco_index(json_path, index_path=None):
+    """
+    load the persisted index of json, rebuild and save it when the json changed
+    :param json_path: coco instance json
+    :param index_path: default is beside the json
+    :return: CocoIndex
+    """
+    if index_path is None:
+        index_path = os.path.splitext(json_path)[0] + INDEX_SUFFIX
+    stat = os.stat(json_path)
+    if os.path.isfile(index_path):
+        try:
+            index, source_size, source_mtime = CocoIndex.load(index_path)
+            if index is not None and source_size == stat.st_size and source_mtime == stat.st_mtime_ns:
+                return index
+        except (OSError, ValueError, KeyError) as e:
+            print('failed to load index {0}: {1}'.format(index_path, e))
+    index = build_coco_index(json_path)
+    try:
+        index.save(index_path, source_size=stat.st_size, source_mtime=stat.st_mtime_ns)
+    except OSError as e:
+        print('failed to save index {0}: {1}'.format(index_path, e))
+    return index
@@ -14,11 +14,14 @@ import os
 import glob
 import cv2 as cv
 import numpy as np
-import json
-from collections import defaultdict
+import functools
 import tensorflow  as tf
 
 from utils.tools import view_bar, makedir
+from libs.configs import cfgs
+from data.tfrecord_utils import write_shards, load_record_image, RECORD_FORMATS
+from data.coco.coco_index import load_coco_index
+from data.split_utils import load_split_manifest
 
 coco_dataset_dir = '/media/alex/AC6A2BDB6A2BA0D6/alex_dataset/sub_coco'
 coco_tfrecord_dir = '/media/alex/AC6A2BDB6A2BA0D6/alex_dataset/coco_tfrecord'
@@ -29,155 +32,140 @@ tf.app.flags.DEFINE_string('image_dir', 'Images', 'image dir')
 tf.app.flags.DEFINE_string('save_dir', coco_tfrecord_dir, 'save directory')
 tf.app.flags.DEFINE_string('save_name', 'train', 'save name')
 tf.app.flags.DEFINE_string('img_format', '.jpg', 'format of image')
+tf.app.flags.DEFINE_integer('num_workers', 1, 'number of conversion process')
+tf.app.flags.DEFINE_string('record_format', 'raw', 'raw: decoded pixels | encoded: original jpeg/png bytes')
+tf.app.flags.DEFINE_integer('shortside_len', 0, 'resize image to the short side length when conversion, 0 keep size')
+tf.app.flags.DEFINE_integer('length_limitation', cfgs.IMG_MAX_LENGTH, 'max length of resized image')
+tf.app.flags.DEFINE_string('compression', '', 'compression type of shards: "" | GZIP | ZLIB')
+tf.app.flags.DEFINE_boolean('incremental', False, 'only convert new or changed samples of last conversion')
+tf.app.flags.DEFINE_string('split_file', '', 'split manifest written by split_coco, convert it instead of dataset')
+tf.app.flags.DEFINE_integer('shard_mb', 0, 'target size(MB) of shard, 0 split shards by record capacity')
 
 FLAGS = tf.app.flags.FLAGS
 
 
-def convert_coco_to_tfrecord(src_path, save_path, record_capacity=2000, raw_coco=True):
+def convert_coco_to_tfrecord(src_path, save_path, record_capacity=2000, raw_coco=True, num_workers=1,
+                             record_format='raw', shortside_len=0, length_limitation=cfgs.IMG_MAX_LENGTH,
+                             compression='', incremental=False, shard_bytes=0,
+                             split_file=''):
    """
 
    :param src_path:
    :param save_path:
    :param record_capacity:
    :param raw_coco:
+   :param num_workers: number of conversion process, every worker writes its own shards
+   :param record_format: 'raw' store decoded pixels, 'encoded' store the original compressed image bytes
+   :param shortside_len: if not 0, images are resized to the short side length(IMG_SHORT_SIDE_LEN of training)
+                         when conversion, and the input pipeline skip resize
+   :param length_limitation: max length of resized image(IMG_MAX_LENGTH of training)
+   :param compression: compression type of shards, '', 'GZIP' or 'ZLIB'
+   :param incremental: if True, only encode new or changed samples and rewrite the affected shards
+   :param shard_bytes: if not 0, balance samples to shards of about shard_bytes by estimated size
+   :param split_file: if not '', convert the samples of split manifest written by split_coco instead of src_path
    :return:
    """
+   assert record_format in RECORD_FORMATS, 'record format must in {0}'.format(RECORD_FORMATS)
 
    imgs_path = os.path.join(src_path, FLAGS.image_dir)
    anns_path = os.path.join(src_path, FLAGS.anns_dir)
 
    # img_name_list = glob.glob(os.path.join(img_path,'*'+FLAGS.img_format))
-   annotation_list = glob.glob(os.path.join(anns_path, '*.json'))
-   anns, cats, imgs, img_anns, cate_imgs = create_index(annotation_list[0])
-   image_id_list = [img_id for img_id in img_anns.keys()]
-
-   remainder_num = len(image_id_list) % record_capacity
-   if remainder_num == 0:
-      num_record = int(len(image_id_list) / record_capacity)
+   split_images = None
+   if split_file:
+      # split manifest refer to the original images
+      split_manifest = load_split_manifest(split_file, dataset='coco')
+      coco_index = load_coco_index(split_manifest['annotation_file'])
+      split_images = dict([(sample['image_id'], sample['image']) for sample in split_manifest['samples']])
    else:
-      num_record = int(len(image_id_list) / record_capacity) + 1
-   for index in range(num_record):
-      makedir(save_path)
-      record_filename = os.path.join(save_path, f'{index}.record')
-      write = tf.io.TFRecordWriter(record_filename)
-      if index < num_record - 1:
-         sub_img_id_list = image_id_list[index * record_capacity: (index + 1) * record_capacity]
-      else:
-         sub_img_id_list = image_id_list[(index * record_capacity): (index * record_capacity + remainder_num)]
-
-      num_samples = 0
-      for index, img_id in enumerate(sub_img_id_list):
-         try:
-            # get gtbox_label
-            gtbox_label = read_json_gtbox_label(img_anns[img_id])
-            # get image name
-            if raw_coco:
-               img_name = '0' * (12 - len(str(img_id))) + f'{img_id}.{FLAGS.img_format}'
-            else:
-               img_name = '{0}.jpg'.format(img_id)
-
-            img_path = os.path.join(imgs_path, img_name)
-
-            # load image
-            bgr_image = cv.imread(img_path)
-            # BGR TO RGB
-            rgb_image = cv.cvtColor(bgr_image, cv.COLOR_BGR2RGB)
-            img_height = rgb_image.shape[0]
-            img_width = rgb_image.shape[1]
-
-            image_record = serialize_example(image=rgb_image, img_height=img_height, img_width=img_width,
-                                             img_depth=3, filename=img_name, gtbox_label=gtbox_label)
-            write.write(record=image_record)
-
-            num_samples += 1
-            view_bar(message='\nConversion progress', num=num_samples, total=len(img_anns))
-
-         except Exception as e:
-            print(e)
+      annotation_list = glob.glob(os.path.join(anns_path, '*.json'))
+      coco_index = load_coco_index(annotation_list[0])
+
+   samples = []
+   for index in range(coco_index.num_images):
+      # skip image without annotation
+      if coco_index.get_num_objects(index) == 0:
+         continue
+      img_id = int(coco_index.image_ids[index])
+      # get image name
+      if split_images is not None:
+         if img_id not in split_images:
             continue
-      write.close()
-      print('There are {0} samples convert to {1}'.format(num_samples, save_path))
-
-
-def create_index(json_path):
-   """
-   create index
-   :param dataset:
-   :return:
-   """
-   dataset = json.load(open(json_path, 'r'))
-   print('creating index...')
-   anns, cats, imgs = {}, {}, {}
-   img_anns, cate_imgs = defaultdict(list), defaultdict(list)
-   if 'annotations' in dataset:
-      for ann in dataset['annotations']:
-         img_anns[ann['image_id']].append(ann)
-         anns[ann['id']] = ann
-
-   if 'images' in dataset:
-      for img in dataset['images']:
-         imgs[img['id']] = img
-
-   if 'categories' in dataset:
-      for cat in dataset['categories']:
-         cats[cat['id']] = cat
-
-   if 'annotations' in dataset and 'categories' in dataset:
-      for ann in dataset['annotations']:
-         cate_imgs[ann['category_id']].append(ann['image_id'])
-   print('index created!')
-
-   return anns, cats, imgs, img_anns, cate_imgs
-
-
-def read_json_gtbox_label(img_anns):
+         img_file = split_images[img_id]
+         img_name = os.path.basename(img_file)
+      else:
+         if raw_coco:
+            img_name = '0' * (12 - len(str(img_id))) + f'{img_id}.{FLAGS.img_format}'
+         else:
+            img_name = '{0}.jpg'.format(img_id)
+         img_file = os.path.join(imgs_path, img_name)
+      samples.append({'image': img_file,
+                      'filename': img_name,
+                      'height': int(coco_index.heights[index]),
+                      'width': int(coco_index.widths[index]),
+                      'annotations': coco_index.get_image_annotations(index)})
+
+   if not shortside_len:
+      length_limitation = 0
+   serialize_fn = functools.partial(serialize_sample, record_format=record_format, shortside_len=shortside_len,
+                                    length_limitation=length_limitation)
+   return write_shards(samples, serialize_fn=serialize_fn, save_path=save_path, record_capacity=record_capacity,
+                       num_workers=num_workers, compression=compression, incremental=incremental, shard_bytes=shard_bytes,
+                       manifest_info={'record_format': record_format,
+                                      'resized_shortside': shortside_len,
+                                      'resized_max_length': length_limitation})
+
+
+def serialize_sample(sample, record_format='raw', shortside_len=0, length_limitation=0):
    """
-
-   :param dataset_dict:
-   :param img_id:
+   load image and annotation of a sample and serialize them
+   :param sample: {'image': image path, 'filename': image name, 'height': , 'width': ,
+                   'annotations': int32 [num_objects, 5] gtbox and label of image}
+   :param record_format: 'raw' or 'encoded'
+   :param shortside_len: if not 0, store image resized to the short side length
+   :param length_limitation: max length of resized image
    :return:
    """
-   # gtbox_label = np.zeros((0, 5), dtype=tf.float32)
-   gtbox_label = []
-   for annotation in img_anns:
-      bbox = annotation['bbox']
-
-      ## the format of coco bounding boxs is [xmin, ymin, width, height]
-      x, y, w, h = float(bbox[0]), float(bbox[1]), float(bbox[2]), float(bbox[3])
-      # (x,y, w, h) -> (x_min, y_min, x_max, y_max)
-      x_min, y_min, x_max, y_max = int(np.rint(x)), int(np.rint(y)), int(np.rint(x + w)), int(np.rint(y + h))
-      label = annotation['category_id']
-      gt_bbox = [x_min, y_min, x_max, y_max]
-      gt_bbox.append(label)
-      gtbox_label.append(gt_bbox)
-
-   gtbox_label = np.array(gtbox_label, dtype=np.int32)  # [x1, y1. x2, y2, label]
-
-   # xmin, ymin, xmax, ymax, label = gtbox_label[:, 0], gtbox_label[:, 1], gtbox_label[:, 2], gtbox_label[:, 3], \
-   #                                 gtbox_label[:, 4]
-   # gtbox_label = np.transpose(np.stack([ymin, xmin, ymax, xmax, label], axis=0))
-
-   return gtbox_label
-
-
-def serialize_example(image, img_height, img_width, img_depth, filename, gtbox_label):
+   # get gtbox_label
+   gtbox_label = np.array(sample['annotations'], dtype=np.int32).reshape(-1, 5)
+   image, image_format, img_height, img_width, gtbox_label = load_record_image(sample['image'], gtbox_label,
+                                                                               record_format=record_format,
+                                                                               shortside_len=shortside_len,
+                                                                               length_limitation=length_limitation,
+                                                                               img_height=sample['height'],
+                                                                               img_width=sample['width'])
+
+   return serialize_example(image=image, img_height=img_height, img_width=img_width,
+                            img_depth=3, filename=sample['filename'], gtbox_label=gtbox_label,
+                            image_format=image_format, shortside_len=shortside_len,
+                            length_limitation=length_limitation)
+
+
+def serialize_example(image, img_height, img_width, img_depth, filename, gtbox_label, image_format='raw',
+                      shortside_len=0, length_limitation=0):
    """
    create a tf.Example message to be written to a file
    :param label: label info
-   :param image: image content
+   :param image: image content, RGB array when image_format is 'raw' else encoded bytes
    :param filename: image name
+   :param image_format: 'raw', 'jpeg' or 'png'
+   :param shortside_len: short side length the image already resized to, 0 means original size
+   :param length_limitation: max length the image already resized to
    :return:
    """
    # create a dict mapping the feature name to the tf.Example compatible
    # image_shape = tf.image.decode_jpeg(image_string).eval().shape
    feature = {
-      'image': _bytes_feature(image.tobytes()),
+      'image': _bytes_feature(image.tobytes() if image_format == 'raw' else image),
       'height': _int64_feature(img_height),
       'width': _int64_feature(img_width),
       'depth': _int64_feature(img_depth),
       'filename': _bytes_feature(filename.encode()),
       'gtboxes_and_label': _bytes_feature(gtbox_label.tobytes()),
-      'num_objects': _int64_feature(gtbox_label.shape[0])
+      'num_objects': _int64_feature(gtbox_label.shape[0]),
+      'format': _bytes_feature(image_format.encode()),
+      'resized_shortside': _int64_feature(shortside_len),
+      'resized_max_length': _int64_feature(length_limitation)
    }
    # create a feature message using tf.train.Example
    example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
@@ -194,6 +182,10 @@ def _bytes_feature(value):
 
 if __name__ == "__main__":
    # test json
-   convert_coco_to_tfrecord(src_path=coco_dataset_dir, save_path=coco_tfrecord_dir, raw_coco=False)
+   convert_coco_to_tfrecord(src_path=coco_dataset_dir, save_path=coco_tfrecord_dir, raw_coco=False,
+                            num_workers=FLAGS.num_workers, record_format=FLAGS.record_format,
+                            shortside_len=FLAGS.shortside_len, length_limitation=FLAGS.length_limitation,
+                            compression=FLAGS.compression, incremental=FLAGS.incremental,
+                            shard_bytes=FLAGS.shard_mb * 2 ** 20, split_file=FLAGS.split_file)
 
 
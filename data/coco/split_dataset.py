@@ -11,11 +11,12 @@
 #-------------------------------------------------------
 import os
 import json
-import shutil
 import numpy as np
 from collections import defaultdict
 
 from utils.tools import makedir, view_bar
+from data.coco.coco_index import load_coco_index, iter_coco_json
+from data.split_utils import SPLIT_MODES, materialize_file, save_split_manifest, get_split_manifest_path
 
 # original_dataset_dir = '/home/alex/Documents/datasets/Pascal_VOC_2012/VOCtrainval/VOCdevkit'
 
@@ -30,36 +31,38 @@ sub_annotations = os.path.join(sub_coco, 'Annotations')
 sub_images = os.path.join(sub_coco, 'Images')
 
 
-def split_coco(imgs_path, annotaions_path, dst_dir, num_catetory=20, num_per_category=18):
+def split_coco(imgs_path, annotaions_path, dst_dir, num_catetory=20, num_per_category=18, mode='copy'):
     """
 
     :param origin_path:
     :param split_ratio:
+    :param mode: 'copy', 'hardlink' or 'symlink' the images to split dir,
+                 'manifest' only write <dst_dir>/<basename of dst_dir>.split.json refer to the original images
     :return:
     """
+    assert mode in SPLIT_MODES, 'split mode must in {0}'.format(SPLIT_MODES)
 
-    dataset = json.load(open(annotaions_path, 'r'))
+    coco_index = load_coco_index(annotaions_path)
 
     sub_annotations_path = os.path.join(dst_dir, 'Annotations')
     sub_img_path = os.path.join(dst_dir, 'Images')
 
-
-    anns, cats, imgs, img_anns, cate_imgs = create_index(dataset)
-
-    img_id_list, category_id_list = get_img_per_categorise(cate_imgs, num_catetory, num_per_category)
+    img_id_list, category_id_list = get_img_per_categorise(coco_index.get_category_images(), num_catetory,
+                                                           num_per_category)
 
     img_name_dict = {}
     for i, img_id in enumerate(img_id_list):
         img_name_dict[img_id] = '0' * (12 - len(str(img_id))) + '{0}.jpg'.format(img_id)
 
     #----------------------------write annotaion info-----------------------------------
+    imgs, img_anns = load_images_annotations(annotaions_path, img_id_list)
     images_list, annotations_list = get_images_annotaion_info(img_id_list, imgs, img_anns, category_id_list)
     new_dataset = defaultdict(list)
-    new_dataset['info'] = dataset['info']
-    new_dataset['licenses'] = dataset['licenses']
+    new_dataset['info'] = coco_index.info
+    new_dataset['licenses'] = coco_index.licenses
     new_dataset['images'] = images_list
     new_dataset['annotations'] = annotations_list
-    new_dataset['categories'] = dataset['categories']
+    new_dataset['categories'] = coco_index.categories
 
     makedir(sub_annotations_path)
     json_path = os.path.join(sub_annotations_path, 'instances.json')
@@ -69,45 +72,43 @@ def split_coco(imgs_path, annotaions_path, dst_dir, num_catetory=20, num_per_cat
           format(len(new_dataset['annotations']), len(new_dataset['images']), json_path))
 
     #---------------------------------remove image---------------------------------------
+    if mode == 'manifest':
+        manifest_path = get_split_manifest_path(dst_dir, os.path.basename(os.path.normpath(dst_dir)))
+        save_split_manifest(manifest_path, {'dataset': 'coco',
+                                            'annotation_file': os.path.abspath(json_path),
+                                            'samples': [{'image_id': img_id,
+                                                         'image': os.path.abspath(os.path.join(imgs_path, img_name))}
+                                                        for img_id, img_name in img_name_dict.items()]})
+        return
+
     makedir(sub_img_path)
 
     num_samples = 0
     for img_id, img_name in img_name_dict.items():
-        shutil.copy(os.path.join(imgs_path, img_name), os.path.join(sub_img_path, '{0}.jpg'.format(img_id)))
+        materialize_file(os.path.join(imgs_path, img_name), os.path.join(sub_img_path, '{0}.jpg'.format(img_id)),
+                         mode)
         num_samples += 1
         view_bar("split coco:", num_samples, len(img_name_dict))
 
     print('Successful copy the number of {0} images to {1}'.format(len(img_name_dict), sub_img_path))
 
 
-def create_index(dataset):
+def load_images_annotations(annotaions_path, img_id_list):
     """
-    create index
-    :param dataset:
-    :return:
+    stream the instance json again and only keep the image info and annotations of selected images
+    :param annotaions_path:
+    :param img_id_list:
+    :return: imgs, img_anns
     """
-    print('creating index...')
-    anns, cats, imgs = {}, {}, {}
-    img_anns, cate_imgs = defaultdict(list), defaultdict(list)
-    if 'annotations' in dataset:
-        for ann in dataset['annotations']:
-            img_anns[ann['image_id']].append(ann)
-            anns[ann['id']] = ann
-
-    if 'images' in dataset:
-        for img in dataset['images']:
-            imgs[img['id']] = img
-
-    if 'categories' in dataset:
-        for cat in dataset['categories']:
-            cats[cat['id']] = cat
-
-    if 'annotations' in dataset and 'categories' in dataset:
-        for ann in dataset['annotations']:
-            cate_imgs[ann['category_id']].append(ann['image_id'])
-    print('index created!')
+    img_id_set = set(img_id_list)
+    imgs, img_anns = {}, defaultdict(list)
+    for key, item in iter_coco_json(annotaions_path):
+        if key == 'images' and item['id'] in img_id_set:
+            imgs[item['id']] = item
+        elif key == 'annotations' and item['image_id'] in img_id_set:
+            img_anns[item['image_id']].append(item)
 
-    return  anns, cats, imgs, img_anns, cate_imgs
+    return imgs, img_anns
 
 
 def get_img_per_categorise(category_imgs, num_category=20, per_cate_base_num=18):
@@ -153,8 +154,8 @@ def get_images_annotaion_info(img_id_list, imgs_raw, img_anns_raw, category_id_l
     annotation_index = 0
     for img_index, img_id in enumerate(img_id_list):
         img_annotations = img_anns_raw[img_id]
+        # keep the original image id, the image_id of annotations and the name of split image refer to it
         img_info = imgs_raw[img_id]
-        img_info['id'] = img_index
         if len(img_annotations) == 0:
             continue
         else:
@@ -171,7 +172,7 @@ def get_images_annotaion_info(img_id_list, imgs_raw, img_anns_raw, category_id_l
 if __name__ == "__main__":
 
     # split coco dataset
-    split_coco(img_dir, instance_dir, sub_coco)
+    split_coco(img_dir, instance_dir, sub_coco, mode='copy')
 
     # evaluate split result
     sub_instance_dir = os.path.join(sub_annotations, 'instances.json')
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : host_loader.py
+# @ Description: numpy/opencv input path, worker processes decode samples into a shared memory ring buffer
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 PM 21:05
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import time
+import queue
+import threading
+import multiprocessing
+import numpy as np
+import cv2 as cv
+
+from data.pascal.voc_annotation import load_voc_annotations
+from data.tfrecord_utils import resize_image_and_boxes
+from libs.configs import cfgs
+
+
+def get_voc_samples(image_dir, annotation_dir, img_format='jpg', num_workers=4):
+    """
+    get (image path, gtbox_label) of every annotated image
+    :param image_dir:
+    :param annotation_dir:
+    :param img_format:
+    :param num_workers: number of xml parse process
+    :return:
+    """
+    annotations = load_voc_annotations(annotation_dir, num_workers=num_workers)
+    samples = []
+    for index in range(annotations.num_images):
+        img_name = annotations.image_names[index]
+        try:
+            gtbox_label = annotations.get_gtbox_label(index, cfgs.PASCAL_NAME_LABEL_MAP)
+        except KeyError as e:
+            print('{0}: unknown class {1}'.format(img_name, e))
+            continue
+        samples.append((os.path.join(image_dir, '{0}.{1}'.format(img_name, img_format)), gtbox_label))
+    return samples
+
+
+def load_sample(image_path, gtbox_label, shortside_len, length_limitation, is_training=False):
+    """
+    read, resize and random flip a sample
+    :param image_path:
+    :param gtbox_label: int32 [-1, 5]
+    :param shortside_len:
+    :param length_limitation:
+    :param is_training:
+    :return: uint8 RGB image [h, w, 3], int32 gtbox_label [-1, 5]
+    """
+    bgr_img = cv.imread(image_path)
+    if bgr_img is None:
+        raise IOError('failed to read {0}'.format(image_path))
+    image = cv.cvtColor(bgr_img, cv.COLOR_BGR2RGB)
+    image, gtbox_label = resize_image_and_boxes(image, gtbox_label, shortside_len, length_limitation)
+    if is_training and np.random.rand() < 0.5:
+        width = image.shape[1]
+        image = image[:, ::-1]
+        gtbox_label = gtbox_label.copy()
+        gtbox_label[:, 0], gtbox_label[:, 2] = width - gtbox_label[:, 2], width - gtbox_label[:, 0]
+    return image, gtbox_label
+
+
+def _decode_worker(shared_buffer, slot_bytes, image_capacity, max_objects, samples, task_queue, free_queue, ready_queue,
+                   shortside_len, length_limitation, is_training, seed):
+    """
+    decode samples of task queue into free slots of ring buffer, and put (slot, sample index, h, w, num_objects)
+    to ready queue. only the slot metadata passes the queues, the pixels are written to shared memory
+    """
+    np.random.seed(seed)
+    # keep opencv single threaded, the parallelism comes from processes
+    cv.setNumThreads(1)
+    shared_buffer = np.frombuffer(shared_buffer, dtype=np.uint8)
+    while True:
+        index = task_queue.get()
+        if index is None:
+            break
+        slot = free_queue.get()
+        try:
+            image, gtbox_label = load_sample(samples[index][0], samples[index][1], shortside_len,
+                                             length_limitation, is_training=is_training)
+        except Exception as e:
+            print('failed to load {0}: {1}'.format(samples[index][0], e))
+            free_queue.put(slot)
+            ready_queue.put((None, index, 0, 0, 0))
+            continue
+        height, width = image.shape[0], image.shape[1]
+        num_objects = min(len(gtbox_label), max_objects)
+        offset = slot * slot_bytes
+        image_view = np.ndarray((height, width, 3), dtype=np.uint8, buffer=shared_buffer, offset=offset)
+        image_view[...] = image
+        box_view = np.ndarray((num_objects, 5), dtype=np.int32, buffer=shared_buffer,
+                              offset=offset + image_capacity)
+        box_view[...] = gtbox_label[:num_objects]
+        del image_view, box_view
+        ready_queue.put((slot, index, height, width, num_objects))
+
+
+class HostDataLoader(object):
+    """
+    load training batches with numpy and opencv in worker processes.
+    every worker decodes, resizes and flips samples into a slot of a shared memory ring buffer, the trainer assembles
+    the padded batch directly from the slots and returns them to the free list.
+    the batch has the same layout as dataset_tfrecord: filename, image, gtboxes_and_label, num_objects, img_size
+    """
+    def __init__(self, samples, shortside_len, length_limitation, batch_size=1, num_workers=4, num_slots=None,
+                 epoch=1, shuffle=True, is_training=True, max_objects=256, seed=0):
+        """
+        :param samples: list of (image path, int32 gtbox_label [-1, 5])
+        :param shortside_len:
+        :param length_limitation:
+        :param batch_size:
+        :param num_workers: number of decode process
+        :param num_slots: number of slots of ring buffer, default 2 * (num_workers + batch_size)
+        :param epoch:
+        :param shuffle:
+        :param is_training: random flip when training
+        :param max_objects: max number of objects stored of an image
+        :param seed:
+        """
+        self.samples = samples
+        self.batch_size = batch_size
+        self.epoch = epoch
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_slots = num_slots or 2 * (num_workers + batch_size)
+        # the resized image is at most shortside_len x length_limitation
+        self.image_capacity = shortside_len * length_limitation * 3
+        self.slot_bytes = self.image_capacity + max_objects * 5 * 4
+
+        context = multiprocessing.get_context('spawn')
+        # lock free shared array, the slots are owned by one process at a time through the free and ready queues
+        self.shared_buffer = context.RawArray('B', self.slot_bytes * self.num_slots)
+        self.buffer = np.frombuffer(self.shared_buffer, dtype=np.uint8)
+        self.task_queue = context.Queue(maxsize=self.num_slots * 2)
+        self.free_queue = context.Queue()
+        self.ready_queue = context.Queue()
+        for slot in range(self.num_slots):
+            self.free_queue.put(slot)
+        self.workers = [context.Process(target=_decode_worker,
+                                        args=(self.shared_buffer, self.slot_bytes, self.image_capacity, max_objects,
+                                              samples, self.task_queue, self.free_queue, self.ready_queue,
+                                              shortside_len, length_limitation, is_training, seed + i),
+                                        daemon=True)
+                        for i in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+        self.num_tasks = len(samples) * epoch
+        self.num_done = 0
+        self.stop_event = threading.Event()
+        self.feeder = threading.Thread(target=self._feed_tasks, daemon=True)
+        self.feeder.start()
+
+    def _feed_tasks(self):
+        random_state = np.random.RandomState(self.seed)
+        for _ in range(self.epoch):
+            indices = random_state.permutation(len(self.samples)) if self.shuffle else np.arange(len(self.samples))
+            for index in indices.tolist():
+                while not self.stop_event.is_set():
+                    try:
+                        self.task_queue.put(index, timeout=1)
+                        break
+                    except queue.Full:
+                        continue
+                if self.stop_event.is_set():
+                    return
+        for _ in self.workers:
+            self.task_queue.put(None)
+
+    def next_batch(self):
+        """
+        :return: filename [batch], float32 image [batch, h, w, 3] (mean subtracted, zero padded),
+                 int32 gtboxes_and_label [batch, max_num_objects, 5], int32 num_objects [batch],
+                 int32 img_size [batch, 2] (height, width before padding)
+        :raise StopIteration: all epochs are consumed
+        """
+        ready = []
+        while len(ready) < self.batch_size and self.num_done < self.num_tasks:
+            slot, index, height, width, num_objects = self.ready_queue.get()
+            self.num_done += 1
+            if slot is not None:
+                ready.append((slot, index, height, width, num_objects))
+        if len(ready) == 0:
+            raise StopIteration
+
+        max_height = max([sample[2] for sample in ready])
+        max_width = max([sample[3] for sample in ready])
+        max_num_objects = max([sample[4] for sample in ready])
+        image_batch = np.zeros((len(ready), max_height, max_width, 3), dtype=np.float32)
+        gtboxes_batch = np.zeros((len(ready), max_num_objects, 5), dtype=np.int32)
+        num_objects_batch = np.zeros((len(ready),), dtype=np.int32)
+        img_size_batch = np.zeros((len(ready), 2), dtype=np.int32)
+        filename_batch = []
+        for i, (slot, index, height, width, num_objects) in enumerate(ready):
+            offset = slot * self.slot_bytes
+            image_view = np.ndarray((height, width, 3), dtype=np.uint8, buffer=self.buffer, offset=offset)
+            box_view = np.ndarray((num_objects, 5), dtype=np.int32, buffer=self.buffer,
+                                  offset=offset + self.image_capacity)
+            # image is mean subtracted, zero padding is the mean color
+            np.subtract(image_view, np.array(cfgs.PIXEL_MEAN, dtype=np.float32),
+                        out=image_batch[i, :height, :width])
+            gtboxes_batch[i, :num_objects] = box_view
+            num_objects_batch[i] = num_objects
+            img_size_batch[i] = (height, width)
+            filename_batch.append(os.path.basename(self.samples[index][0]).encode())
+            del image_view, box_view
+            self.free_queue.put(slot)
+        return np.array(filename_batch), image_batch, gtboxes_batch, num_objects_batch, img_size_batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next_batch()
+
+    def close(self):
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+
+
+def measure_throughput(next_batch, num_batches, warmup=5):
+    """
+    :param next_batch: function return a batch whose second item is the image batch
+    :param num_batches:
+    :param warmup: number of batches skipped before timing
+    :return: images per second
+    """
+    for _ in range(warmup):
+        next_batch()
+    num_images = 0
+    start_time = time.perf_counter()
+    for _ in range(num_batches):
+        num_images += len(next_batch()[1])
+    return num_images / (time.perf_counter() - start_time)
+
+
+if __name__ == "__main__":
+    import tensorflow as tf
+    from data.pascal.read_tfrecord import dataset_tfrecord
+
+    num_batches = 200
+    samples = get_voc_samples(cfgs.VOC_IMAGE_DIR, cfgs.VOC_ANNOTATION_DIR)
+    loader = HostDataLoader(samples, shortside_len=cfgs.IMG_SHORT_SIDE_LEN, length_limitation=cfgs.IMG_MAX_LENGTH,
+                            batch_size=cfgs.BATCH_SIZE, num_workers=cfgs.HOST_LOADER_WORKERS, epoch=100)
+    try:
+        host_speed = measure_throughput(loader.next_batch, num_batches)
+    finally:
+        loader.close()
+
+    batch = dataset_tfrecord(record_file=cfgs.TFRECORD_DIR, shortside_len=cfgs.IMG_SHORT_SIDE_LEN,
+                             length_limitation=cfgs.IMG_MAX_LENGTH, batch_size=cfgs.BATCH_SIZE, epoch=100,
+                             is_training=True)
+    with tf.Session() as sess:
+        tfrecord_speed = measure_throughput(lambda: sess.run(batch), num_batches)
+
+    print('host loader: {0:.1f} images/s | dataset_tfrecord: {1:.1f} images/s'.format(host_speed, tfrecord_speed))
@@ -6,14 +6,16 @@
 # @ Time 10/12/2019 PM 17:05
 
 import os
-import glob
 import random
+import functools
 import numpy as np
 import tensorflow  as tf
-import xml.etree.cElementTree as ET
 import cv2 as cv
 
 from utils.tools import makedir, view_bar
+from data.tfrecord_utils import write_shards, load_record_image, RECORD_FORMATS
+from data.pascal.voc_annotation import load_voc_annotations
+from data.split_utils import load_split_manifest
 from libs.configs import cfgs
 
 
@@ -42,6 +44,14 @@ tf.app.flags.DEFINE_string('year', '2007,2012', 'Desired challenge year.')
 tf.app.flags.DEFINE_string('save_dir', tfrecord_dir, 'save name')
 tf.app.flags.DEFINE_string('img_format', 'jpg', 'format of image')
 tf.app.flags.DEFINE_string('dataset', 'car', 'dataset')
+tf.app.flags.DEFINE_integer('num_workers', 1, 'number of conversion process')
+tf.app.flags.DEFINE_string('record_format', 'raw', 'raw: decoded pixels | encoded: original jpeg/png bytes')
+tf.app.flags.DEFINE_integer('shortside_len', 0, 'resize image to the short side length when conversion, 0 keep size')
+tf.app.flags.DEFINE_integer('length_limitation', cfgs.IMG_MAX_LENGTH, 'max length of resized image')
+tf.app.flags.DEFINE_string('compression', '', 'compression type of shards: "" | GZIP | ZLIB')
+tf.app.flags.DEFINE_boolean('incremental', False, 'only convert new or changed samples of last conversion')
+tf.app.flags.DEFINE_string('split_file', '', 'split manifest written by split_pascal, convert it instead of dataset')
+tf.app.flags.DEFINE_integer('shard_mb', 0, 'target size(MB) of shard, 0 split shards by record capacity')
 FLAGS = tf.app.flags.FLAGS
 
 
@@ -61,150 +71,141 @@ def _bytes_feature(value):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
 
-def read_xml_gtbox_and_label(xml_path):
-    """
-    read gtbox(ground truth) and label from xml
-    :param xml_path: the path of voc xml
-    :return: a list contains gtboxes and labels, shape is [num_of_gtboxes, 5],
-           and has [xmin, ymin, xmax, ymax, label] in a per row
-    """
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
-    img_width = None
-    img_height = None
-    box_list = []
-    for child_of_root in root:
-        if child_of_root.tag == 'size':
-            for child_item in child_of_root:
-                if child_item.tag == 'width':
-                    img_width = int(child_item.text)
-                if child_item.tag == 'height':
-                    img_height = int(child_item.text)
-
-        if child_of_root.tag == 'object':
-            label = None
-            for child_item in child_of_root:
-                if child_item.tag == 'name':
-                    # label = NAME_LABEL_MAP[child_item.text]
-                    label=cfgs.PASCAL_NAME_LABEL_MAP[child_item.text]
-                if child_item.tag == 'bndbox':
-                    tmp_box = []
-                    xmin, ymin, xmax, ymax = None, None, None, None
-                    for node in child_item:
-                        if node.tag == 'xmin':
-                            xmin = int(eval(node.text))
-                        if node.tag == 'ymin':
-                            ymin = int(eval(node.text))
-                        if node.tag == 'xmax':
-                            xmax = int(eval(node.text))
-                        if node.tag == 'ymax':
-                            ymax = int(eval(node.text))
-                    tmp_box = [xmin, ymin, xmax, ymax]
-                    # tmp_box.append()
-                    assert label is not None, 'label is none, error'
-                    tmp_box.append(label)
-                    box_list.append(tmp_box)
-
-    gtbox_label = np.array(box_list, dtype=np.int32)  # [x1, y1. x2, y2, label]
-
-    # xmin, ymin, xmax, ymax, label = gtbox_label[:, 0], gtbox_label[:, 1], gtbox_label[:, 2], gtbox_label[:, 3], \
-    #                                 gtbox_label[:, 4]
-    # gtbox_label = np.transpose(np.stack([ymin, xmin, ymax, xmax, label], axis=0))  # [ymin, xmin, ymax, xmax, label]
-
-    return img_height, img_width, gtbox_label
-
-
-def convert_pascal_to_tfrecord(dataset_path, save_path, record_capacity=2000, shuffling=False):
+def convert_pascal_to_tfrecord(dataset_path, save_path, record_capacity=2000, shuffling=False, num_workers=1,
+                               record_format='raw', shortside_len=0, length_limitation=cfgs.IMG_MAX_LENGTH,
+                               compression='', incremental=False, shard_bytes=0,
+                               split_file=''):
     """
     convert pascal dataset to rfrecord
-    :param img_path:
-    :param xml_path:
+    :param dataset_path:
     :param save_path:
     :param record_capacity:
+    :param shuffling:
+    :param num_workers: number of conversion process, every worker writes its own shards
+    :param record_format: 'raw' store decoded pixels, 'encoded' store the original compressed image bytes
+    :param shortside_len: if not 0, images are resized to the short side length(IMG_SHORT_SIDE_LEN of training)
+                          when conversion, and the input pipeline skip resize
+    :param length_limitation: max length of resized image(IMG_MAX_LENGTH of training)
+    :param compression: compression type of shards, '', 'GZIP' or 'ZLIB'
+    :param incremental: if True, only encode new or changed samples and rewrite the affected shards
+    :param shard_bytes: if not 0, balance samples to shards of about shard_bytes by estimated size
+    :param split_file: if not '', convert the samples of split manifest written by split_pascal instead of dataset_path
     :return:
     """
+    assert record_format in RECORD_FORMATS, 'record format must in {0}'.format(RECORD_FORMATS)
     # record_file = os.path.join(FLAGS.save_dir, FLAGS.save_name+'.tfrecord')
-    years = [s.strip() for s in FLAGS.year.split(',')]
-    # get image and xml list
-    img_name_list = []
-    img_xml_list = []
-
-    for year in years:
-        img_path = os.path.join(dataset_path, 'VOC'+year, FLAGS.image_dir)
-        xml_path = os.path.join(dataset_path, 'VOC'+year, FLAGS.xml_dir)
-        xml_list = [xml_file for xml_file in glob.glob(os.path.join(xml_path, '*.xml'))]
-        img_list = [os.path.join(img_path, os.path.basename(xml).replace('xml', FLAGS.img_format)) for xml in xml_list]
-        img_name_list.extend(img_list)
-        img_xml_list.extend(xml_list)
-
+    # get image and annotation list
+    if split_file:
+        # split manifest refer to the original image and xml dir
+        split_manifest = load_split_manifest(split_file, dataset='pascal')
+        samples = get_samples(split_manifest['image_dir'], split_manifest['annotation_dir'],
+                              image_names=split_manifest['samples'], num_workers=num_workers)
+    else:
+        years = [s.strip() for s in FLAGS.year.split(',')]
+        samples = []
+        for year in years:
+            img_path = os.path.join(dataset_path, 'VOC'+year, FLAGS.image_dir)
+            xml_path = os.path.join(dataset_path, 'VOC'+year, FLAGS.xml_dir)
+            samples.extend(get_samples(img_path, xml_path, num_workers=num_workers))
 
     if shuffling:
-        shuffled_index = list(range(len(img_name_list)))
         random.seed(0)
-        random.shuffle(shuffled_index)
-        img_name_shuffle = [img_name_list[index] for index in shuffled_index]
-        img_xml_shuffle = [img_xml_list[index] for index in shuffled_index]
-        img_name_list = img_name_shuffle
-        img_xml_list = img_xml_shuffle
-
-    remainder_num = len(img_name_list) % record_capacity
-    if remainder_num == 0:
-        num_record = int(len(img_name_list) / record_capacity)
-    else:
-        num_record = int(len(img_name_list) / record_capacity) + 1
-
-    num_samples = 0
-    for index in range(num_record):
-        record_filename = os.path.join(save_path, f'{index}.record')
-        write = tf.io.TFRecordWriter(record_filename)
-        if index < num_record - 1:
-            sub_img_list = img_name_list[index * record_capacity: (index + 1) * record_capacity]
-            sub_xml_list = img_xml_list[index * record_capacity: (index + 1) * record_capacity]
-        else:
-            sub_img_list = img_name_list[(index * record_capacity): (index * record_capacity + remainder_num)]
-            sub_xml_list = img_xml_list[(index * record_capacity): (index * record_capacity + remainder_num)]
+        random.shuffle(samples)
+
+    if not shortside_len:
+        length_limitation = 0
+    serialize_fn = functools.partial(serialize_sample, record_format=record_format, shortside_len=shortside_len,
+                                     length_limitation=length_limitation)
+    return write_shards(samples, serialize_fn=serialize_fn, save_path=save_path, record_capacity=record_capacity,
+                        num_workers=num_workers, compression=compression, incremental=incremental,
+                        shard_bytes=shard_bytes,
+                        manifest_info={'record_format': record_format,
+                                       'resized_shortside': shortside_len,
+                                       'resized_max_length': length_limitation})
 
+
+def get_samples(img_path, xml_path, image_names=None, num_workers=1):
+    """
+    get samples of a voc dir from the annotation cache
+    :param img_path: image dir
+    :param xml_path: xml dir
+    :param image_names: only get samples of these names if not None
+    :param num_workers: number of xml parse process
+    :return:
+    """
+    annotations = load_voc_annotations(xml_path, num_workers=max(num_workers, 1))
+    if image_names is None:
+        indices = range(annotations.num_images)
+    else:
+        indices = [annotations.get_index(img_name) for img_name in image_names]
+        missing = [img_name for img_name, index in zip(image_names, indices) if index is None]
+        if len(missing) > 0:
+            print('{0} samples have no annotation in {1}'.format(len(missing), xml_path))
+        indices = [index for index in indices if index is not None]
+
+    samples = []
+    for index in indices:
+        img_name = annotations.image_names[index]
         try:
-            for img_file, xml_file in zip(sub_img_list, sub_xml_list):
-
-                img_height, img_width, gtbox_label = read_xml_gtbox_and_label(xml_file)
-                # note image channel format of opencv if rgb
-                bgr_image = cv.imread(img_file)
-                # BGR TO RGB
-                rgb_image = cv.cvtColor(bgr_image, cv.COLOR_BGR2RGB)
-
-                image_record = serialize_example(image=rgb_image, img_height=img_height, img_width=img_width, img_depth=3,
-                                                 filename=img_file, gtbox_label=gtbox_label)
-                write.write(record=image_record)
-
-                num_samples += 1
-                view_bar(message='\nConversion progress', num=num_samples, total=len(img_name_list))
-                
-        except Exception as e:
-            print(e)
+            gtbox_label = annotations.get_gtbox_label(index, cfgs.PASCAL_NAME_LABEL_MAP)
+        except KeyError as e:
+            print('\n{0}: unknown class {1}'.format(img_name, e))
             continue
-        write.close()
-    print('\nThere are {0} samples convert to {1}'.format(num_samples, save_path))
+        samples.append({'image': os.path.join(img_path, '{0}.{1}'.format(img_name, FLAGS.img_format)),
+                        'height': int(annotations.heights[index]) or None,
+                        'width': int(annotations.widths[index]) or None,
+                        'annotations': gtbox_label})
+    return samples
+
+
+def serialize_sample(sample, record_format='raw', shortside_len=0, length_limitation=0):
+    """
+    load image and annotation of a sample and serialize them
+    :param sample: {'image': image path, 'height':, 'width':,
+                    'annotations': int32 [num_objects, 5] gtbox and label of image}
+    :param record_format: 'raw' or 'encoded'
+    :param shortside_len: if not 0, store image resized to the short side length
+    :param length_limitation: max length of resized image
+    :return:
+    """
+    gtbox_label = np.array(sample['annotations'], dtype=np.int32).reshape(-1, 5)
+    image, image_format, img_height, img_width, gtbox_label = load_record_image(sample['image'], gtbox_label,
+                                                                                record_format=record_format,
+                                                                                shortside_len=shortside_len,
+                                                                                length_limitation=length_limitation,
+                                                                                img_height=sample['height'],
+                                                                                img_width=sample['width'])
+
+    return serialize_example(image=image, img_height=img_height, img_width=img_width, img_depth=3,
+                             filename=sample['image'], gtbox_label=gtbox_label, image_format=image_format,
+                             shortside_len=shortside_len, length_limitation=length_limitation)
 
 
-def serialize_example(image, img_height, img_width, img_depth, filename, gtbox_label):
+def serialize_example(image, img_height, img_width, img_depth, filename, gtbox_label, image_format='raw',
+                      shortside_len=0, length_limitation=0):
     """
     create a tf.Example message to be written to a file
     :param label: label info
-    :param image: image content
+    :param image: image content, RGB array when image_format is 'raw' else encoded bytes
     :param filename: image name
+    :param image_format: 'raw', 'jpeg' or 'png'
+    :param shortside_len: short side length the image already resized to, 0 means original size
+    :param length_limitation: max length the image already resized to
     :return:
     """
     # create a dict mapping the feature name to the tf.Example compatible
     # image_shape = tf.image.decode_jpeg(image_string).eval().shape
     feature = {
-        'image': _bytes_feature(image.tostring()),
+        'image': _bytes_feature(image.tostring() if image_format == 'raw' else image),
         'height': _int64_feature(img_height),
         'width': _int64_feature(img_width),
         'depth':_int64_feature(img_depth),
         'filename': _bytes_feature(filename.encode()),
         'gtboxes_and_label': _bytes_feature(gtbox_label.tostring()),
-        'num_objects': _int64_feature(gtbox_label.shape[0])
+        'num_objects': _int64_feature(gtbox_label.shape[0]),
+        'format': _bytes_feature(image_format.encode()),
+        'resized_shortside': _int64_feature(shortside_len),
+        'resized_max_length': _int64_feature(length_limitation)
     }
     # create a feature message using tf.train.Example
     example_proto = tf.train.Example(features=tf.train.Features(feature=feature))
@@ -215,7 +216,11 @@ if __name__ == "__main__":
     image_path = os.path.join(FLAGS.dataset_dir, FLAGS.image_dir)
     xml_path = os.path.join(FLAGS.dataset_dir, FLAGS.xml_dir)
 
-    convert_pascal_to_tfrecord(dataset_path=FLAGS.dataset_dir,save_path=FLAGS.save_dir, record_capacity=4000)
+    convert_pascal_to_tfrecord(dataset_path=FLAGS.dataset_dir,save_path=FLAGS.save_dir, record_capacity=4000,
+                               num_workers=FLAGS.num_workers, record_format=FLAGS.record_format,
+                               shortside_len=FLAGS.shortside_len, length_limitation=FLAGS.length_limitation,
+                               compression=FLAGS.compression, incremental=FLAGS.incremental,
+                               shard_bytes=FLAGS.shard_mb * 2 ** 20, split_file=FLAGS.split_file)
 
 
 
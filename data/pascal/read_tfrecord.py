@@ -8,9 +8,16 @@
 
 import os
 import glob
+import math
+import random
 import tensorflow as tf
 import matplotlib.pyplot as plt
 from tensorflow.python_io import tf_record_iterator
+from tensorflow.contrib.staging import StagingArea
+
+from data.tfrecord_utils import get_record_list, load_manifest, get_compression_type
+from data.record_index import load_record_index
+from libs.configs import cfgs
 
 from libs.box_utils import show_box_in_tensor
 
@@ -26,69 +33,172 @@ IMG_SHORT_SIDE_LEN = 600
 IMG_MAX_LENGTH = 1000
 
 
-def read_parse_single_example(serialized_sample, shortside_len, length_limitation, is_training=False):
+def get_feature_description():
     """
-    parse tensor
-    :param image_sample:
+    feature description of sample
     :return:
     """
-    # construct feature description
-    image_feature_description = {
+    return {
         'filename': tf.FixedLenFeature([], tf.string),
         'height': tf.FixedLenFeature([], tf.int64),
         'width': tf.FixedLenFeature([], tf.int64),
         'depth': tf.FixedLenFeature([], tf.int64),
         'image': tf.FixedLenFeature([], tf.string),
         'gtboxes_and_label': tf.FixedLenFeature([], tf.string),
-        'num_objects': tf.FixedLenFeature([], tf.int64)
+        'num_objects': tf.FixedLenFeature([], tf.int64),
+        # shards written before the format feature existed store raw pixels
+        'format': tf.FixedLenFeature([], tf.string, default_value='raw'),
+        # the resolution image already resized to when conversion, 0 means original resolution
+        'resized_shortside': tf.FixedLenFeature([], tf.int64, default_value=0),
+        'resized_max_length': tf.FixedLenFeature([], tf.int64, default_value=0)
     }
-    feature = tf.io.parse_single_example(serialized=serialized_sample, features=image_feature_description)
 
+
+def read_parse_single_example(serialized_sample, shortside_len, length_limitation, is_training=False,
+                              sample_cache=None):
+    """
+    parse tensor
+    :param image_sample:
+    :param shortside_len: int or int32 scalar tensor sampled for multi-scale training
+    :param sample_cache: SampleCache of resized samples, decode and resize are skipped when hit
+    :return:
+    """
+    feature = tf.io.parse_single_example(serialized=serialized_sample, features=get_feature_description())
+    return process_parsed_example(feature, shortside_len=shortside_len, length_limitation=length_limitation,
+                                  is_training=is_training, sample_cache=sample_cache)
+
+
+def parse_example_batch(serialized_samples):
+    """
+    parse a batch of serialized samples with one op
+    :param serialized_samples: string tensor [batch]
+    :return: dict of feature, every value has shape [batch]
+    """
+    return tf.io.parse_example(serialized=serialized_samples, features=get_feature_description())
+
+
+def process_parsed_example(feature, shortside_len, length_limitation, is_training=False, sample_cache=None,
+                           seed=None):
+    """
+    decode, resize and augment a parsed sample
+    :param feature: dict of feature of one sample
+    :param shortside_len:
+    :param length_limitation:
+    :param is_training:
+    :param sample_cache:
+    :param seed: int64 tensor [2] of stateless random flip, None use stateful random op
+    :return: image, filename, gtboxes_and_label, num_objects
+    """
     # parse feature
-    image = tf.decode_raw(feature['image'], tf.uint8)
     # shape = tf.cast(feature['shape'], tf.int32)
     height = tf.cast(feature['height'], tf.int32)
     width = tf.cast(feature['width'], tf.int32)
     depth = tf.cast(feature['depth'], tf.int32)
-    image = tf.reshape(image, [height, width, depth])
     filename = tf.cast(feature['filename'], tf.string)
-    # image augmentation
-    # image = augmentation_image(image=image, image_shape=input_shape)
-    # parse gtbox
-    gtboxes_and_label = tf.decode_raw(feature['gtboxes_and_label'], tf.int32)
-    gtboxes_and_label = tf.reshape(gtboxes_and_label, shape=[-1, 5])
     num_objects = tf.cast(feature['num_objects'], tf.int32)
-
+    # skip resize when the shard is already resized to target resolution
+    resized = tf.logical_and(tf.equal(feature['resized_shortside'], tf.cast(shortside_len, tf.int64)),
+                             tf.equal(feature['resized_max_length'], tf.cast(length_limitation, tf.int64)))
+
+    def _decode_sample():
+        image = decode_image(feature['image'], image_format=feature['format'], height=height, width=width,
+                             depth=depth)
+        # image augmentation
+        # image = augmentation_image(image=image, image_shape=input_shape)
+        # parse gtbox
+        gtboxes_and_label = tf.decode_raw(feature['gtboxes_and_label'], tf.int32)
+        gtboxes_and_label = tf.reshape(gtboxes_and_label, shape=[-1, 5])
+        return image, gtboxes_and_label
+
+    if sample_cache is None:
+        image, gtboxes_and_label = _decode_sample()
+        image, gtboxes_and_label = image_process(image, gtboxes_and_label, shortside_len=shortside_len,
+                                                 length_limitation=length_limitation, is_training=is_training,
+                                                 resized=resized, seed=seed)
+        return image, filename, gtboxes_and_label, num_objects
+
+    def _decode_resize_and_cache():
+        image, gtboxes_and_label = _decode_sample()
+        image, gtboxes_and_label = resize_sample(image, gtboxes_and_label, shortside_len=shortside_len,
+                                                 length_limitation=length_limitation, resized=resized)
+        image = tf.cast(tf.clip_by_value(tf.round(image), 0., 255.), tf.uint8)
+        return sample_cache.insert_op(filename, shortside_len, length_limitation, image, gtboxes_and_label)
+
+    # the cache holds resized uint8 samples before random flip
+    found, cached_image, cached_gtboxes_and_label = sample_cache.lookup_op(filename, shortside_len,
+                                                                           length_limitation)
+    image, gtboxes_and_label = tf.cond(found,
+                                       true_fn=lambda: (cached_image, cached_gtboxes_and_label),
+                                       false_fn=_decode_resize_and_cache)
     image, gtboxes_and_label = image_process(image, gtboxes_and_label, shortside_len=shortside_len,
-                                             length_limitation=length_limitation, is_training=is_training)
+                                             length_limitation=length_limitation, is_training=is_training,
+                                             resized=True, seed=seed)
     return image, filename, gtboxes_and_label, num_objects
 
 
-def image_process(image, gtboxes_and_label, shortside_len, length_limitation, is_training=False):
+def decode_image(image_string, image_format, height, width, depth):
+    """
+    decode image according to the record format
+    :param image_string: raw pixels or encoded image bytes
+    :param image_format: 'raw', 'jpeg' or 'png'
+    :param height:
+    :param width:
+    :param depth:
+    :return: uint8 image tensor [height, width, depth]
+    """
+    image = tf.case([(tf.equal(image_format, 'jpeg'), lambda: tf.image.decode_jpeg(image_string, channels=3)),
+                     (tf.equal(image_format, 'png'), lambda: tf.image.decode_png(image_string, channels=3))],
+                    default=lambda: tf.decode_raw(image_string, tf.uint8),
+                    exclusive=True)
+    return tf.reshape(image, [height, width, depth])
+
+
+def image_process(image, gtboxes_and_label, shortside_len, length_limitation, is_training=False, resized=None,
+                  seed=None):
     """
     image process
     :param image:
     :param gtboxes_and_label:
     :param shortside_len:
+    :param resized: bool tensor, True if image already has the target resolution
+    :param seed: int64 tensor [2] of stateless random flip, None use stateful random op
     :return:
     """
-    img = tf.cast(image, tf.float32)
+    img, gtboxes_and_label = resize_sample(image, gtboxes_and_label, shortside_len=shortside_len,
+                                           length_limitation=length_limitation, resized=resized)
     if is_training:
-        img, gtboxes_and_label = short_side_resize(img_tensor=img, gtboxes_and_label=gtboxes_and_label,
-                                                                    target_shortside_len=shortside_len,
-                                                                    length_limitation=length_limitation)
-        img, gtboxes_and_label = random_flip_left_right(img_tensor=img,
-                                                                         gtboxes_and_label=gtboxes_and_label)
-
-    else:
-        img, gtboxes_and_label = short_side_resize(img_tensor=img, gtboxes_and_label=gtboxes_and_label,
-                                                                    target_shortside_len=shortside_len,
-                                                                    length_limitation=length_limitation)
+        img, gtboxes_and_label = random_flip_left_right(img_tensor=img, gtboxes_and_label=gtboxes_and_label,
+                                                        seed=seed)
     image = img - tf.constant([_R_MEAN, _G_MEAN, _B_MEAN], dtype=tf.float32)
     # image = image_whitened(img)
     return image, gtboxes_and_label
 
 
+def resize_sample(image, gtboxes_and_label, shortside_len, length_limitation, resized=None):
+    """
+    cast image to float and resize it to target resolution
+    :param image:
+    :param gtboxes_and_label:
+    :param shortside_len:
+    :param length_limitation:
+    :param resized: bool tensor, True if image already has the target resolution. python True skip resize
+    :return:
+    """
+    img = tf.cast(image, tf.float32)
+    if resized is None:
+        img, gtboxes_and_label = short_side_resize(img_tensor=img, gtboxes_and_label=gtboxes_and_label,
+                                                   target_shortside_len=shortside_len,
+                                                   length_limitation=length_limitation)
+    elif resized is not True:
+        img, gtboxes_and_label = tf.cond(resized,
+                                         true_fn=lambda: (img, gtboxes_and_label),
+                                         false_fn=lambda: short_side_resize(img_tensor=img,
+                                                                            gtboxes_and_label=gtboxes_and_label,
+                                                                            target_shortside_len=shortside_len,
+                                                                            length_limitation=length_limitation))
+    return img, gtboxes_and_label
+
+
 def image_whitened(image, means=(_R_MEAN, _G_MEAN, _B_MEAN)):
     """Subtracts the given means from each image channel.
     Returns:
@@ -129,13 +239,33 @@ def short_side_resize(img_tensor, gtboxes_and_label, target_shortside_len, lengt
     img_tensor = tf.expand_dims(img_tensor, axis=0)
     img_tensor = tf.image.resize_bilinear(img_tensor, [new_h, new_w])
 
-    xmin, ymin, xmax, ymax, label = tf.unstack(gtboxes_and_label, axis=1)
-
-    new_xmin, new_ymin = xmin * new_w // img_w, ymin * new_h // img_h
-    new_xmax, new_ymax = xmax * new_w // img_w, ymax * new_h // img_h
+    # rescale boxes in float, integer division truncates the coordinates
+    scale_x = tf.cast(new_w, tf.float32) / tf.cast(img_w, tf.float32)
+    scale_y = tf.cast(new_h, tf.float32) / tf.cast(img_h, tf.float32)
+    boxes = tf.cast(gtboxes_and_label[:, :4], tf.float32) * tf.stack([scale_x, scale_y, scale_x, scale_y])
+    boxes = tf.cast(tf.round(boxes), gtboxes_and_label.dtype)
     img_tensor = tf.squeeze(img_tensor, axis=0)  # ensure image tensor rank is 3
 
-    return img_tensor, tf.transpose(tf.stack([new_xmin, new_ymin, new_xmax, new_ymax, label], axis=0))
+    return img_tensor, tf.concat([boxes, gtboxes_and_label[:, 4:]], axis=1)
+
+
+def sample_short_side(short_side_range, short_side_buckets, seed=None):
+    """
+    sample short side uniformly from range and snap it to the nearest bucket
+    :param short_side_range: [min, max]
+    :param short_side_buckets: candidate short sides
+    :param seed: int64 tensor [2] of stateless sampling, None use stateful random op
+    :return: int32 scalar tensor
+    """
+    if seed is None:
+        short_side = tf.random_uniform(shape=[], minval=short_side_range[0], maxval=short_side_range[1] + 1,
+                                       dtype=tf.int32)
+    else:
+        uniform = tf.random.stateless_uniform(shape=[], seed=seed)
+        short_side = short_side_range[0] + tf.cast(tf.floor(uniform * (short_side_range[1] - short_side_range[0] + 1)),
+                                                   tf.int32)
+    buckets = tf.constant(short_side_buckets, dtype=tf.int32)
+    return tf.gather(buckets, tf.argmin(tf.abs(buckets - short_side)))
 
 
 def flip_left_to_right(img_tensor, gtboxes_and_label):
@@ -151,70 +281,368 @@ def flip_left_to_right(img_tensor, gtboxes_and_label):
     return img_tensor, tf.transpose(tf.stack([new_xmin, ymin, new_xmax, ymax, label], axis=0))
 
 
-def random_flip_left_right(img_tensor, gtboxes_and_label):
-    img_tensor, gtboxes_and_label= tf.cond(tf.less(tf.random_uniform(shape=[], minval=0, maxval=1), 0.5),
+def random_flip_left_right(img_tensor, gtboxes_and_label, seed=None):
+    if seed is None:
+        uniform = tf.random_uniform(shape=[], minval=0, maxval=1)
+    else:
+        # stateless random op, the flip only depends on seed
+        uniform = tf.random.stateless_uniform(shape=[], seed=seed)
+    img_tensor, gtboxes_and_label= tf.cond(tf.less(uniform, 0.5),
                                             lambda: flip_left_to_right(img_tensor, gtboxes_and_label),
                                             lambda: (img_tensor, gtboxes_and_label))
     return img_tensor,  gtboxes_and_label
 
 
-def dataset_tfrecord(record_file, shortside_len, length_limitation, batch_size=1, epoch=5, shuffle=True, is_training=False):
+def get_autotune(value):
+    # -1 in cfgs means autotune
+    return tf.data.experimental.AUTOTUNE if value == -1 else value
+
+
+def bucket_batch(dataset, batch_size, aspect_ratio_boundaries, short_side_buckets=None):
     """
-    construct iterator to read image
+    group images of similar aspect ratio (and short side in multi-scale training) into batch and pad them to the
+    largest image of batch
+    :param dataset: dataset of (image, filename, gtboxes_and_label, num_objects, ...), image is the first component
+    :param batch_size:
+    :param aspect_ratio_boundaries: bucket boundaries of width / height
+    :param short_side_buckets: short side buckets of multi-scale training
+    :return: dataset of padded batch
+    """
+    boundaries = tf.constant(aspect_ratio_boundaries, dtype=tf.float32)
+    num_scales = len(short_side_buckets) if short_side_buckets else 1
+
+    def _bucket_id(image, *args):
+        shape = tf.cast(tf.shape(image), tf.float32)
+        aspect_ratio = shape[1] / shape[0]
+        aspect_id = tf.reduce_sum(tf.cast(tf.greater(aspect_ratio, boundaries), tf.int64))
+        if not short_side_buckets:
+            return aspect_id
+        scale_id = tf.argmin(tf.abs(tf.constant(short_side_buckets, dtype=tf.float32) - tf.minimum(shape[0], shape[1])))
+        return aspect_id * num_scales + scale_id
+
+    # pad every unknown dim to the largest of batch, strings with '' and numbers with zero
+    padded_shapes = tf.compat.v1.data.get_output_shapes(dataset)
+    padding_values = tuple([tf.constant('' if dtype == tf.string else 0, dtype=dtype)
+                            for dtype in tf.compat.v1.data.get_output_types(dataset)])
+
+    def _padded_batch(bucket_id, bucket_dataset):
+        # image is mean subtracted, zero padding is the mean color
+        return bucket_dataset.padded_batch(batch_size,
+                                           padded_shapes=padded_shapes,
+                                           padding_values=padding_values)
+
+    return dataset.apply(tf.data.experimental.group_by_window(key_func=_bucket_id, reduce_func=_padded_batch,
+                                                              window_size=batch_size))
+
+
+# stages of the input pipeline built by build_dataset, in order
+INPUT_STAGES = ('read', 'parse', 'process', 'batch')
+
+
+def read_records(record_file, batch_size=1, epoch=5, shuffle=True, is_training=False, compression_type=None,
+                 num_parallel_reads=None, shuffle_buffer_size=None):
+    """
+    stage read: interleave the shards, shuffle and repeat the serialized records
     :param record_file:
-    :return:
+    :param batch_size:
+    :param epoch: None repeats forever
+    :param shuffle:
+    :param is_training:
+    :param compression_type: '', 'GZIP' or 'ZLIB'. if None, get it from shard manifest
+    :param num_parallel_reads: number of shards interleaved, default cfgs.NUM_PARALLEL_READS
+    :param shuffle_buffer_size: default cfgs.SHUFFLE_BUFFER_SIZE
+    :return: dataset of serialized record, (serialized record, position) when is_training
     """
-    record_list = []
-    # check record file format
-    if os.path.isfile(record_file):
-        record_list = [record_file]
-    else:
-        for filename in os.listdir(record_file):
-            record_list.append(os.path.join(record_file, filename))
-    # # use dataset read record file
-    record_dataset = tf.data.TFRecordDataset(record_list)
+    num_parallel_reads = cfgs.NUM_PARALLEL_READS if num_parallel_reads is None else num_parallel_reads
+    shuffle_buffer_size = cfgs.SHUFFLE_BUFFER_SIZE if shuffle_buffer_size is None else shuffle_buffer_size
+
+    # check record file format, only shards are read(skip manifest)
+    record_list = get_record_list(record_file)
+    if compression_type is None:
+        compression_type = get_compression_type(record_file)
+    # read several shards concurrently, and interleave their records
+    cycle_length = len(record_list) if num_parallel_reads == -1 else max(min(num_parallel_reads, len(record_list)), 1)
+    file_dataset = tf.data.Dataset.from_tensor_slices(record_list)
+    if shuffle:
+        file_dataset = file_dataset.shuffle(buffer_size=len(record_list))
+    record_dataset = file_dataset.interleave(lambda record_path: tf.data.TFRecordDataset(
+                                                 record_path, compression_type=compression_type),
+                                             cycle_length=cycle_length,
+                                             block_length=1,
+                                             num_parallel_calls=get_autotune(num_parallel_reads))
+    # shuffle the serialized record before parse, the buffer is much smaller than decoded image
+    if shuffle:
+        record_dataset = record_dataset.shuffle(buffer_size=max(shuffle_buffer_size, batch_size * 4))
+    record_dataset = record_dataset.repeat(epoch)
+    if is_training:
+        # number every sample, the seed (augment_seed, position) of random augmentation is then part of the element
+        # instead of the state of a random op
+        record_dataset = tf.data.Dataset.zip((record_dataset, tf.data.experimental.Counter()))
+    return record_dataset
+
+
+def parse_records(record_dataset, parse_batch_size=None, num_parallel_calls=None):
+    """
+    stage parse: parse the serialized records into feature dict
+    :param record_dataset: dataset of read_records
+    :param parse_batch_size: number of records parsed by one parse_example, default cfgs.PARSE_BATCH_SIZE,
+                             1 means parse record one by one
+    :param num_parallel_calls: number of parse threads, default cfgs.NUM_PARALLEL_CALLS
+    :return: dataset of (feature, ...), the other components of record_dataset are kept
+    """
+    parse_batch_size = cfgs.PARSE_BATCH_SIZE if parse_batch_size is None else parse_batch_size
+    num_parallel_calls = cfgs.NUM_PARALLEL_CALLS if num_parallel_calls is None else num_parallel_calls
+
+    if parse_batch_size > 1:
+        # parse serialized records in batch to reduce the per record op overhead, then unbatch to resize every image
+        feature_dataset = record_dataset.batch(parse_batch_size).map(
+            lambda serialized_samples, *args: (parse_example_batch(serialized_samples),) + args,
+            num_parallel_calls=get_autotune(num_parallel_calls))
+        return feature_dataset.apply(tf.data.experimental.unbatch())
+    return record_dataset.map(lambda series_record, *args:
+                              (tf.io.parse_single_example(serialized=series_record,
+                                                          features=get_feature_description()),) + args,
+                              num_parallel_calls=get_autotune(num_parallel_calls))
+
+
+def process_features(feature_dataset, shortside_len, length_limitation, is_training=False, num_parallel_calls=None,
+                     sample_cache=None, short_side_range=None, short_side_buckets=None, augment_seed=None):
+    """
+    stage process: decode, resize and augment every sample
+    :param feature_dataset: dataset of parse_records
+    :param shortside_len:
+    :param length_limitation:
+    :param is_training:
+    :param num_parallel_calls: default cfgs.NUM_PARALLEL_CALLS
+    :param sample_cache: SampleCache of decoded and resized samples, see data.sample_cache
+    :param short_side_range: [min, max] short side of multi-scale training, default cfgs.TRAIN_SHORT_SIDE_RANGE,
+                             only used when is_training
+    :param short_side_buckets: short sides the sampled short side is snapped to, default cfgs.TRAIN_SHORT_SIDE_BUCKETS
+    :param augment_seed: seed of random flip and short side sampling in training, default cfgs.AUGMENT_SEED,
+                         None is random. the augmentation of a sample is a stateless function of the seed and
+                         the sample position, so the map function can be serialized with the iterator state
+    :return: dataset of (image, filename, gtboxes_and_label, num_objects, img_size)
+    """
+    num_parallel_calls = cfgs.NUM_PARALLEL_CALLS if num_parallel_calls is None else num_parallel_calls
+    short_side_range = cfgs.TRAIN_SHORT_SIDE_RANGE if short_side_range is None else short_side_range
+    short_side_buckets = cfgs.TRAIN_SHORT_SIDE_BUCKETS if short_side_buckets is None else short_side_buckets
+    augment_seed = cfgs.AUGMENT_SEED if augment_seed is None else augment_seed
+    if augment_seed is None:
+        augment_seed = random.randint(0, 2 ** 31 - 1)
+    multi_scale = is_training and len(short_side_range) == 2
+
     # execute parse function to get dataset
-    # This transformation applies map_func to each element of this dataset,
+    # This transformation applies map_func to each element of this dataset,
     # and returns a new dataset containing the transformed elements, in the
     # same order as they appeared in the input.
-    # when parse_example has only one parameter (office recommend)
-    # parse_img_dataset = raw_img_dataset.map(parse_example)
     # when parse_example has more than one parameter which used to process data
-    parse_img_dataset = record_dataset.map(lambda series_record:
-                                            read_parse_single_example(serialized_sample = series_record,
-                                                                      shortside_len=shortside_len,
-                                                                      length_limitation=length_limitation,
-                                                                      is_training=is_training))
+    def _process(feature, position=None):
+        def _seed(offset):
+            return None if position is None else tf.stack([tf.constant(augment_seed + offset, tf.int64), position])
+
+        image, filename, gtboxes_and_label, num_objects = \
+            process_parsed_example(feature,
+                                   shortside_len=sample_short_side(short_side_range, short_side_buckets,
+                                                                   seed=_seed(1))
+                                   if multi_scale else shortside_len,
+                                   length_limitation=length_limitation,
+                                   is_training=is_training,
+                                   sample_cache=sample_cache,
+                                   seed=_seed(0))
+        # size of image before padding
+        return image, filename, gtboxes_and_label, num_objects, tf.shape(image)[:2]
+
+    return feature_dataset.map(_process, num_parallel_calls=get_autotune(num_parallel_calls))
+
+
+def batch_images(image_dataset, batch_size=1, is_training=False, aspect_ratio_boundaries=None, short_side_range=None,
+                 short_side_buckets=None, prefetch_buffer_size=None):
+    """
+    stage batch: batch the images, and prefetch the batches
+    :param image_dataset: dataset of process_features
+    :param batch_size:
+    :param is_training:
+    :param aspect_ratio_boundaries: bucket boundaries of width / height when batch_size > 1,
+                                    default cfgs.ASPECT_RATIO_BOUNDARIES
+    :param short_side_range: default cfgs.TRAIN_SHORT_SIDE_RANGE, images are also bucketed by short side in
+                             multi-scale training
+    :param short_side_buckets: default cfgs.TRAIN_SHORT_SIDE_BUCKETS
+    :param prefetch_buffer_size: number of prefetched batch, default cfgs.PREFETCH_BUFFER_SIZE
+    :return: dataset of batch
+    """
+    aspect_ratio_boundaries = cfgs.ASPECT_RATIO_BOUNDARIES if aspect_ratio_boundaries is None \
+        else aspect_ratio_boundaries
+    short_side_range = cfgs.TRAIN_SHORT_SIDE_RANGE if short_side_range is None else short_side_range
+    short_side_buckets = cfgs.TRAIN_SHORT_SIDE_BUCKETS if short_side_buckets is None else short_side_buckets
+    prefetch_buffer_size = cfgs.PREFETCH_BUFFER_SIZE if prefetch_buffer_size is None else prefetch_buffer_size
+    multi_scale = is_training and len(short_side_range) == 2
+
     # get dataset batch
-    if shuffle:
-        shuffle_batch_dataset = parse_img_dataset.shuffle(buffer_size=batch_size*4).repeat(epoch).batch(batch_size=batch_size)
+    if batch_size > 1:
+        batch_dataset = bucket_batch(image_dataset, batch_size=batch_size,
+                                     aspect_ratio_boundaries=aspect_ratio_boundaries,
+                                     short_side_buckets=short_side_buckets if multi_scale else None)
     else:
-        shuffle_batch_dataset = parse_img_dataset.repeat(epoch).batch(batch_size=batch_size)
+        batch_dataset = image_dataset.batch(batch_size=batch_size)
+    # prepare next batches while the training step runs
+    return batch_dataset.prefetch(buffer_size=get_autotune(prefetch_buffer_size))
+
+
+def build_dataset(record_file, shortside_len, length_limitation, batch_size=1, epoch=5, shuffle=True, is_training=False,
+                  compression_type=None, num_parallel_reads=None, num_parallel_calls=None, shuffle_buffer_size=None,
+                  prefetch_buffer_size=None, aspect_ratio_boundaries=None, sample_cache=None,
+                  short_side_range=None, short_side_buckets=None, parse_batch_size=None, augment_seed=None,
+                  stop_after=None, stats_aggregator=None):
+    """
+    chain the stages of INPUT_STAGES into the input pipeline, see dataset_tfrecord for the parameters
+    :param stop_after: one of INPUT_STAGES, return the pipeline up to this stage. None is the whole pipeline
+    :param stats_aggregator: tf.data.experimental.StatsAggregator, record the latency of every stage to it
+    :return: dataset
+    """
+    if stop_after is not None and stop_after not in INPUT_STAGES:
+        raise ValueError('stop_after must be one of {0}, got {1}'.format(INPUT_STAGES, stop_after))
+    stages = (
+        ('read', lambda dataset: read_records(record_file, batch_size=batch_size, epoch=epoch, shuffle=shuffle,
+                                              is_training=is_training, compression_type=compression_type,
+                                              num_parallel_reads=num_parallel_reads,
+                                              shuffle_buffer_size=shuffle_buffer_size)),
+        ('parse', lambda dataset: parse_records(dataset, parse_batch_size=parse_batch_size,
+                                                num_parallel_calls=num_parallel_calls)),
+        ('process', lambda dataset: process_features(dataset, shortside_len=shortside_len,
+                                                     length_limitation=length_limitation, is_training=is_training,
+                                                     num_parallel_calls=num_parallel_calls,
+                                                     sample_cache=sample_cache, short_side_range=short_side_range,
+                                                     short_side_buckets=short_side_buckets,
+                                                     augment_seed=augment_seed)),
+        ('batch', lambda dataset: batch_images(dataset, batch_size=batch_size, is_training=is_training,
+                                               aspect_ratio_boundaries=aspect_ratio_boundaries,
+                                               short_side_range=short_side_range,
+                                               short_side_buckets=short_side_buckets,
+                                               prefetch_buffer_size=prefetch_buffer_size))
+    )
+    dataset = None
+    for stage, build_stage in stages:
+        dataset = build_stage(dataset)
+        if stats_aggregator is not None:
+            dataset = dataset.apply(tf.data.experimental.latency_stats('input_{0}_latency'.format(stage)))
+        if stage == stop_after:
+            break
+    if stats_aggregator is not None:
+        options = tf.data.Options()
+        options.experimental_stats.aggregator = stats_aggregator
+        dataset = dataset.with_options(options)
+    return dataset
+
+
+def dataset_tfrecord(record_file, shortside_len, length_limitation, batch_size=1, epoch=5, shuffle=True, is_training=False,
+                     compression_type=None, num_parallel_reads=None, num_parallel_calls=None, shuffle_buffer_size=None,
+                     prefetch_buffer_size=None, aspect_ratio_boundaries=None, sample_cache=None,
+                     short_side_range=None, short_side_buckets=None, parse_batch_size=None, saveable=False,
+                     augment_seed=None, stats_aggregator=None):
+    """
+    construct iterator to read image
+    :param record_file:
+    :param compression_type: '', 'GZIP' or 'ZLIB'. if None, get it from shard manifest
+    :param num_parallel_reads: number of shards interleaved, default cfgs.NUM_PARALLEL_READS
+    :param num_parallel_calls: number of parse threads, default cfgs.NUM_PARALLEL_CALLS
+    :param shuffle_buffer_size: default cfgs.SHUFFLE_BUFFER_SIZE
+    :param prefetch_buffer_size: number of prefetched batch, default cfgs.PREFETCH_BUFFER_SIZE
+    :param aspect_ratio_boundaries: bucket boundaries of width / height when batch_size > 1,
+                                    default cfgs.ASPECT_RATIO_BOUNDARIES
+    :param sample_cache: SampleCache of decoded and resized samples, see data.sample_cache
+    :param short_side_range: [min, max] short side of multi-scale training, default cfgs.TRAIN_SHORT_SIDE_RANGE,
+                             only used when is_training
+    :param short_side_buckets: short sides the sampled short side is snapped to, default cfgs.TRAIN_SHORT_SIDE_BUCKETS
+    :param parse_batch_size: number of records parsed by one parse_example, default cfgs.PARSE_BATCH_SIZE,
+                             1 means parse record one by one
+    :param saveable: add the iterator state(position, shuffle buffer and seed) to SAVEABLE_OBJECTS collection,
+                     so tf.train.Saver checkpoints and restores it with the variables.
+                     not supported with sample_cache, its py_func can not be serialized.
+                     batches already taken from the iterator(such as the one in stage_batch) are not part of the
+                     state, they are skipped when resume
+    :param augment_seed: seed of random flip and short side sampling in training, default cfgs.AUGMENT_SEED,
+                         None is random. the augmentation of a sample is a stateless function of the seed and
+                         the sample position, so the map function can be serialized with the iterator state
+    :param stats_aggregator: tf.data.experimental.StatsAggregator, record the latency of every stage to it
+    :return: filename [batch], image [batch, h, w, 3], gtboxes_and_label [batch, max_num_objects, 5],
+             num_objects [batch], img_size [batch, 2]. when batch_size > 1, image and gtboxes_and_label are zero
+             padded, the first num_objects rows of gtboxes_and_label and the top left img_size (height, width)
+             of image are valid
+    """
+    batch_dataset = build_dataset(record_file, shortside_len=shortside_len, length_limitation=length_limitation,
+                                  batch_size=batch_size, epoch=epoch, shuffle=shuffle, is_training=is_training,
+                                  compression_type=compression_type, num_parallel_reads=num_parallel_reads,
+                                  num_parallel_calls=num_parallel_calls, shuffle_buffer_size=shuffle_buffer_size,
+                                  prefetch_buffer_size=prefetch_buffer_size,
+                                  aspect_ratio_boundaries=aspect_ratio_boundaries, sample_cache=sample_cache,
+                                  short_side_range=short_side_range, short_side_buckets=short_side_buckets,
+                                  parse_batch_size=parse_batch_size, augment_seed=augment_seed,
+                                  stats_aggregator=stats_aggregator)
     # make dataset iterator
-    image, filename, gtboxes_and_label, num_objects = shuffle_batch_dataset.make_one_shot_iterator().get_next()
+    iterator = batch_dataset.make_one_shot_iterator()
+    if saveable:
+        if sample_cache is not None:
+            print('iterator state is not saveable with sample cache, input restarts from the beginning when resume')
+        else:
+            tf.add_to_collection(tf.GraphKeys.SAVEABLE_OBJECTS,
+                                 tf.data.experimental.make_saveable_from_iterator(iterator))
+    image, filename, gtboxes_and_label, num_objects, img_size = iterator.get_next()
+
+    return filename, image, gtboxes_and_label, num_objects, img_size
 
-    return filename, image, gtboxes_and_label, num_objects
+
+def stage_batch(tensors, name='stage_batch'):
+    """
+    double buffer the batch with StagingArea, the next batch is put into the area while the current step computes.
+    run stage_op once before the first step, then run it with every training step.
+    the staged batch is out of the saveable iterator state, so the restored input skips one batch when resume
+    :param tensors: list of batch tensors, string tensors are staged on cpu
+    :param name:
+    :return: stage_op, list of staged tensors in the order of tensors
+    """
+    with tf.name_scope(name):
+        string_indices = [i for i, tensor in enumerate(tensors) if tensor.dtype == tf.string]
+        other_indices = [i for i, tensor in enumerate(tensors) if tensor.dtype != tf.string]
+        put_ops = []
+        get_values = []
+        staged_tensors = [None] * len(tensors)
+        for indices, device in ((string_indices, '/cpu:0'), (other_indices, None)):
+            if len(indices) == 0:
+                continue
+            with tf.device(device):
+                staging_area = StagingArea(dtypes=[tensors[i].dtype for i in indices])
+                put_ops.append(staging_area.put([tensors[i] for i in indices]))
+                # the get of every area runs in the same step as the gets before it, so every put is consumed
+                # and the staged tensors always belong to the same batch
+                with tf.control_dependencies(get_values):
+                    values = staging_area.get()
+            if not isinstance(values, (list, tuple)):
+                values = [values]
+            get_values.extend(values)
+            for i, value in zip(indices, values):
+                value.set_shape(tensors[i].shape)
+                staged_tensors[i] = value
+
+    return tf.group(*put_ops), staged_tensors
 
 
 def reader_tfrecord(record_file, shortside_len, length_limitation, batch_size=1, num_threads=2, epoch=5, shuffle=True,
-                    is_training=False):
+                    is_training=False, compression_type=None):
     """
     read and sparse TFRecord
     :param record_file:
+    :param compression_type: '', 'GZIP' or 'ZLIB'. if None, get it from shard manifest
     :return:
     """
-    record_tensor = []
     # check record file format
-    if os.path.isfile(record_file):
-        record_tensor = [record_file]
-    else:
-        for filename in os.listdir(record_file):
-            record_tensor.append(os.path.join(record_file, filename))
+    record_tensor = get_record_list(record_file)
     # filename_list = tf.train.match_filenames_once(record_file)
     # create input queue
     filename_queue = tf.train.string_input_producer(string_tensor=record_tensor, num_epochs=epoch, shuffle=shuffle)
     # create reader to read TFRecord sample instant
-    reader = tf.TFRecordReader()
+    if compression_type is None:
+        compression_type = get_compression_type(record_file)
+    reader = tf.TFRecordReader(options=tf.io.TFRecordOptions(compression_type=compression_type))
     # read one sample instant
     _, serialized_sample = reader.read(filename_queue)
     # parse sample
@@ -242,19 +670,37 @@ def get_num_samples(record_dir):
     """
     # check record file format
     # record_list = glob.glob(os.path.join(self.record_dir, '*.record'))
-    file_pattern = os.path.join(record_dir, '*.record')
-    input_files = tf.io.gfile.glob(file_pattern)
+    manifest = load_manifest(record_dir)
+    if manifest is not None:
+        return manifest['num_samples']
+    input_files = get_record_list(record_dir)
+    # the sidecar index of shard is memory mapped, only its header is read
+    record_indices = [load_record_index(record_file) for record_file in input_files]
+    if all([record_index is not None for record_index in record_indices]):
+        return sum([len(record_index) for record_index in record_indices])
     num_samples = 0
     print("counting number of sample, please waiting...")
-    # convert to dynamic mode
-    tf.enable_eager_execution()
-    for _ in tf.data.TFRecordDataset(input_files):
-        num_samples += 1
-    # recover to static mode
-    tf.disable_eager_execution()
+    # iterate records outside of the graph, safe to call while building the graph
+    options = tf.io.TFRecordOptions(compression_type=get_compression_type(record_dir))
+    for record_file in input_files:
+        for _ in tf.compat.v1.io.tf_record_iterator(record_file, options=options):
+            num_samples += 1
     return num_samples
 
 
+def get_num_epochs(record_dir, max_iteration, batch_size=1):
+    """
+    get the number of epochs to repeat dataset, so the dataset covers max_iteration steps
+    :param record_dir:
+    :param max_iteration:
+    :param batch_size:
+    :return:
+    """
+    num_samples = get_num_samples(record_dir)
+    # bucket batching emits some partial batches, repeat one more epoch
+    return int(math.ceil(max_iteration * batch_size / max(num_samples, 1))) + 1
+
+
 if __name__ == "__main__":
 
     print('number samples: {0}'.format(get_num_samples(tfrecord_dir)))
@@ -262,10 +708,11 @@ if __name__ == "__main__":
     # image, filename, gtboxes_and_label, num_objects = reader_tfrecord(record_file=tfrecord_dir,
     #                                                                   shortside_len=IMG_SHORT_SIDE_LEN,
     #                                                                   is_training=True)
-    filename_batch, image_batch, gtboxes_and_label_batch, num_objects_batch = dataset_tfrecord(record_file=tfrecord_dir,
-                                                                       shortside_len=IMG_SHORT_SIDE_LEN,
-                                                                       length_limitation=IMG_MAX_LENGTH,
-                                                                       is_training=True)
+    filename_batch, image_batch, gtboxes_and_label_batch, num_objects_batch, img_size_batch = \
+        dataset_tfrecord(record_file=tfrecord_dir,
+                         shortside_len=IMG_SHORT_SIDE_LEN,
+                         length_limitation=IMG_MAX_LENGTH,
+                         is_training=True)
     gtboxes_and_label_tensor = tf.reshape(gtboxes_and_label_batch, [-1, 5])
 
     gtboxes_in_img = show_box_in_tensor.draw_boxes_with_categories(img_batch=image_batch,
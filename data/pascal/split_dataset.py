@@ -11,24 +11,45 @@
 #-------------------------------------------------------
 import os
 import math
-import shutil
 import numpy as np
 
 from utils.tools import makedir, view_bar
+from data.pascal.voc_annotation import load_voc_annotations, save_voc_annotations
+from data.split_utils import SPLIT_MODES, materialize_file, save_split_manifest, get_split_manifest_path
 
 original_dataset_dir = '/media/alex/AC6A2BDB6A2BA0D6/alex_dataset/Pascal_VOC_2012/VOCtrainval/VOCdevkit/VOC2012'
 dst_dir = '/media/alex/AC6A2BDB6A2BA0D6/alex_dataset/pascal_split'
 
 #++++++++++++++++++++++++++++++++++++++++split pascal++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-def split_pascal(origin_path, dst_path, split_rate=0.8):
+def split_pascal(origin_path, dst_path, split_rate=0.8, mode='copy'):
     """
     split pascal dataset
     :param origin_path:
+    :param dst_path:
+    :param split_rate:
+    :param mode: 'copy', 'hardlink' or 'symlink' the image and xml to split dir,
+                 'manifest' only write <dst_path>/train.split.json and val.split.json for conversion
     :return:
     """
+    assert mode in SPLIT_MODES, 'split mode must in {0}'.format(SPLIT_MODES)
     image_path = os.path.join(origin_path, 'JPEGImages')
     xml_path = os.path.join(origin_path, 'Annotations')
 
+    image_list = os.listdir(image_path)
+    image_name = [image.split('.')[0] for image in image_list]
+    image_name = np.random.permutation(image_name)
+    train_image_name = image_name[:int(math.ceil(len(image_name) * split_rate))]
+    val_image_name = image_name[int(math.ceil(len(image_name) * split_rate)):]
+
+    if mode == 'manifest':
+        for split_name, split_image_name in [('train', train_image_name), ('val', val_image_name)]:
+            save_split_manifest(get_split_manifest_path(dst_path, split_name),
+                                {'dataset': 'pascal',
+                                 'image_dir': os.path.abspath(image_path),
+                                 'annotation_dir': os.path.abspath(xml_path),
+                                 'samples': sorted(split_image_name.tolist())})
+        return
+
     image_train_path = os.path.join(dst_path, 'train', 'JPEGImages')
     xml_train_path = os.path.join(dst_path, 'train', 'Annotations')
     image_val_path = os.path.join(dst_path, 'val', 'JPEGImages')
@@ -38,24 +59,25 @@ def split_pascal(origin_path, dst_path, split_rate=0.8):
     makedir(image_val_path)
     makedir(xml_val_path)
 
-    image_list = os.listdir(image_path)
-    image_name = [image.split('.')[0] for image in image_list]
-    image_name = np.random.permutation(image_name)
-    train_image_name = image_name[:int(math.ceil(len(image_name) * split_rate))]
-    val_image_name = image_name[int(math.ceil(len(image_name) * split_rate)):]
-
     for n, image in enumerate(train_image_name):
-        shutil.copy(os.path.join(image_path, image+'.jpg'), os.path.join(image_train_path, image+'.jpg'))
-        shutil.copy(os.path.join(xml_path, image + '.xml'), os.path.join(xml_train_path, image + '.xml'))
+        materialize_file(os.path.join(image_path, image+'.jpg'), os.path.join(image_train_path, image+'.jpg'), mode)
+        materialize_file(os.path.join(xml_path, image + '.xml'), os.path.join(xml_train_path, image + '.xml'), mode)
         view_bar(message="split train dataset:", num=n, total=len(train_image_name))
     print('Total of {0} data split to {1}'.format(len(train_image_name), os.path.dirname(image_train_path)))
 
     for n, image in enumerate(val_image_name):
-        shutil.copy(os.path.join(image_path, image+'.jpg'), os.path.join(image_val_path, image+'.jpg'))
-        shutil.copy(os.path.join(xml_path, image + '.xml'), os.path.join(xml_val_path, image + '.xml'))
+        materialize_file(os.path.join(image_path, image+'.jpg'), os.path.join(image_val_path, image+'.jpg'), mode)
+        materialize_file(os.path.join(xml_path, image + '.xml'), os.path.join(xml_val_path, image + '.xml'), mode)
         view_bar(message="split val dataset:", num=n, total=len(val_image_name))
     print('Total of {0} data split to {1}'.format(len(val_image_name),  os.path.dirname(image_val_path)))
 
+    # write the annotation cache of split dataset, so conversion of split dataset need not parse xml
+    annotations = load_voc_annotations(xml_path)
+    for split_image_name, split_xml_path in [(train_image_name, xml_train_path), (val_image_name, xml_val_path)]:
+        split_indices = [annotations.get_index(image) for image in sorted(split_image_name)]
+        split_indices = [index for index in split_indices if index is not None]
+        save_voc_annotations(annotations.subset(split_indices), split_xml_path)
+
 
 if __name__ == "__main__":
 
@@ -63,5 +85,5 @@ if __name__ == "__main__":
     image_list = os.listdir(os.path.join(original_dataset_dir, 'JPEGImages'))
     image_name = [image.split('.')[0] for image in image_list]
     print(f'number of sample:{len(image_list)}')
-    split_pascal(original_dataset_dir, dst_dir, 0.8)
+    split_pascal(original_dataset_dir, dst_dir, 0.8, mode='copy')
 
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : voc_annotation.py
+# @ Description: shared pascal voc xml loader with parallel parsing and a compact numpy cache
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 PM 15:20
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import glob
+import multiprocessing
+import xml.etree.ElementTree as ET
+import numpy as np
+
+CACHE_VERSION = 2
+CACHE_SUFFIX = '.cache.npz'
+
+
+def _to_int(text):
+    # coordinate of some annotation tools is float, such as 273.5
+    return int(float(text))
+
+
+def parse_voc_xml(xml_path):
+    """
+    parse a pascal voc xml with iterparse
+    :param xml_path:
+    :return: {'height':, 'width':, 'boxes': [[xmin, ymin, xmax, ymax]], 'names': [class name], 'difficult': [0|1]}
+    """
+    height, width = 0, 0
+    boxes, names, difficult = [], [], []
+    obj = None
+    # tags from root to current element, used to skip the boxes of object parts
+    path = []
+    for event, elem in ET.iterparse(xml_path, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            if elem.tag == 'object' and len(path) == 2:
+                obj = {'name': None, 'difficult': 0, 'bbox': {}}
+            continue
+        parent = path[-2] if len(path) > 1 else None
+        if obj is not None and parent == 'object' and elem.tag == 'name':
+            obj['name'] = (elem.text or '').strip()
+        elif obj is not None and parent == 'object' and elem.tag == 'difficult':
+            obj['difficult'] = _to_int(elem.text or 0)
+        elif obj is not None and parent == 'bndbox' and path[-3] == 'object':
+            obj['bbox'][elem.tag] = _to_int(elem.text)
+        elif obj is not None and elem.tag == 'object' and len(path) == 2:
+            assert obj['name'], 'label is none, error'
+            boxes.append([obj['bbox'].get(key, 0) for key in ('xmin', 'ymin', 'xmax', 'ymax')])
+            names.append(obj['name'])
+            difficult.append(obj['difficult'])
+            obj = None
+            elem.clear()
+        elif parent == 'size' and elem.tag == 'width':
+            width = _to_int(elem.text)
+        elif parent == 'size' and elem.tag == 'height':
+            height = _to_int(elem.text)
+        path.pop()
+
+    return {'height': height, 'width': width, 'boxes': boxes, 'names': names, 'difficult': difficult}
+
+
+def _parse_voc_xml_task(xml_path):
+    try:
+        return parse_voc_xml(xml_path), None
+    except Exception as e:
+        return None, repr(e)
+
+
+class VocAnnotations(object):
+    """
+    annotations of a voc Annotations dir, the objects of image i are in [offsets[i], offsets[i+1])
+    """
+    def __init__(self, image_names, heights, widths, boxes, class_ids, difficult, offsets, class_names,
+                 sizes=None, mtimes=None, failed_names=None, failed_sizes=None, failed_mtimes=None):
+        """
+        :param image_names: str [num_images], xml name without suffix
+        :param heights: int32 [num_images]
+        :param widths: int32 [num_images]
+        :param boxes: int32 [num_objects, 4], (xmin, ymin, xmax, ymax)
+        :param class_ids: int32 [num_objects], index of class_names
+        :param difficult: uint8 [num_objects]
+        :param offsets: int64 [num_images+1]
+        :param class_names: str [num_classes]
+        :param sizes: int64 [num_images], size of xml when parsed
+        :param mtimes: int64 [num_images], modify time(ns) of xml when parsed
+        :param failed_names: str [num_failed], xml failed to parse, skipped while their size and mtime are unchanged
+        :param failed_sizes: int64 [num_failed]
+        :param failed_mtimes: int64 [num_failed]
+        """
+        self.image_names = image_names
+        self.heights = heights
+        self.widths = widths
+        self.boxes = boxes
+        self.class_ids = class_ids
+        self.difficult = difficult
+        self.offsets = offsets
+        self.class_names = class_names
+        self.sizes = np.zeros(len(image_names), dtype=np.int64) if sizes is None else sizes
+        self.mtimes = np.zeros(len(image_names), dtype=np.int64) if mtimes is None else mtimes
+        self.failed_names = np.zeros((0,), dtype=np.str_) if failed_names is None else failed_names
+        self.failed_sizes = np.zeros(len(self.failed_names), dtype=np.int64) if failed_sizes is None else failed_sizes
+        self.failed_mtimes = np.zeros(len(self.failed_names), dtype=np.int64) if failed_mtimes is None \
+            else failed_mtimes
+        self._name_index = None
+
+    @property
+    def num_images(self):
+        return len(self.image_names)
+
+    def get_index(self, image_name):
+        """
+        :param image_name: xml or image name with or without suffix
+        :return: image index, None if not exist
+        """
+        if self._name_index is None:
+            self._name_index = dict([(name, index) for index, name in enumerate(self.image_names.tolist())])
+        return self._name_index.get(os.path.splitext(os.path.basename(image_name))[0])
+
+    def get_objects(self, index):
+        """
+        :param index:
+        :return: boxes int32 [n, 4], class names [n], difficult uint8 [n]
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.boxes[start:end], self.class_names[self.class_ids[start:end]], self.difficult[start:end]
+
+    def get_gtbox_label(self, index, name_label_map):
+        """
+        :param index:
+        :param name_label_map: class name to label
+        :return: int32 [n, 5], (xmin, ymin, xmax, ymax, label)
+        """
+        boxes, names, _ = self.get_objects(index)
+        labels = np.array([name_label_map[name] for name in names.tolist()], dtype=np.int32)
+        return np.concatenate([boxes, labels.reshape(-1, 1)], axis=1).astype(np.int32)
+
+    def subset(self, indices):
+        """
+        get annotations of part of images
+        :param indices: image indices
+        :return: VocAnnotations
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        counts = self.offsets[indices + 1] - self.offsets[indices]
+        object_indices = np.concatenate([np.arange(self.offsets[index], self.offsets[index + 1])
+                                         for index in indices.tolist()] + [np.zeros((0,), dtype=np.int64)])
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return VocAnnotations(image_names=self.image_names[indices], heights=self.heights[indices],
+                              widths=self.widths[indices], boxes=self.boxes[object_indices],
+                              class_ids=self.class_ids[object_indices], difficult=self.difficult[object_indices],
+                              offsets=offsets, class_names=self.class_names, sizes=self.sizes[indices],
+                              mtimes=self.mtimes[indices])
+
+    def save(self, cache_path):
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, version=CACHE_VERSION, image_names=self.image_names, heights=self.heights,
+                 widths=self.widths, boxes=self.boxes, class_ids=self.class_ids, difficult=self.difficult,
+                 offsets=self.offsets, class_names=self.class_names, sizes=self.sizes, mtimes=self.mtimes,
+                 failed_names=self.failed_names, failed_sizes=self.failed_sizes, failed_mtimes=self.failed_mtimes)
+        os.replace(tmp_path, cache_path)
+
+    @classmethod
+    def load(cls, cache_path):
+        """
+        :param cache_path:
+        :return: VocAnnotations, None if the cache version changed
+        """
+        with np.load(cache_path) as data:
+            if int(data['version']) != CACHE_VERSION:
+                return None
+            return cls(image_names=data['image_names'], heights=data['heights'], widths=data['widths'],
+                       boxes=data['boxes'], class_ids=data['class_ids'], difficult=data['difficult'],
+                       offsets=data['offsets'], class_names=data['class_names'], sizes=data['sizes'],
+                       mtimes=data['mtimes'], failed_names=data['failed_names'], failed_sizes=data['failed_sizes'],
+                       failed_mtimes=data['failed_mtimes'])
+
+
+def get_cache_path(xml_dir):
+    return os.path.normpath(xml_dir) + CACHE_SUFFIX
+
+
+def get_xml_stats(xml_dir, image_names):
+    stats = [os.stat(os.path.join(xml_dir, name + '.xml')) for name in image_names]
+    return np.array([stat.st_size for stat in stats], dtype=np.int64), \
+           np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64)
+
+
+def save_voc_annotations(annotations, xml_dir, cache_path=None):
+    """
+    save annotations as the cache of xml dir, such as the annotations of split dataset
+    :param annotations:
+    :param xml_dir:
+    :param cache_path:
+    :return:
+    """
+    cache_path = cache_path or get_cache_path(xml_dir)
+    annotations.sizes, annotations.mtimes = get_xml_stats(xml_dir, annotations.image_names.tolist())
+    annotations.failed_sizes, annotations.failed_mtimes = get_xml_stats(xml_dir, annotations.failed_names.tolist())
+    try:
+        annotations.save(cache_path)
+    except OSError as e:
+        print('failed to save annotation cache {0}: {1}'.format(cache_path, e))
+
+
+def load_voc_annotations(xml_dir, cache_path=None, num_workers=4):
+    """
+    load annotations of all xml in dir, only new or modified xml are parsed and the cache is updated
+    :param xml_dir: Annotations dir of voc
+    :param cache_path: default is <xml_dir>.cache.npz
+    :param num_workers: number of parse process
+    :return: VocAnnotations
+    """
+    cache_path = cache_path or get_cache_path(xml_dir)
+    image_names = sorted([os.path.splitext(os.path.basename(xml_file))[0]
+                          for xml_file in glob.glob(os.path.join(xml_dir, '*.xml'))])
+    sizes, mtimes = get_xml_stats(xml_dir, image_names)
+
+    cached = None
+    if os.path.isfile(cache_path):
+        try:
+            cached = VocAnnotations.load(cache_path)
+        except (OSError, ValueError, KeyError) as e:
+            print('failed to load annotation cache {0}: {1}'.format(cache_path, e))
+    # (size, mtime) of every xml in dir, and of the failed xml recorded in cache
+    stats = dict(zip(image_names, zip(sizes.tolist(), mtimes.tolist())))
+    failed_stats = {} if cached is None else \
+        dict(zip(cached.failed_names.tolist(), zip(cached.failed_sizes.tolist(), cached.failed_mtimes.tolist())))
+    if cached is not None and sorted(cached.image_names.tolist() + list(failed_stats)) == image_names and \
+            all([stats[name] == stat for name, stat in failed_stats.items()]) and \
+            np.array_equal(cached.sizes, [stats[name][0] for name in cached.image_names.tolist()]) and \
+            np.array_equal(cached.mtimes, [stats[name][1] for name in cached.image_names.tolist()]):
+        return cached
+
+    # reuse the cached records of unchanged xml, and skip the unchanged xml failed before
+    records = {}
+    parse_names = []
+    failed_names = []
+    for index, name in enumerate(image_names):
+        cached_index = None if cached is None else cached.get_index(name)
+        if cached_index is not None and cached.sizes[cached_index] == sizes[index] and \
+                cached.mtimes[cached_index] == mtimes[index]:
+            boxes, names, difficult = cached.get_objects(cached_index)
+            records[name] = {'height': int(cached.heights[cached_index]), 'width': int(cached.widths[cached_index]),
+                             'boxes': boxes, 'names': names.tolist(), 'difficult': difficult}
+        elif failed_stats.get(name) == stats[name]:
+            failed_names.append(name)
+        else:
+            parse_names.append(name)
+    if len(failed_names) > 0:
+        print('skip {0} unchanged xml failed to parse before'.format(len(failed_names)))
+
+    print('parsing {0} of {1} xml in {2}...'.format(len(parse_names), len(image_names), xml_dir))
+    xml_paths = [os.path.join(xml_dir, name + '.xml') for name in parse_names]
+    if num_workers > 1 and len(xml_paths) > 1:
+        with multiprocessing.Pool(processes=num_workers) as pool:
+            results = pool.map(_parse_voc_xml_task, xml_paths, chunksize=64)
+    else:
+        results = list(map(_parse_voc_xml_task, xml_paths))
+    for name, (record, error) in zip(parse_names, results):
+        if record is None:
+            print('failed to parse {0}: {1}'.format(name, error))
+            failed_names.append(name)
+            continue
+        records[name] = record
+
+    image_names = [name for name in image_names if name in records]
+    class_names = sorted(set([class_name for record in records.values() for class_name in record['names']]))
+    class_index = dict([(class_name, index) for index, class_name in enumerate(class_names)])
+    counts = [len(records[name]['names']) for name in image_names]
+    offsets = np.zeros(len(image_names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    annotations = VocAnnotations(
+        image_names=np.array(image_names, dtype=np.str_),
+        heights=np.array([records[name]['height'] for name in image_names], dtype=np.int32),
+        widths=np.array([records[name]['width'] for name in image_names], dtype=np.int32),
+        boxes=np.array([box for name in image_names for box in np.asarray(records[name]['boxes']).tolist()],
+                       dtype=np.int32).reshape(-1, 4),
+        class_ids=np.array([class_index[class_name] for name in image_names for class_name in records[name]['names']],
+                           dtype=np.int32),
+        difficult=np.array([flag for name in image_names for flag in np.asarray(records[name]['difficult']).tolist()],
+                           dtype=np.uint8),
+        offsets=offsets,
+        class_names=np.array(class_names, dtype=np.str_),
+        failed_names=np.array(sorted(failed_names), dtype=np.str_))
+    save_voc_annotations(annotations, xml_dir, cache_path=cache_path)
+    return annotations
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : record_index.py
+# @ Description: sidecar offset index of tfrecord shards for counting and random access
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 PM 16:30
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import struct
+import numpy as np
+import tensorflow as tf
+
+INDEX_SUFFIX = '.index'
+# a record is framed as uint64 length, uint32 masked crc of length, data, uint32 masked crc of data
+RECORD_HEADER_BYTES = 12
+RECORD_FOOTER_BYTES = 4
+
+
+def get_index_path(record_file):
+    return record_file + INDEX_SUFFIX
+
+
+def get_record_meta(record):
+    """
+    get the index fields of a serialized example
+    :param record:
+    :return: (filename, height, width, num_objects)
+    """
+    feature = tf.train.Example.FromString(record).features.feature
+
+    def _int64_value(key):
+        return int(feature[key].int64_list.value[0]) if key in feature else 0
+
+    filename = feature['filename'].bytes_list.value[0].decode() if 'filename' in feature else ''
+    return filename, _int64_value('height'), _int64_value('width'), _int64_value('num_objects')
+
+
+def build_record_index(records_meta):
+    """
+    build index of one shard
+    :param records_meta: list of (record length, filename, height, width, num_objects) in the order of shard
+    :return: structured array with fields offset, length, height, width, num_objects, filename
+             offset is the byte offset of the record frame in the uncompressed shard
+    """
+    filename_len = max([len(meta[1]) for meta in records_meta] + [1])
+    index = np.zeros(len(records_meta), dtype=[('offset', np.int64), ('length', np.int64), ('height', np.int32),
+                                               ('width', np.int32), ('num_objects', np.int32),
+                                               ('filename', 'U{0}'.format(filename_len))])
+    offset = 0
+    for i, (length, filename, height, width, num_objects) in enumerate(records_meta):
+        index[i] = (offset, length, height, width, num_objects, filename)
+        offset += RECORD_HEADER_BYTES + length + RECORD_FOOTER_BYTES
+    return index
+
+
+def save_record_index(record_file, index):
+    index_path = get_index_path(record_file)
+    with open(index_path + '.tmp', 'wb') as fw:
+        np.save(fw, index, allow_pickle=False)
+    os.replace(index_path + '.tmp', index_path)
+
+
+def load_record_index(record_file, mmap_mode='r'):
+    """
+    :param record_file:
+    :param mmap_mode: memory map the index, so only the header is read when counting
+    :return: structured array, None if the shard has no index
+    """
+    index_path = get_index_path(record_file)
+    if not os.path.isfile(index_path):
+        return None
+    return np.load(index_path, mmap_mode=mmap_mode, allow_pickle=False)
+
+
+def read_record(record_file, position, index=None, compression_type=''):
+    """
+    read the serialized example at position of shard.
+    uncompressed shard is seeked directly to the byte offset, compressed shard is iterated to position.
+    :param record_file:
+    :param position: index of record in shard
+    :param index: index of shard, loaded if None
+    :param compression_type:
+    :return: serialized example
+    """
+    if compression_type:
+        options = tf.io.TFRecordOptions(compression_type=compression_type)
+        for i, record in enumerate(tf.compat.v1.io.tf_record_iterator(record_file, options=options)):
+            if i == position:
+                return record
+        raise IndexError('record {0} out of range of {1}'.format(position, record_file))
+
+    if index is None:
+        index = load_record_index(record_file)
+    if index is None:
+        raise IOError('index of {0} not found'.format(record_file))
+    offset, length = int(index[position]['offset']), int(index[position]['length'])
+    with open(record_file, 'rb') as fr:
+        fr.seek(offset)
+        header = fr.read(RECORD_HEADER_BYTES)
+        if len(header) != RECORD_HEADER_BYTES or struct.unpack('<Q', header[:8])[0] != length:
+            raise IOError('index of {0} does not match the shard at record {1}'.format(record_file, position))
+        return fr.read(length)
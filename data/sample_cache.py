@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : sample_cache.py
+# @ Description: bounded cache of decoded and resized training samples, in memory LRU or on local disk
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 PM 19:40
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+
+from libs.configs import cfgs
+from data.tfrecord_utils import get_record_list
+
+CACHE_MODES = ('memory', 'disk')
+
+
+class SampleCache(object):
+    """
+    cache of resized uint8 image and gtboxes_and_label keyed by filename and target resolution.
+    memory mode evicts the least recently used samples when the byte budget is exceeded,
+    disk mode saves every sample as a npz file in cache dir and stops adding samples when the budget is used up,
+    the disk cache is reused by later runs on the same records
+    """
+    def __init__(self, mode='memory', max_bytes=4 << 30, cache_dir='', fingerprint=''):
+        """
+        :param mode: 'memory' or 'disk'
+        :param max_bytes: byte budget of cached samples
+        :param cache_dir: dir of disk cache, better on local SSD
+        :param fingerprint: fingerprint of the records, see get_dataset_fingerprint. the disk cache is kept in a
+                            sub dir of cache_dir named by it, so regenerated records never hit stale samples
+        """
+        assert mode in CACHE_MODES, 'cache mode must in {0}'.format(CACHE_MODES)
+        assert mode == 'memory' or cache_dir, 'disk cache need cache dir'
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.cache_dir = os.path.join(cache_dir, fingerprint) if fingerprint else cache_dir
+        self.lock = threading.Lock()
+        self.samples = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if self.mode == 'disk':
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            for entry in os.scandir(self.cache_dir):
+                if not entry.name.endswith('.npz'):
+                    continue
+                if entry.name.endswith('.tmp.npz'):
+                    # left by a writer that was killed before rename
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                else:
+                    self.num_bytes += entry.stat().st_size
+
+    @staticmethod
+    def get_key(filename, shortside_len, length_limitation):
+        if isinstance(filename, bytes):
+            filename = filename.decode()
+        return '{0}_{1}_{2}'.format(filename, int(shortside_len), int(length_limitation))
+
+    def get_cache_path(self, key):
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode()).hexdigest() + '.npz')
+
+    def get(self, key):
+        """
+        :param key:
+        :return: (image, gtboxes_and_label), None if miss
+        """
+        if self.mode == 'memory':
+            with self.lock:
+                sample = self.samples.get(key)
+                if sample is not None:
+                    self.samples.move_to_end(key)
+        else:
+            sample = None
+            cache_path = self.get_cache_path(key)
+            if os.path.isfile(cache_path):
+                try:
+                    with np.load(cache_path) as data:
+                        sample = (data['image'], data['gtboxes_and_label'])
+                except (OSError, ValueError, KeyError):
+                    sample = None
+        with self.lock:
+            if sample is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return sample
+
+    def put(self, key, image, gtboxes_and_label):
+        sample_bytes = image.nbytes + gtboxes_and_label.nbytes
+        if sample_bytes > self.max_bytes:
+            return
+        if self.mode == 'memory':
+            with self.lock:
+                if key in self.samples:
+                    return
+                while self.samples and self.num_bytes + sample_bytes > self.max_bytes:
+                    _, (old_image, old_gtboxes) = self.samples.popitem(last=False)
+                    self.num_bytes -= old_image.nbytes + old_gtboxes.nbytes
+                    self.evictions += 1
+                self.samples[key] = (image, gtboxes_and_label)
+                self.num_bytes += sample_bytes
+            return
+
+        cache_path = self.get_cache_path(key)
+        with self.lock:
+            if self.num_bytes + sample_bytes > self.max_bytes or os.path.isfile(cache_path):
+                return
+            self.num_bytes += sample_bytes
+        # write to tmp file first, parallel readers never see a partial file
+        tmp_path = cache_path + '.{0}.tmp.npz'.format(threading.get_ident())
+        try:
+            np.savez(tmp_path, image=image, gtboxes_and_label=gtboxes_and_label)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print('failed to write sample cache {0}: {1}'.format(cache_path, e))
+
+    def get_stats(self):
+        """
+        :return: {'hits':, 'misses':, 'hit_rate':, 'evictions':, 'num_bytes':, 'num_samples':}
+        """
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.,
+                    'evictions': self.evictions,
+                    'num_bytes': self.num_bytes,
+                    'num_samples': len(self.samples) if self.mode == 'memory' else None}
+
+    def _lookup(self, filename, shortside_len, length_limitation):
+        sample = self.get(self.get_key(filename, shortside_len, length_limitation))
+        if sample is None:
+            return False, np.zeros((0, 0, 3), dtype=np.uint8), np.zeros((0, 5), dtype=np.int32)
+        return True, sample[0], sample[1]
+
+    def _insert(self, filename, shortside_len, length_limitation, image, gtboxes_and_label):
+        self.put(self.get_key(filename, shortside_len, length_limitation), image, gtboxes_and_label)
+        return image, gtboxes_and_label
+
+    def lookup_op(self, filename, shortside_len, length_limitation):
+        """
+        :param filename: string tensor
+        :param shortside_len:
+        :param length_limitation:
+        :return: found, uint8 image [h, w, 3], int32 gtboxes_and_label [-1, 5]
+        """
+        found, image, gtboxes_and_label = tf.py_func(self._lookup, [filename, shortside_len, length_limitation],
+                                                     [tf.bool, tf.uint8, tf.int32], stateful=True)
+        found.set_shape([])
+        image.set_shape([None, None, 3])
+        gtboxes_and_label.set_shape([None, 5])
+        return found, image, gtboxes_and_label
+
+    def insert_op(self, filename, shortside_len, length_limitation, image, gtboxes_and_label):
+        """
+        insert sample to cache and pass through the sample
+        :return: image, gtboxes_and_label
+        """
+        image, gtboxes_and_label = tf.py_func(self._insert, [filename, shortside_len, length_limitation, image,
+                                                             gtboxes_and_label],
+                                              [tf.uint8, tf.int32], stateful=True)
+        image.set_shape([None, None, 3])
+        gtboxes_and_label.set_shape([None, 5])
+        return image, gtboxes_and_label
+
+
+def get_dataset_fingerprint(record_file):
+    """
+    fingerprint of the records, changes when any shard is rewritten, added or removed
+    :param record_file: a single record file or a dir of shards
+    :return: hex string
+    """
+    md5 = hashlib.md5()
+    for record_path in get_record_list(record_file):
+        stat = os.stat(record_path)
+        md5.update('{0}|{1}|{2}\n'.format(os.path.abspath(record_path), stat.st_size, stat.st_mtime_ns).encode())
+    return md5.hexdigest()
+
+
+def get_sample_cache(mode=None, max_bytes=None, cache_dir=None, record_file=None):
+    """
+    create sample cache from cfgs
+    :param mode: default cfgs.SAMPLE_CACHE_MODE, '' means no cache
+    :param max_bytes: default cfgs.SAMPLE_CACHE_BYTES
+    :param cache_dir: default cfgs.SAMPLE_CACHE_DIR
+    :param record_file: records the samples are read from, default cfgs.TFRECORD_DIR
+    :return: SampleCache, None if cache disabled
+    """
+    mode = cfgs.SAMPLE_CACHE_MODE if mode is None else mode
+    if not mode:
+        return None
+    return SampleCache(mode=mode,
+                       max_bytes=cfgs.SAMPLE_CACHE_BYTES if max_bytes is None else max_bytes,
+                       cache_dir=cfgs.SAMPLE_CACHE_DIR if cache_dir is None else cache_dir,
+                       fingerprint=get_dataset_fingerprint(cfgs.TFRECORD_DIR if record_file is None else record_file))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : split_utils.py
+# @ Description: split manifest and copy-free materialization of dataset split
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 PM 17:10
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import json
+import shutil
+
+# copy: copy files to split dir | manifest: only write split manifest, converters read the original files
+# hardlink/symlink: link files to split dir
+SPLIT_MODES = ('copy', 'manifest', 'hardlink', 'symlink')
+SPLIT_MANIFEST_SUFFIX = '.split.json'
+
+
+def materialize_file(src_path, dst_path, mode='copy'):
+    """
+    create dst file from src file
+    :param src_path:
+    :param dst_path:
+    :param mode: 'copy', 'hardlink' or 'symlink'
+    :return:
+    """
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+    if mode == 'hardlink':
+        try:
+            os.link(src_path, dst_path)
+            return
+        except OSError:
+            # cross device link is not allowed, fall back to copy
+            pass
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(src_path), dst_path)
+        return
+    shutil.copy(src_path, dst_path)
+
+
+def get_split_manifest_path(dst_dir, split_name):
+    return os.path.join(dst_dir, split_name + SPLIT_MANIFEST_SUFFIX)
+
+
+def save_split_manifest(manifest_path, split_manifest):
+    """
+    :param manifest_path:
+    :param split_manifest: {'dataset': 'pascal' | 'coco', 'samples': [...], ...}
+    :return:
+    """
+    dst_dir = os.path.dirname(manifest_path)
+    if dst_dir and not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    with open(manifest_path + '.tmp', 'w') as fw:
+        json.dump(split_manifest, fw, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    print('Successful write the number of {0} samples to {1}'.format(len(split_manifest['samples']), manifest_path))
+
+
+def load_split_manifest(manifest_path, dataset=None):
+    """
+    :param manifest_path:
+    :param dataset: check the dataset of manifest if not None
+    :return:
+    """
+    with open(manifest_path, 'r') as fr:
+        split_manifest = json.load(fr)
+    if dataset is not None and split_manifest.get('dataset') != dataset:
+        raise ValueError('{0} is a split manifest of {1}, not {2}'.format(manifest_path, split_manifest.get('dataset'),
+                                                                         dataset))
+    return split_manifest
@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : tfrecord_utils.py
+# @ Description: shared shard writing and manifest helpers for pascal and coco conversion
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 AM 09:30
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import glob
+import json
+import math
+import hashlib
+import heapq
+import functools
+import multiprocessing
+import numpy as np
+import cv2 as cv
+import tensorflow as tf
+
+from utils.tools import makedir, view_bar
+from data.record_index import get_record_meta, build_record_index, save_record_index, get_index_path
+
+MANIFEST_NAME = 'manifest.json'
+RECORD_SUFFIX = '.record'
+# raw: decoded RGB pixels, encoded: the original compressed JPEG/PNG bytes
+RECORD_FORMATS = ('raw', 'encoded')
+# '' means uncompressed record
+COMPRESSION_TYPES = ('', 'GZIP', 'ZLIB')
+
+
+def get_record_list(record_file):
+    """
+    get the shard list of a record file or record dir
+    :param record_file: a single record file or a dir of shards
+    :return: list of shard path
+    """
+    if os.path.isfile(record_file):
+        return [record_file]
+    manifest = load_manifest(record_file)
+    if manifest is not None:
+        return [os.path.join(record_file, shard['filename']) for shard in manifest['shards']]
+    return sorted(glob.glob(os.path.join(record_file, '*' + RECORD_SUFFIX)))
+
+
+def load_manifest(record_dir):
+    """
+    load shard manifest of record dir
+    :param record_dir:
+    :return: manifest dict, None if the dir has no manifest
+    """
+    manifest_path = os.path.join(record_dir, MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return None
+    with open(manifest_path, 'r') as fr:
+        return json.load(fr)
+
+
+def get_compression_type(record_file):
+    """
+    get compression type of shards recorded in manifest
+    :param record_file: a single record file or a dir of shards
+    :return: '', 'GZIP' or 'ZLIB'
+    """
+    record_dir = os.path.dirname(record_file) if os.path.isfile(record_file) else record_file
+    manifest = load_manifest(record_dir)
+    if manifest is None:
+        return ''
+    return manifest.get('compression', '')
+
+
+def save_manifest(record_dir, manifest):
+    """
+    write manifest, the old manifest is only replaced after the new one is complete
+    :param record_dir:
+    :param manifest:
+    :return:
+    """
+    manifest_path = os.path.join(record_dir, MANIFEST_NAME)
+    with open(manifest_path + '.tmp', 'w') as fw:
+        json.dump(manifest, fw, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest_path
+
+
+def get_image_format(encoded_image):
+    """
+    get format of encoded image by its signature
+    :param encoded_image: bytes of image file
+    :return: 'jpeg' or 'png'
+    """
+    if encoded_image[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    elif encoded_image[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    else:
+        raise ValueError('only jpeg and png image can be stored encoded')
+
+
+def read_encoded_image(image_path):
+    """
+    read the compressed bytes of image file
+    :param image_path:
+    :return: (encoded image, image format)
+    """
+    with open(image_path, 'rb') as fr:
+        encoded_image = fr.read()
+    return encoded_image, get_image_format(encoded_image)
+
+
+def get_resize_shape(img_height, img_width, shortside_len, length_limitation):
+    """
+    get image size after short side resize, the same as short_side_resize of input pipeline
+    :param img_height:
+    :param img_width:
+    :param shortside_len:
+    :param length_limitation:
+    :return: (new_height, new_width)
+    """
+    if img_height < img_width:
+        return shortside_len, min(shortside_len * img_width // img_height, length_limitation)
+    else:
+        return min(shortside_len * img_height // img_width, length_limitation), shortside_len
+
+
+def resize_image_and_boxes(image, gtbox_label, shortside_len, length_limitation):
+    """
+    short side resize image and rescale gtboxes in float precision
+    :param image: [h, w, c]
+    :param gtbox_label: [-1, 5] [xmin, ymin, xmax, ymax, label]
+    :param shortside_len:
+    :param length_limitation:
+    :return:
+    """
+    img_height, img_width = image.shape[0], image.shape[1]
+    new_height, new_width = get_resize_shape(img_height, img_width, shortside_len, length_limitation)
+    image = cv.resize(image, (new_width, new_height), interpolation=cv.INTER_LINEAR)
+
+    gtbox_label = gtbox_label.reshape(-1, 5)
+    scale = np.array([new_width / img_width, new_height / img_height] * 2, dtype=np.float64)
+    gtboxes = np.round(gtbox_label[:, :4].astype(np.float64) * scale)
+    gtbox_label = np.hstack([gtboxes, gtbox_label[:, 4:]]).astype(np.int32)
+
+    return image, gtbox_label
+
+
+def load_record_image(image_path, gtbox_label, record_format='raw', shortside_len=0, length_limitation=0,
+                      img_height=None, img_width=None):
+    """
+    load image content to store in record
+    :param image_path:
+    :param gtbox_label: [-1, 5]
+    :param record_format: 'raw' or 'encoded'
+    :param shortside_len: if not 0, image is resized to the short side length when conversion
+    :param length_limitation: max length of resized image
+    :param img_height: image height of annotation, avoid decoding encoded image
+    :param img_width: image width of annotation
+    :return: image, image_format, img_height, img_width, gtbox_label
+    """
+    if record_format == 'encoded' and not shortside_len:
+        # keep the compressed bytes, the image is decoded in the input pipeline
+        image, image_format = read_encoded_image(image_path)
+        if img_height is None or img_width is None:
+            img_height, img_width = cv.imdecode(np.frombuffer(image, dtype=np.uint8), cv.IMREAD_COLOR).shape[:2]
+        return image, image_format, img_height, img_width, gtbox_label
+
+    # note image channel format of opencv if rgb
+    bgr_image = cv.imread(image_path)
+    if bgr_image is None:
+        raise IOError('failed to read image {0}'.format(image_path))
+    if shortside_len:
+        bgr_image, gtbox_label = resize_image_and_boxes(bgr_image, gtbox_label, shortside_len=shortside_len,
+                                                        length_limitation=length_limitation)
+    img_height, img_width = bgr_image.shape[0], bgr_image.shape[1]
+
+    if record_format == 'encoded':
+        # re-encode resized image with the format of source image
+        if image_path.lower().endswith('.png'):
+            _, image = cv.imencode('.png', bgr_image)
+            image_format = 'png'
+        else:
+            _, image = cv.imencode('.jpg', bgr_image, [cv.IMWRITE_JPEG_QUALITY, 95])
+            image_format = 'jpeg'
+        image = image.tobytes()
+    else:
+        # BGR TO RGB
+        image = cv.cvtColor(bgr_image, cv.COLOR_BGR2RGB)
+        image_format = 'raw'
+
+    return image, image_format, img_height, img_width, gtbox_label
+
+
+def split_shards(samples, record_capacity, num_workers=1):
+    """
+    split samples into contiguous shards
+    :param samples:
+    :param record_capacity: max number of samples per shard
+    :param num_workers: ensure there are at least as many shards as workers
+    :return: list of sample list
+    """
+    if len(samples) == 0:
+        return []
+    num_record = max(int(math.ceil(len(samples) / record_capacity)), min(num_workers, len(samples)))
+    shard_size = int(math.ceil(len(samples) / num_record))
+    return [samples[index * shard_size: (index + 1) * shard_size] for index in range(num_record)
+            if len(samples[index * shard_size: (index + 1) * shard_size]) > 0]
+
+
+def estimate_sample_bytes(sample, record_format='raw', shortside_len=0, length_limitation=0):
+    """
+    estimate the serialized size of a sample without encoding it
+    :param sample: sample dict with 'image' and optional 'height', 'width'
+    :param record_format: 'raw' or 'encoded'
+    :param shortside_len: short side length the image is resized to when conversion, 0 keep size
+    :param length_limitation:
+    :return: bytes
+    """
+    img_height, img_width = sample.get('height'), sample.get('width')
+    try:
+        file_bytes = os.path.getsize(sample['image'])
+    except OSError:
+        file_bytes = 0
+    if not img_height or not img_width:
+        # no image size in annotation, the file size is the only estimation
+        return file_bytes
+    new_height, new_width = img_height, img_width
+    if shortside_len:
+        new_height, new_width = get_resize_shape(img_height, img_width, shortside_len, length_limitation)
+    if record_format == 'raw':
+        return new_height * new_width * 3
+    # the size of re-encoded image is assumed to be proportional to its area
+    return int(file_bytes * new_height * new_width / (img_height * img_width))
+
+
+def balance_shards(samples, sample_bytes, shard_bytes, num_workers=1):
+    """
+    split samples into shards of about shard_bytes with the longest processing time rule, every sample is added to
+    the lightest shard in descending order of size, then samples of every shard keep their original order
+    :param samples:
+    :param sample_bytes: estimated bytes of every sample
+    :param shard_bytes: target bytes per shard
+    :param num_workers: ensure there are at least as many shards as workers
+    :return: list of sample list
+    """
+    if len(samples) == 0:
+        return []
+    num_record = max(int(math.ceil(sum(sample_bytes) / shard_bytes)), min(num_workers, len(samples)))
+    num_record = min(num_record, len(samples))
+    shard_heap = [(0, index) for index in range(num_record)]
+    shard_indices = [[] for _ in range(num_record)]
+    for sample_index in sorted(range(len(samples)), key=lambda index: -sample_bytes[index]):
+        total_bytes, shard_index = heapq.heappop(shard_heap)
+        shard_indices[shard_index].append(sample_index)
+        heapq.heappush(shard_heap, (total_bytes + sample_bytes[sample_index], shard_index))
+    return [[samples[index] for index in sorted(indices)] for indices in shard_indices if len(indices) > 0]
+
+
+def get_file_hash(file_path):
+    """
+    get sha1 of file content
+    :param file_path:
+    :return:
+    """
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as fr:
+        for chunk in iter(lambda: fr.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_sample_hash(hash_task):
+    """
+    get content hash of image and annotation of a sample, the image hash of last conversion is reused when
+    size and modify time of image are not changed
+    :param hash_task: (sample, sample entry of last manifest or None)
+    :return: {'image_hash':, 'annotation_hash':, 'size':, 'mtime':}, None if the image can not be read
+    """
+    sample, last_entry = hash_task
+    try:
+        stat = os.stat(sample['image'])
+        if last_entry is not None and last_entry['size'] == stat.st_size and last_entry['mtime'] == stat.st_mtime_ns:
+            image_hash = last_entry['image_hash']
+        else:
+            image_hash = get_file_hash(sample['image'])
+        if 'annotation' in sample:
+            # annotation file, such as pascal xml
+            annotation_hash = get_file_hash(sample['annotation'])
+        elif isinstance(sample.get('annotations'), np.ndarray):
+            # annotation array, such as coco gtbox and label of image
+            annotation_hash = hashlib.sha1(np.ascontiguousarray(sample['annotations']).tobytes()).hexdigest()
+        else:
+            # annotation dict
+            annotation_hash = hashlib.sha1(json.dumps(sample.get('annotations'), sort_keys=True).encode()).hexdigest()
+    except OSError:
+        return None
+
+    return {'image_hash': image_hash,
+            'annotation_hash': annotation_hash,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns}
+
+
+def is_same_sample(sample_hash, last_entry):
+    return sample_hash is not None and last_entry is not None and \
+           sample_hash['image_hash'] == last_entry['image_hash'] and \
+           sample_hash['annotation_hash'] == last_entry['annotation_hash']
+
+
+def plan_shards(samples, sample_hashes, last_manifest, save_path, record_capacity, num_workers=1,
+                sample_bytes=None, shard_bytes=0):
+    """
+    plan which shards should be written. with manifest of last conversion, only shards contain changed or removed
+    samples are rewritten and new samples are written to new shards, the unchanged samples of rewritten shards are
+    copied from the old shard without encoding.
+    :param samples:
+    :param sample_hashes:
+    :param last_manifest: manifest of last conversion, None to convert all samples
+    :param save_path:
+    :param record_capacity:
+    :param num_workers:
+    :param sample_bytes: estimated bytes of every sample, required when shard_bytes is not 0
+    :param shard_bytes: if not 0, new shards are balanced to about shard_bytes instead of record_capacity
+    :return: (kept shards, shard tasks). every shard task is (old shard filename or None, [(sample, sample hash,
+             offset in old shard or None)])
+    """
+    def _split(entries, entries_bytes):
+        if shard_bytes:
+            return balance_shards(entries, entries_bytes, shard_bytes=shard_bytes, num_workers=num_workers)
+        return split_shards(entries, record_capacity=record_capacity, num_workers=num_workers)
+
+    if sample_bytes is None:
+        sample_bytes = [0] * len(samples)
+    if last_manifest is None:
+        shard_samples = _split([(sample, sample_hash, None) for sample, sample_hash in zip(samples, sample_hashes)],
+                               sample_bytes)
+        return [], [(None, sub_samples) for sub_samples in shard_samples]
+
+    last_samples = last_manifest['samples']
+    current_keys = set([sample['image'] for sample in samples])
+    # shard lost in a crashed conversion or contain removed samples should be rewritten
+    affected_shards = set([shard['filename'] for shard in last_manifest['shards']
+                           if not os.path.isfile(os.path.join(save_path, shard['filename']))])
+    affected_shards.update([entry['shard'] for key, entry in last_samples.items() if key not in current_keys])
+
+    shard_entries = {}
+    new_samples = []
+    new_samples_bytes = []
+    for sample, sample_hash, num_bytes in zip(samples, sample_hashes, sample_bytes):
+        last_entry = last_samples.get(sample['image'])
+        if last_entry is None:
+            new_samples.append((sample, sample_hash, None))
+            new_samples_bytes.append(num_bytes)
+            continue
+        if is_same_sample(sample_hash, last_entry):
+            offset = last_entry['offset']
+        else:
+            offset = None
+            affected_shards.add(last_entry['shard'])
+        shard_entries.setdefault(last_entry['shard'], []).append((sample, sample_hash, offset))
+
+    kept_shards = [shard for shard in last_manifest['shards'] if shard['filename'] not in affected_shards]
+    shard_tasks = []
+    for shard in last_manifest['shards']:
+        if shard['filename'] in affected_shards and len(shard_entries.get(shard['filename'], [])) > 0:
+            entries = sorted(shard_entries[shard['filename']],
+                             key=lambda entry: -1 if entry[2] is None else entry[2])
+            shard_tasks.append((shard['filename'], entries))
+    shard_tasks += [(None, sub_samples) for sub_samples in _split(new_samples, new_samples_bytes)]
+    return kept_shards, shard_tasks
+
+
+def write_shard(shard_task):
+    """
+    serialize samples of one shard and write them to its record file
+    :param shard_task: (record_filename, old_record_filename, entries, serialize_fn, compression).
+                       entries is list of (sample, sample_hash, offset in old shard or None),
+                       serialize_fn(sample) return serialized example
+    :return: shard info
+    """
+    record_filename, old_record_filename, entries, serialize_fn, compression = shard_task
+    options = tf.io.TFRecordOptions(compression_type=compression)
+
+    # read the unchanged records of old shard
+    old_records = {}
+    copy_offsets = set([offset for _, _, offset in entries if offset is not None])
+    if old_record_filename is not None and os.path.isfile(old_record_filename) and len(copy_offsets) > 0:
+        for offset, record in enumerate(tf.compat.v1.io.tf_record_iterator(old_record_filename, options=options)):
+            if offset in copy_offsets:
+                old_records[offset] = record
+
+    samples = []
+    failed = []
+    records_meta = []
+    writer = tf.io.TFRecordWriter(record_filename + '.tmp', options=options)
+    for sample, sample_hash, offset in entries:
+        if offset in old_records:
+            record = old_records[offset]
+        else:
+            try:
+                if sample_hash is None:
+                    raise IOError('failed to read image {0}'.format(sample['image']))
+                record = serialize_fn(sample)
+            except Exception as e:
+                failed.append({'image': sample['image'], 'error': repr(e)})
+                continue
+        writer.write(record=record)
+        records_meta.append((len(record),) + get_record_meta(record))
+        samples.append(dict(sample_hash, image=sample['image'], offset=len(samples)))
+    writer.close()
+    os.replace(record_filename + '.tmp', record_filename)
+    save_record_index(record_filename, build_record_index(records_meta))
+
+    return {'filename': os.path.basename(record_filename),
+            'bytes': os.path.getsize(record_filename),
+            'old_filename': None if old_record_filename is None else os.path.basename(old_record_filename),
+            'num_samples': len(samples),
+            'samples': samples,
+            'failed': failed}
+
+
+def remove_shard(record_file):
+    for path in (record_file, get_index_path(record_file)):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def get_shard_index(filename):
+    return int(filename.split('.')[0])
+
+
+def write_shards(samples, serialize_fn, save_path, record_capacity=2000, num_workers=1, compression='',
+                 manifest_info=None, incremental=False, shard_bytes=0):
+    """
+    write samples to shards and record all shards and samples in manifest.
+    the manifest maps every sample to content hash, shard and offset, and is saved after every shard finish,
+    so a crashed or updated conversion can be resumed with incremental=True.
+    :param samples: list of sample dict, every sample must contain the key 'image'
+    :param serialize_fn: picklable function convert a sample to serialized example
+    :param save_path: the dir to save shards
+    :param record_capacity: max number of samples per shard
+    :param num_workers: number of process, every worker writes its own shards
+    :param compression: compression type of shards, '', 'GZIP' or 'ZLIB'
+    :param manifest_info: extra conversion options recorded in manifest, such as record_format
+    :param incremental: if True, only encode new or changed samples and rewrite the affected shards
+    :param shard_bytes: if not 0, balance samples to shards of about shard_bytes by the estimated size of sample
+                        instead of record_capacity samples per shard
+    :return: manifest
+    """
+    assert compression in COMPRESSION_TYPES, 'compression type must in {0}'.format(COMPRESSION_TYPES)
+    makedir(save_path)
+    options = dict(manifest_info or {}, compression=compression)
+
+    last_manifest = load_manifest(save_path) if incremental else None
+    if last_manifest is not None:
+        if 'samples' not in last_manifest or \
+                any([last_manifest.get(key) != value for key, value in options.items()]):
+            print('conversion options or manifest version changed, all samples will be converted')
+            last_manifest = None
+    last_samples = {} if last_manifest is None else last_manifest['samples']
+
+    pool = multiprocessing.Pool(processes=num_workers) if num_workers > 1 else None
+    try:
+        hash_tasks = [(sample, last_samples.get(sample['image'])) for sample in samples]
+        if pool is not None:
+            sample_hashes = pool.map(get_sample_hash, hash_tasks, chunksize=64)
+        else:
+            sample_hashes = list(map(get_sample_hash, hash_tasks))
+
+        sample_bytes = None
+        if shard_bytes:
+            estimate_fn = functools.partial(estimate_sample_bytes, record_format=options.get('record_format', 'raw'),
+                                            shortside_len=options.get('resized_shortside', 0),
+                                            length_limitation=options.get('resized_max_length', 0))
+            sample_bytes = pool.map(estimate_fn, samples, chunksize=256) if pool is not None \
+                else list(map(estimate_fn, samples))
+        kept_shards, shard_plan = plan_shards(samples, sample_hashes, last_manifest, save_path=save_path,
+                                              record_capacity=record_capacity, num_workers=num_workers,
+                                              sample_bytes=sample_bytes, shard_bytes=shard_bytes)
+        # written shards always get new filename, so a shard referenced by manifest is never half written
+        next_index = max([get_shard_index(shard['filename']) for shard in kept_shards] +
+                         [get_shard_index(old_filename) for old_filename, _ in shard_plan
+                          if old_filename is not None] + [-1]) + 1
+        shard_tasks = [(os.path.join(save_path, '{0}{1}'.format(next_index + index, RECORD_SUFFIX)),
+                        None if old_filename is None else os.path.join(save_path, old_filename),
+                        entries, serialize_fn, compression)
+                       for index, (old_filename, entries) in enumerate(shard_plan)]
+        print('{0} shards are kept, {1} shards will be written'.format(len(kept_shards), len(shard_tasks)))
+
+        # old shards stay in manifest until they are replaced, so an interrupted conversion loses no sample
+        rewritten_filenames = set([old_filename for old_filename, _ in shard_plan if old_filename is not None])
+        manifest = dict(options)
+        manifest['shards'] = list(kept_shards) + [shard for shard in last_manifest['shards']
+                                                  if shard['filename'] in rewritten_filenames] \
+            if last_manifest is not None else []
+        current_filenames = set([shard['filename'] for shard in manifest['shards']])
+        manifest['samples'] = dict([(key, entry) for key, entry in last_samples.items()
+                                    if entry['shard'] in current_filenames])
+        # failed samples of last conversion are not in manifest samples, so they are always retried
+        failed = {}
+
+        if pool is not None:
+            shard_iter = pool.imap_unordered(write_shard, shard_tasks)
+        else:
+            shard_iter = map(write_shard, shard_tasks)
+
+        for num_shards, shard in enumerate(shard_iter):
+            if shard['old_filename'] is not None:
+                manifest['shards'] = [old_shard for old_shard in manifest['shards']
+                                      if old_shard['filename'] != shard['old_filename']]
+                for key in [key for key, entry in manifest['samples'].items()
+                            if entry['shard'] == shard['old_filename']]:
+                    manifest['samples'].pop(key)
+            manifest['shards'].append({'filename': shard['filename'], 'num_samples': shard['num_samples'],
+                                       'bytes': shard['bytes']})
+            for sample in shard['samples']:
+                manifest['samples'][sample.pop('image')] = dict(sample, shard=shard['filename'])
+            for item in shard['failed']:
+                failed[item['image']] = item['error']
+                print('\n{0}: {1}'.format(item['image'], item['error']))
+
+            manifest['shards'] = sorted(manifest['shards'], key=lambda item: get_shard_index(item['filename']))
+            manifest['num_samples'] = sum([item['num_samples'] for item in manifest['shards']])
+            manifest['failed'] = [{'image': key, 'error': error} for key, error in failed.items()]
+            save_manifest(save_path, manifest)
+            # old shard is removed only after the manifest no longer reference it
+            if shard['old_filename'] is not None:
+                remove_shard(os.path.join(save_path, shard['old_filename']))
+            view_bar(message='\nConversion progress', num=num_shards + 1, total=len(shard_tasks))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    manifest['shards'] = sorted(manifest['shards'], key=lambda item: get_shard_index(item['filename']))
+    manifest['num_samples'] = sum([item['num_samples'] for item in manifest['shards']])
+    manifest['failed'] = [{'image': key, 'error': error} for key, error in failed.items()]
+    save_manifest(save_path, manifest)
+    # remove old shards whose samples are all removed from dataset
+    if last_manifest is not None:
+        current_shards = set([shard['filename'] for shard in manifest['shards']])
+        for shard in last_manifest['shards']:
+            if shard['filename'] not in current_shards:
+                remove_shard(os.path.join(save_path, shard['filename']))
+    print('\nThere are {0} samples convert to {1}, {2} samples failed'.format(manifest['num_samples'], save_path,
+                                                                            len(manifest['failed'])))
+    shards_bytes = [shard.get('bytes', 0) for shard in manifest['shards']]
+    if len(shards_bytes) > 0:
+        print('{0} shards, shard size min: {1:.1f} MB, max: {2:.1f} MB'.format(len(shards_bytes),
+                                                                             min(shards_bytes) / 2 ** 20,
+                                                                             max(shards_bytes) / 2 ** 20))
+
+    return manifest
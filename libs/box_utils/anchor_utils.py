@@ -5,6 +5,9 @@
 # @ Author alexchung
 # @ Time 16/12/2019 PM 15:03
 
+import threading
+from collections import OrderedDict
+import numpy as np
 import tensorflow as tf
 
 def make_anchors(base_anchor_size, anchor_scales, anchor_ratios, feature_height, feature_width,
@@ -76,6 +79,102 @@ def enum_ratios(anchors, anchor_ratios):
     return w_scale, h_scale
 
 
+def make_anchors_np(base_anchor_size, anchor_scales, anchor_ratios, feature_height, feature_width, stride):
+    """
+    numpy version of make_anchors, the order of anchors is the same
+    :param base_anchor_size:
+    :param anchor_scales:
+    :param anchor_ratios:
+    :param feature_height:
+    :param feature_width:
+    :param stride:
+    :return: float32 (feature_height*feature_width*len(anchor_scales)*len(anchor_ratios), 4)
+    """
+    base_anchor = np.array([0, 0, base_anchor_size, base_anchor_size], dtype=np.float32)
+    anchor_scales = base_anchor * np.array(anchor_scales, dtype=np.float32).reshape(-1, 1)
+    sqrt_ratios = np.sqrt(np.array(anchor_ratios, dtype=np.float32))
+    w_scale = (anchor_scales[:, 2] / sqrt_ratios[:, np.newaxis]).reshape(-1)
+    h_scale = (anchor_scales[:, 3] * sqrt_ratios[:, np.newaxis]).reshape(-1)
+
+    x_centers = np.arange(feature_width, dtype=np.float32) * np.array(stride, dtype=np.float32)
+    y_centers = np.arange(feature_height, dtype=np.float32) * np.array(stride, dtype=np.float32)
+    x_centers, y_centers = np.meshgrid(x_centers, y_centers)
+    w_scale, x_centers = np.meshgrid(w_scale, x_centers)
+    h_scale, y_centers = np.meshgrid(h_scale, y_centers)
+
+    anchor_centers = np.stack([x_centers, y_centers], axis=2).reshape(-1, 2)
+    box_sizes = np.stack([w_scale, h_scale], axis=2).reshape(-1, 2)
+    anchors = np.concatenate([anchor_centers - 0.5 * box_sizes, anchor_centers + 0.5 * box_sizes], axis=1)
+    return anchors.astype(np.float32)
+
+
+def get_inside_mask(anchors, img_height, img_width, allow_border=0):
+    """
+    anchors which sit inside the image
+    :param anchors: (-1, 4)
+    :param img_height:
+    :param img_width:
+    :param allow_border: the number of a small amount boxes allow to sit over the edge
+    :return: bool (-1,)
+    """
+    return (anchors[:, 0] >= -allow_border) & \
+           (anchors[:, 1] >= -allow_border) & \
+           (anchors[:, 2] < img_width + allow_border) & \
+           (anchors[:, 3] < img_height + allow_border)
+
+
+class AnchorCache(object):
+    """
+    anchors cached by (feature_height, feature_width). the anchors only depend on the feature map shape, and the
+    resized images have a small set of shapes, so the anchor grid is built once per shape instead of every step
+    """
+    def __init__(self, base_anchor_size, anchor_scales, anchor_ratios, stride, max_entries=64):
+        """
+        :param base_anchor_size:
+        :param anchor_scales:
+        :param anchor_ratios:
+        :param stride:
+        :param max_entries: number of cached shapes, the least recently used shape is evicted
+        """
+        self.base_anchor_size = base_anchor_size
+        self.anchor_scales = anchor_scales
+        self.anchor_ratios = anchor_ratios
+        self.stride = stride
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, feature_height, feature_width):
+        """
+        :return: float32 anchors (-1, 4)
+        """
+        key = (int(feature_height), int(feature_width))
+        with self.lock:
+            anchors = self.entries.get(key)
+            if anchors is not None:
+                self.entries.move_to_end(key)
+                return anchors
+        anchors = make_anchors_np(self.base_anchor_size, self.anchor_scales, self.anchor_ratios,
+                                  feature_height=key[0], feature_width=key[1], stride=self.stride)
+        with self.lock:
+            self.entries[key] = anchors
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return anchors
+
+    def lookup_op(self, feature_height, feature_width, name='anchor_cache'):
+        """
+        :param feature_height: int32 tensor
+        :param feature_width: int32 tensor
+        :param name:
+        :return: anchors (-1, 4)
+        """
+        with tf.name_scope(name):
+            anchors = tf.py_func(self.get, [feature_height, feature_width], tf.float32, stateful=False)
+            anchors.set_shape([None, 4])
+        return anchors
+
+
 if __name__ == "__main__":
     base_anchor_size = 256
     anchor_scales = [0.5, 1.0, 2.0]
@@ -91,10 +190,18 @@ if __name__ == "__main__":
 
     w_scale, h_scale = enum_ratios(anchor_scales, anchor_ratios)
 
+    anchor_cache = AnchorCache(base_anchor_size, anchor_scales=[0.5, 1.0, 2.0], anchor_ratios=anchor_ratios,
+                               stride=stride)
+    cached_anchors = anchor_cache.lookup_op(feature_height, feature_width)
+    inside_mask = get_inside_mask(cached_anchors, img_height=feature_height * 16., img_width=feature_width * 16.)
+
     with tf.Session() as sess:
         print(sess.run(anchor_scales))
         print(sess.run([w_scale, h_scale]))
-        print(sess.run(anchors))
+        anchors, cached_anchors, inside_mask = sess.run([anchors, cached_anchors, inside_mask])
+        print(anchors)
+        print('max difference of cached anchors: {0}, inside anchors: {1}'.format(
+            np.abs(anchors - cached_anchors).max(), inside_mask.sum()))
 
 
 
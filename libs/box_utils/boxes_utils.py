@@ -38,6 +38,28 @@ def ious_calu(boxes_1, boxes_2):
     return ious
 
 
+def bbox_overlaps(boxes, query_boxes):
+    '''
+    tensorflow version of cython bbox_overlaps, width and height are counted in pixels (+1)
+    :param boxes: [N, 4] [xmin, ymin, xmax, ymax]
+    :param query_boxes: [K, 4] [xmin, ymin, xmax, ymax]
+    :return: [N, K]
+    '''
+    boxes = tf.reshape(tf.cast(boxes, tf.float32), [-1, 4])
+    query_boxes = tf.reshape(tf.cast(query_boxes, tf.float32), [-1, 4])
+    xmin_1, ymin_1, xmax_1, ymax_1 = tf.split(boxes, 4, axis=1)  # xmin_1 shape is [N, 1]..
+    xmin_2, ymin_2, xmax_2, ymax_2 = tf.unstack(query_boxes, axis=1)  # xmin_2 shape is [K, ]..
+
+    overlap_w = tf.maximum(0., tf.minimum(xmax_1, xmax_2) - tf.maximum(xmin_1, xmin_2) + 1.)
+    overlap_h = tf.maximum(0., tf.minimum(ymax_1, ymax_2) - tf.maximum(ymin_1, ymin_2) + 1.)
+    overlaps = overlap_w * overlap_h
+
+    area_1 = (xmax_1 - xmin_1 + 1.) * (ymax_1 - ymin_1 + 1.)  # [N, 1]
+    area_2 = (xmax_2 - xmin_2 + 1.) * (ymax_2 - ymin_2 + 1.)  # [K, ]
+
+    return overlaps / (area_1 + area_2 - overlaps)
+
+
 def clip_boxes_to_img_boundaries(decode_boxes, img_shape):
     '''
 
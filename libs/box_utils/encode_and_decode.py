@@ -91,4 +91,39 @@ def encode_boxes(unencode_boxes, reference_boxes, scale_factors=None):
         t_w *= scale_factors[2]
         t_h *= scale_factors[3]
 
-    return np.transpose(np.stack([t_xcenter, t_ycenter, t_w, t_h], axis=0))
\ No newline at end of file
+    return np.transpose(np.stack([t_xcenter, t_ycenter, t_w, t_h], axis=0))
+
+
+def encode_boxes_tf(unencode_boxes, reference_boxes, scale_factors=None):
+    '''
+    tensorflow version of encode_boxes
+    :param unencode_boxes: [-1, 4]
+    :param reference_boxes: [-1, 4]
+    :return: encode_boxes [-1, 4]
+    '''
+    xmin, ymin, xmax, ymax = tf.unstack(unencode_boxes, axis=1)
+    reference_xmin, reference_ymin, reference_xmax, reference_ymax = tf.unstack(reference_boxes, axis=1)
+
+    # w + 1e-8 to avoid NaN in division and log below
+    w = xmax - xmin + 1e-8
+    h = ymax - ymin + 1e-8
+    x_center = xmin + w/2.0
+    y_center = ymin + h/2.0
+
+    reference_w = reference_xmax - reference_xmin + 1e-8
+    reference_h = reference_ymax - reference_ymin + 1e-8
+    reference_xcenter = reference_xmin + reference_w/2.0
+    reference_ycenter = reference_ymin + reference_h/2.0
+
+    t_xcenter = (x_center - reference_xcenter) / reference_w
+    t_ycenter = (y_center - reference_ycenter) / reference_h
+    t_w = tf.log(w / reference_w)
+    t_h = tf.log(h / reference_h)
+
+    if scale_factors:
+        t_xcenter *= scale_factors[0]
+        t_ycenter *= scale_factors[1]
+        t_w *= scale_factors[2]
+        t_h *= scale_factors[3]
+
+    return tf.stack([t_xcenter, t_ycenter, t_w, t_h], axis=1)
@@ -30,6 +30,9 @@ SAVE_WEIGHTS_INTE = 10000
 
 # TFRECORD_DIR = ROOT_PATH + '/data/tfrecord'
 TFRECORD_DIR = '/media/alex/AC6A2BDB6A2BA0D6/alex_dataset/pascal_tfrecord/train'
+# voc dirs read by the host loader
+VOC_IMAGE_DIR = '/media/alex/AC6A2BDB6A2BA0D6/alex_dataset/pascal_split/train/JPEGImages'
+VOC_ANNOTATION_DIR = '/media/alex/AC6A2BDB6A2BA0D6/alex_dataset/pascal_split/train/Annotations'
 SUMMARY_PATH = ROOT_PATH + '/outputs/summary'
 INFERENCE_SAVE_PATH = ROOT_PATH + '/outputs/inference_results'
 TEST_SAVE_PATH = ROOT_PATH + '/outputs/test_results'
@@ -76,6 +79,42 @@ PIXEL_MEAN = [123.68, 116.779, 103.939]  # R, G, B. In tf, channel is RGB. In op
 IMG_SHORT_SIDE_LEN = 600
 IMG_MAX_LENGTH = 1000
 CLASS_NUM = 20
+# input pipeline, -1 means tf.data.experimental.AUTOTUNE
+NUM_PARALLEL_READS = 4  # number of shards read concurrently
+NUM_PARALLEL_CALLS = -1  # number of threads to parse, resize and flip sample
+SHUFFLE_BUFFER_SIZE = 64  # number of serialized sample in shuffle buffer
+PREFETCH_BUFFER_SIZE = -1  # number of batch prepared ahead of training step
+PARSE_BATCH_SIZE = 32  # number of serialized sample parsed together by parse_example, 1 means one by one
+# record the latency of every input stage(read, parse, process, batch) to the training summary
+INPUT_STAGE_STATS = False
+# when BATCH_SIZE > 1, images are grouped by width / height into buckets split by the boundaries,
+# and padded to the largest image of batch
+ASPECT_RATIO_BOUNDARIES = [0.6, 0.8, 1.0, 1.25, 1.67]
+# multi-scale training, the short side of every training image is sampled from [min, max] and snapped to the nearest
+# bucket, so only a few input sizes reach the network. empty range means single scale IMG_SHORT_SIDE_LEN
+TRAIN_SHORT_SIDE_RANGE = []  # such as [480, 800]
+TRAIN_SHORT_SIDE_BUCKETS = [480, 576, 672, 800]
+# how the batch reaches the network in training:
+# 'feed_dict': fetch batch to numpy and feed placeholders | 'direct': iterator tensors are the network inputs
+# 'staging': iterator tensors are double buffered by StagingArea, so next batch is loaded during current step
+INPUT_MODE = 'staging'
+# source of training batch, 'tfrecord': dataset_tfrecord | 'host': HostDataLoader decodes voc images with opencv in
+# worker processes and passes them through shared memory, the batch is fed by feed_dict
+INPUT_SOURCE = 'tfrecord'
+HOST_LOADER_WORKERS = 4
+# save the input iterator state with checkpoints, training resumes at the next unseen sample. in 'staging' mode the
+# batch already staged when saving is skipped
+SAVE_INPUT_STATE = True
+# seed of stateless random flip and short side sampling, the augmentation of a sample only depends on the seed and
+# its position in the input, so the input state can be saved. a fixed seed repeats the augmentation after resume,
+# None is random
+AUGMENT_SEED = 0
+# cache of decoded and resized samples before random flip, '' | 'memory' | 'disk'
+SAMPLE_CACHE_MODE = ''
+SAMPLE_CACHE_BYTES = 8 << 30  # byte budget of sample cache
+# dir of disk cache, better on local SSD. samples are kept in a sub dir named by the fingerprint of TFRECORD_DIR,
+# the sub dirs of regenerated records can be deleted
+SAMPLE_CACHE_DIR = os.path.join(ROOT_PATH, 'sample_cache')
 
 # --------------------------------------------- Network_config
 BATCH_SIZE = 1
@@ -91,6 +130,7 @@ ANCHOR_SCALES = [0.5, 1., 2.0]  # [4, 8, 16, 32]
 ANCHOR_RATIOS = [0.5, 1., 2.0]
 ROI_SCALE_FACTORS = [10., 10., 5.0, 5.0]
 ANCHOR_SCALE_FACTORS = None
+ANCHOR_CACHE = False  # build anchors of every feature map shape once in a py_func instead of with graph ops
 
 
 # --------------------------------------------RPN config
@@ -101,6 +141,8 @@ TRAIN_RPN_CLOOBER_POSITIVES = False
 
 RPN_MINIBATCH_SIZE = 256
 RPN_POSITIVE_RATE = 0.5
+ANCHOR_TARGET_IN_GRAPH = True  # label and sample anchors with tensorflow ops, False use the numpy py_func
+TARGET_SAMPLE_SEED = None  # op seed of in graph minibatch sampling, None is random
 RPN_NMS_IOU_THRESHOLD = 0.7
 RPN_TOP_K_NMS_TRAIN = 12000
 RPN_MAXIMUM_PROPOSAL_TARIN = 2000
@@ -118,10 +160,15 @@ SHOW_SCORE_THRSHOLD = 0.5  # only show in tensorboard
 
 FAST_RCNN_NMS_IOU_THRESHOLD = 0.3  # 0.6
 FAST_RCNN_NMS_MAX_BOXES_PER_CLASS = 100
+FAST_RCNN_SCORE_THRESHOLD = 0.05  # boxes with score not greater than it are dropped before NMS
+FAST_RCNN_CLASS_SCORE_THRESHOLD = {}  # class name: score threshold, override FAST_RCNN_SCORE_THRESHOLD of the class
+FAST_RCNN_PRE_NMS_TOP_K_PER_CLASS = 100  # number of highest score boxes of every class kept before NMS, -1 keep all
+FAST_RCNN_MAX_DETECTIONS_PER_IMG = 100  # number of highest score detections of image after NMS, -1 keep all
 FAST_RCNN_IOU_POSITIVE_THRESHOLD = 0.5
 FAST_RCNN_IOU_NEGATIVE_THRESHOLD = 0.0   # 0.1 < IOU < 0.5 is negative
 FAST_RCNN_MINIBATCH_SIZE = 256  # if is -1, that is train with OHEM
 FAST_RCNN_POSITIVE_RATE = 0.25
+PROPOSAL_TARGET_IN_GRAPH = True  # sample rois with tensorflow ops, False use the numpy py_func
 
 ADD_GTBOXES_TO_TRAIN = False
 
@@ -16,6 +16,8 @@ from libs.configs import cfgs
 import numpy as np
 from libs.box_utils.cython_utils.cython_bbox import bbox_overlaps
 from libs.box_utils import encode_and_decode
+from libs.box_utils import boxes_utils
+from libs.box_utils.anchor_utils import get_inside_mask
 
 def anchor_target_layer(gt_boxes, img_shape, all_anchors, is_restrict=False):
     """
@@ -30,16 +32,8 @@ def anchor_target_layer(gt_boxes, img_shape, all_anchors, is_restrict=False):
     img_height, img_width = img_shape[1], img_shape[2]
     gt_boxes = gt_boxes[:, :-1]  # remove class label
 
-    # the number of a small amount boxes allow  to sit over the edge
-    allow_border = 0
-
     # only keep anchors inside the image
-    indices_inside = np.where(
-        (all_anchors[:, 0] >= -allow_border) &  # left_up_x
-        (all_anchors[:, 1] >= -allow_border) &  # left_up_y
-        (all_anchors[:, 2] <  img_width + allow_border) &  # right_down_x
-        (all_anchors[:, 3] < img_height + allow_border)  # right_down_y
-    )[0]
+    indices_inside = np.where(get_inside_mask(all_anchors, img_height, img_width))[0]
 
     anchors = all_anchors[indices_inside, :]
 
@@ -100,6 +94,86 @@ def anchor_target_layer(gt_boxes, img_shape, all_anchors, is_restrict=False):
     return rpn_labels, rpn_bbox_targets
 
 
+def anchor_target_layer_tf(gt_boxes, img_shape, all_anchors, is_restrict=False, seed=None,
+                           name='anchor_target_layer'):
+    """
+    tensorflow version of anchor_target_layer, label, sample and encode anchors in graph
+    :param gt_boxes: [-1, 5]
+    :param img_shape:
+    :param all_anchors: [-1, 4]
+    :param is_restrict:
+    :param seed: op seed of positive and negative sampling
+    :param name:
+    :return: rpn_labels int32 [-1], rpn_bbox_targets float32 [-1, 4]
+    """
+    with tf.name_scope(name):
+        gt_boxes = tf.reshape(tf.cast(gt_boxes, tf.float32), [-1, 5])[:, :-1]  # remove class label
+        all_anchors = tf.reshape(all_anchors, [-1, 4])
+        # only keep anchors inside the image
+        inside_mask = get_inside_mask(all_anchors, img_height=tf.cast(img_shape[1], tf.float32),
+                                      img_width=tf.cast(img_shape[2], tf.float32))
+        indices_inside = tf.reshape(tf.where(inside_mask), [-1])
+        anchors = tf.gather(all_anchors, indices_inside)
+        num_inside = tf.shape(anchors)[0]
+
+        # overlaps between the anchors and the gtbox
+        overlaps = boxes_utils.bbox_overlaps(anchors, gt_boxes)
+        # a zero column keeps argmax defined for images without gtbox, it never wins over a real gtbox
+        padded_overlaps = tf.concat([overlaps, tf.zeros([num_inside, 1])], axis=1)
+        argmax_overlaps = tf.argmax(padded_overlaps, axis=1, output_type=tf.int32)
+        max_overlaps = tf.reduce_max(padded_overlaps, axis=1)
+        gt_max_overlaps = tf.reduce_max(overlaps, axis=0)
+        is_gt_argmax = tf.reduce_any(tf.equal(overlaps, tf.expand_dims(gt_max_overlaps, axis=0)), axis=1)
+
+        # label: 1 -> positive, 0 -> negative, -1 -> dont care
+        labels = -tf.ones([num_inside], dtype=tf.int32)
+        negative = tf.less(max_overlaps, cfgs.RPN_IOU_NEGATIVE_THRESHOLD)
+        positive = tf.logical_or(is_gt_argmax, tf.greater_equal(max_overlaps, cfgs.RPN_IOU_POSITIVE_THRESHOLD))
+        if not cfgs.TRAIN_RPN_CLOOBER_POSITIVES:
+            labels = tf.where(negative, tf.zeros_like(labels), labels)
+        labels = tf.where(positive, tf.ones_like(labels), labels)
+        if cfgs.TRAIN_RPN_CLOOBER_POSITIVES:
+            labels = tf.where(negative, tf.zeros_like(labels), labels)
+
+        # num foreground of RPN
+        num_fg = int(cfgs.RPN_MINIBATCH_SIZE * cfgs.RPN_POSITIVE_RATE)
+        labels = subsample_labels(labels, label=1, num_samples=num_fg, seed=seed)
+        # num backgound of RPN
+        num_bg = cfgs.RPN_MINIBATCH_SIZE - tf.reduce_sum(tf.cast(tf.equal(labels, 1), tf.int32))
+        if is_restrict:
+            num_bg = tf.maximum(num_bg, int(num_fg * 1.5))
+        labels = subsample_labels(labels, label=0, num_samples=num_bg, seed=None if seed is None else seed + 1)
+
+        bbox_targets = encode_and_decode.encode_boxes_tf(
+            unencode_boxes=tf.gather(tf.concat([gt_boxes, tf.zeros([1, 4])], axis=0), argmax_overlaps),
+            reference_boxes=anchors,
+            scale_factors=cfgs.ANCHOR_SCALE_FACTORS)
+
+        # map up to original set of anchors
+        scatter_indices = tf.expand_dims(indices_inside, axis=1)
+        anchors_shape = tf.shape(all_anchors, out_type=tf.int64)
+        rpn_labels = tf.scatter_nd(scatter_indices, labels + 1, shape=anchors_shape[:1]) - 1
+        rpn_bbox_targets = tf.scatter_nd(scatter_indices, bbox_targets, shape=anchors_shape)
+
+        return rpn_labels, rpn_bbox_targets
+
+
+def subsample_labels(labels, label, num_samples, seed=None):
+    """
+    randomly keep at most num_samples of the given label and set the others to -1 (dont care)
+    :param labels: int32 [-1]
+    :param label:
+    :param num_samples: int or int32 tensor
+    :param seed: op seed of the shuffle
+    :return:
+    """
+    indices = tf.reshape(tf.where(tf.equal(labels, label)), [-1])
+    disable_indices = tf.random.shuffle(indices, seed=seed)[num_samples:]
+    disable = tf.scatter_nd(tf.expand_dims(disable_indices, axis=1), tf.ones_like(disable_indices, dtype=tf.int32),
+                            shape=tf.shape(labels, out_type=tf.int64))
+    return tf.where(tf.greater(disable, 0), -tf.ones_like(labels), labels)
+
+
 def unmap_anchor(data, count, indices, fill=0):
     """
     unmap a set of items data back to the original set of items (of size count)
@@ -138,3 +212,42 @@ def compute_targets(ex_rois, gt_rois):
     return targets
 
 
+if __name__ == "__main__":
+    from libs.box_utils.anchor_utils import make_anchors_np
+
+    img_shape = np.array([1, 600, 800, 3], dtype=np.int32)
+    all_anchors = make_anchors_np(base_anchor_size=cfgs.BASE_ANCHOR_SIZE_LIST[0], anchor_scales=cfgs.ANCHOR_SCALES,
+                                  anchor_ratios=cfgs.ANCHOR_RATIOS, feature_height=38, feature_width=50,
+                                  stride=cfgs.ANCHOR_STRIDE)
+    random_state = np.random.RandomState(0)
+    gt_boxes_ph = tf.placeholder(tf.float32, shape=[None, 5])
+    minibatch_size = cfgs.RPN_MINIBATCH_SIZE
+
+    with tf.Session() as sess:
+        for i in range(10):
+            num_gtboxes = random_state.randint(1, 10)
+            xy_min = random_state.uniform(0, [700, 500], size=(num_gtboxes, 2))
+            xy_max = np.minimum(xy_min + random_state.uniform(16, 400, size=(num_gtboxes, 2)), [799, 599])
+            gt_boxes = np.concatenate([xy_min, xy_max, random_state.randint(1, cfgs.CLASS_NUM + 1,
+                                                                            size=(num_gtboxes, 1))], axis=1)
+            gt_boxes = np.round(gt_boxes).astype(np.float32)
+
+            # without sampling the labels and targets must be the same
+            cfgs.RPN_MINIBATCH_SIZE = len(all_anchors) * 2
+            labels_tf, targets_tf = anchor_target_layer_tf(gt_boxes_ph, img_shape, all_anchors, seed=i)
+            labels_tf, targets_tf = sess.run([labels_tf, targets_tf], feed_dict={gt_boxes_ph: gt_boxes})
+            labels_np, targets_np = anchor_target_layer(gt_boxes, img_shape, all_anchors)
+            labels_np = labels_np.reshape(-1).astype(np.int32)
+            label_diff = np.sum(labels_np != labels_tf)
+            target_diff = np.abs(targets_np - targets_tf).max()
+
+            # with sampling the number of every label must be the same
+            cfgs.RPN_MINIBATCH_SIZE = minibatch_size
+            labels_tf = anchor_target_layer_tf(gt_boxes_ph, img_shape, all_anchors, seed=i)[0]
+            labels_tf = sess.run(labels_tf, feed_dict={gt_boxes_ph: gt_boxes})
+            labels_np = anchor_target_layer(gt_boxes, img_shape, all_anchors)[0].reshape(-1)
+            print('num gtboxes: {0} | label diff: {1} | max target diff: {2:.6f} | '
+                  'fg/bg/ignore numpy: {3}/{4}/{5} tf: {6}/{7}/{8}'.format(
+                num_gtboxes, label_diff, target_diff,
+                np.sum(labels_np == 1), np.sum(labels_np == 0), np.sum(labels_np == -1),
+                np.sum(labels_tf == 1), np.sum(labels_tf == 0), np.sum(labels_tf == -1)))
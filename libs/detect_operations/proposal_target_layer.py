@@ -11,9 +11,11 @@
 #-------------------------------------------------------
 
 import numpy as np
+import tensorflow as tf
 
 from libs.configs import cfgs
 from libs.box_utils import encode_and_decode
+from libs.box_utils import boxes_utils
 from libs.box_utils.cython_utils.cython_bbox import bbox_overlaps
 
 def proposal_target_layer(rpn_roi, gt_boxes):
@@ -48,6 +50,59 @@ def proposal_target_layer(rpn_roi, gt_boxes):
 
     return rois, labels, bbox_targets
 
+def proposal_target_layer_tf(rpn_roi, gt_boxes, seed=None, name='proposal_target_layer'):
+    """
+    tensorflow version of proposal_target_layer. the regression targets are compact, only the target of the label
+    class of every roi is kept
+    :param rpn_roi: Proposal ROIs (x1, y1, x2, y2) coming from RPN
+    :param gt_boxes: gt_boxes (x1, y1, x2, y2, label)
+    :param seed: op seed of foreground and background sampling
+    :param name:
+    :return: rois [-1, 4], labels int32 [-1], bbox_targets [-1, 4] (zeros for background)
+    """
+    with tf.name_scope(name):
+        gt_boxes = tf.reshape(tf.cast(gt_boxes, tf.float32), [-1, 5])
+        all_rois = tf.reshape(rpn_roi, [-1, 4])
+        if cfgs.ADD_GTBOXES_TO_TRAIN:
+            all_rois = tf.concat([all_rois, gt_boxes[:, :-1]], axis=0)
+
+        # overlaps rois gt_boxes, a zero column keeps argmax defined for images without gtbox
+        overlaps = boxes_utils.bbox_overlaps(all_rois, gt_boxes[:, :-1])
+        overlaps = tf.concat([overlaps, tf.zeros([tf.shape(all_rois)[0], 1])], axis=1)
+        gt_assignment = tf.argmax(overlaps, axis=1, output_type=tf.int32)
+        max_overlaps = tf.reduce_max(overlaps, axis=1)
+        gt_boxes = tf.concat([gt_boxes, tf.zeros([1, 5])], axis=0)
+
+        # Select foreground RoIs as those with >= FG_THRESH overlap
+        fg_indices = tf.reshape(tf.where(tf.greater_equal(max_overlaps, cfgs.FAST_RCNN_IOU_POSITIVE_THRESHOLD)), [-1])
+        # Select background RoIs as those within [BG_THRESH_LO, BG_THRESH_HI)
+        bg_indices = tf.reshape(tf.where(tf.logical_and(
+            tf.less(max_overlaps, cfgs.FAST_RCNN_IOU_POSITIVE_THRESHOLD),
+            tf.greater_equal(max_overlaps, cfgs.FAST_RCNN_IOU_NEGATIVE_THRESHOLD))), [-1])
+
+        # Sample foreground and background regions without replacement
+        fg_indices = tf.random.shuffle(fg_indices, seed=seed)
+        bg_indices = tf.random.shuffle(bg_indices, seed=None if seed is None else seed + 1)
+        if cfgs.FAST_RCNN_MINIBATCH_SIZE != -1:
+            fg_rois_per_image = int(np.round(cfgs.FAST_RCNN_POSITIVE_RATE * cfgs.FAST_RCNN_MINIBATCH_SIZE))
+            fg_indices = fg_indices[:fg_rois_per_image]
+            bg_indices = bg_indices[:cfgs.FAST_RCNN_MINIBATCH_SIZE - tf.shape(fg_indices)[0]]
+        keep_indices = tf.concat([fg_indices, bg_indices], axis=0)
+
+        rois = tf.gather(all_rois, keep_indices)
+        assigned_gt_boxes = tf.gather(gt_boxes, tf.gather(gt_assignment, keep_indices))
+        # Clamp labels for the background RoIs to 0
+        labels = tf.concat([tf.cast(assigned_gt_boxes[:tf.shape(fg_indices)[0], -1], tf.int32),
+                            tf.zeros_like(bg_indices, dtype=tf.int32)], axis=0)
+
+        bbox_targets = encode_and_decode.encode_boxes_tf(unencode_boxes=assigned_gt_boxes[:, :-1],
+                                                         reference_boxes=rois,
+                                                         scale_factors=cfgs.ROI_SCALE_FACTORS)
+        bbox_targets = bbox_targets * tf.expand_dims(tf.cast(tf.greater(labels, 0), tf.float32), axis=1)
+
+        return rois, labels, bbox_targets
+
+
 def get_bbox_regression_labels(bbox_target_data, num_classes):
     """
     Bounding-box regression targets (bbox_target_data) are stored in a
@@ -149,11 +204,46 @@ def sample_rois(all_rois, gt_boxes, fg_rois_per_image, rois_per_image, num_class
 
 
 if __name__ == "__main__":
-    bbox = np.random.rand(6, 5)
-    classes_num = 20
-    target_box = get_bbox_regression_labels(bbox, classes_num)
-    print(target_box)
-    print([i+1 for i in range(20)] +[0])
-
-
-
+    random_state = np.random.RandomState(0)
+    rpn_roi_ph = tf.placeholder(tf.float32, shape=[None, 4])
+    gt_boxes_ph = tf.placeholder(tf.float32, shape=[None, 5])
+    minibatch_size = cfgs.FAST_RCNN_MINIBATCH_SIZE
+
+    def random_boxes(num_boxes):
+        xy_min = random_state.uniform(0, [700, 500], size=(num_boxes, 2))
+        xy_max = np.minimum(xy_min + random_state.uniform(16, 400, size=(num_boxes, 2)), [799, 599])
+        return np.round(np.concatenate([xy_min, xy_max], axis=1)).astype(np.float32)
+
+    with tf.Session() as sess:
+        for i in range(10):
+            num_gtboxes = random_state.randint(1, 10)
+            gt_boxes = np.concatenate([random_boxes(num_gtboxes),
+                                       random_state.randint(1, cfgs.CLASS_NUM + 1, size=(num_gtboxes, 1))], axis=1)
+            # jittered gtboxes give foreground rois
+            rpn_roi = np.concatenate([random_boxes(1000), np.repeat(gt_boxes[:, :-1], 20, axis=0) +
+                                      random_state.uniform(-20, 20, size=(num_gtboxes * 20, 4))], axis=0)
+            rpn_roi = rpn_roi.astype(np.float32)
+            feed_dict = {rpn_roi_ph: rpn_roi, gt_boxes_ph: gt_boxes}
+
+            # without sampling the sampled set of rois, labels and targets must be the same
+            cfgs.FAST_RCNN_MINIBATCH_SIZE = len(rpn_roi) * 8
+            rois_tf, labels_tf, targets_tf = sess.run(proposal_target_layer_tf(rpn_roi_ph, gt_boxes_ph, seed=i),
+                                                      feed_dict=feed_dict)
+            rois_np, labels_np, targets_np = proposal_target_layer(rpn_roi, gt_boxes)
+            # compact the dense numpy targets to the target of the label class
+            targets_np = targets_np.reshape(len(labels_np), -1, 4)[np.arange(len(labels_np)), labels_np.astype(int)]
+            samples_tf = np.concatenate([rois_tf, labels_tf[:, np.newaxis], targets_tf], axis=1)
+            samples_np = np.concatenate([rois_np, labels_np[:, np.newaxis], targets_np], axis=1)
+            samples_tf = samples_tf[np.lexsort(samples_tf[:, :5].T)]
+            samples_np = samples_np[np.lexsort(samples_np[:, :5].T)]
+            same_size = samples_tf.shape == samples_np.shape
+            max_diff = np.abs(samples_tf - samples_np).max() if same_size else np.inf
+
+            # with sampling the number of foreground and background must be the same
+            cfgs.FAST_RCNN_MINIBATCH_SIZE = minibatch_size
+            labels_tf = sess.run(proposal_target_layer_tf(rpn_roi_ph, gt_boxes_ph, seed=i)[1], feed_dict=feed_dict)
+            labels_np = proposal_target_layer(rpn_roi, gt_boxes)[1]
+            print('num gtboxes: {0} | same samples: {1} max diff: {2:.6f} | '
+                  'fg/bg numpy: {3}/{4} tf: {5}/{6}'.format(num_gtboxes, same_size, max_diff,
+                                                             np.sum(labels_np > 0), np.sum(labels_np == 0),
+                                                             np.sum(labels_tf > 0), np.sum(labels_tf == 0)))
@@ -12,10 +12,10 @@
 
 import os
 import numpy as np
-import xml.etree.ElementTree as ET
 
 from libs.configs import cfgs
 from utils.tools import makedir
+from data.pascal.voc_annotation import parse_voc_xml, load_voc_annotations
 
 NAME_LABEL_MAP = cfgs.PASCAL_NAME_LABEL_MAP
 
@@ -57,26 +57,10 @@ def parse_rec(filename):
     :param filename:
     :return:
     """
-    tree = ET.parse(filename)
+    record = parse_voc_xml(filename)
     objects = []
-    for obj in tree.findall('object'):
-        obj_struct = {}
-        obj_struct['name'] = obj.find('name').text
-        obj_struct['pose'] = obj.find('pose').text
-        if obj.find('truncated') is None:
-            obj_struct['truncated'] = 0
-        else:
-            obj_struct['truncated'] = int(obj.find('truncated').text)
-        if obj.find('difficult') is None:
-            obj_struct['difficult'] = 0
-        else:
-            obj_struct['difficult'] = int(obj.find('difficult').text)
-        bbox = obj.find('bndbox')
-        obj_struct['bbox'] = [int(bbox.find('xmin').text),
-                              int(bbox.find('ymin').text),
-                              int(bbox.find('xmax').text),
-                              int(bbox.find('ymax').text)]
-        objects.append(obj_struct)
+    for name, difficult, bbox in zip(record['names'], record['difficult'], record['boxes']):
+        objects.append({'name': name, 'difficult': difficult, 'bbox': bbox})
 
     return objects
 
@@ -107,7 +91,8 @@ def voc_average_precision(recall, precision):
     return average_precision
 
 
-def voc_eval(img_name_list, detect_bbox_save_path, annotation_path, cls_name, overlap_threshold=0.5, use_diff=False):
+def voc_eval(img_name_list, detect_bbox_save_path, annotation_path, cls_name, overlap_threshold=0.5, use_diff=False,
+             annotations=None):
     """
     calculate  precision, recall and mAP per class
     :param detpath:
@@ -116,27 +101,30 @@ def voc_eval(img_name_list, detect_bbox_save_path, annotation_path, cls_name, ov
     :param cls_name:
     :param overlap_threshold:
     :param use_diff:
+    :param annotations: VocAnnotations of annotation_path, loaded from the annotation cache if None
     :return:
     """
     # read list of image
     img_names = img_name_list
-    # step 1 parse xml to get gtboxes
-    recs = {} # xml info
-    for index, img_name in enumerate(img_names):
-        recs[img_name] = parse_rec(os.path.join(annotation_path, img_name + '.xml'))
+    # step 1 load gtboxes from annotation cache
+    if annotations is None:
+        annotations = load_voc_annotations(annotation_path)
 
     # step 2 get gtboxes for this class
     class_recs = {}
     num_pos = 0 # record all image non difficult bbox of class
     for img_name in img_names:
-        object_class_per_img = [obj for obj in recs[img_name] if obj['name'] == cls_name]
-        bbox_class_per_img = np.array([x['bbox'] for x in object_class_per_img])
+        img_index = annotations.get_index(img_name)
+        if img_index is None:
+            raise IOError('annotation of {0} not found in {1}'.format(img_name, annotation_path))
+        boxes, names, difficult = annotations.get_objects(img_index)
+        bbox_class_per_img = boxes[names == cls_name]
         if use_diff:
-            difficult = np.array([False for x in object_class_per_img]).astype(np.bool)
+            difficult = np.zeros(bbox_class_per_img.shape[0], dtype=np.bool_)
         else:
-            difficult = np.array([x['difficult'] for x in object_class_per_img]).astype(np.bool)
+            difficult = difficult[names == cls_name].astype(np.bool_)
 
-        det = [False] * len(object_class_per_img)
+        det = [False] * bbox_class_per_img.shape[0]
 
         num_pos = num_pos + sum(~difficult) # ignore the difficult boxes
 
@@ -238,6 +226,8 @@ def execute_eval(img_name_list, annotation_path, detect_bbox_save_path):
     :return:
     """
     AP_list = []
+    # parse xml once for all classes
+    annotations = load_voc_annotations(annotation_path)
     for cls_name, cls_index in NAME_LABEL_MAP.items():
         if cls_index == 0:
             continue
@@ -245,7 +235,8 @@ def execute_eval(img_name_list, annotation_path, detect_bbox_save_path):
             recall, precision, AP = voc_eval(img_name_list=img_name_list,
                                              detect_bbox_save_path=detect_bbox_save_path,
                                              annotation_path=annotation_path,
-                                             cls_name=cls_name)
+                                             cls_name=cls_name,
+                                             annotations=annotations)
             AP_list += [AP]
             print("cls : {}|| Recall: {} || Precison: {}|| AP: {}".format(cls_name, recall[-1], precision[-1], AP))
     # get mAP of all classes
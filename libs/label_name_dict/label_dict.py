@@ -61,6 +61,8 @@ elif cfgs.DATASET_NAME == 'pascal':
         'train': 19,
         'tvmonitor': 20
     }
+elif cfgs.DATASET_NAME == 'coco':
+    from libs.label_name_dict.coco_dict import NAME_LABEL_MAP
 else:
     assert 'please set label dict!'
 
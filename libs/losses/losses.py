@@ -58,11 +58,24 @@ def smooth_l1_loss_rpn(bbox_pred, bbox_targets, labels, sigma=1.0):
     return bbox_loss
 
 
+def gather_class_boxes(bbox_pred, label, num_classes):
+    """
+    gather the box of the label class of every roi
+    :param bbox_pred: [-1, num_classes * 4]
+    :param label: [-1]
+    :param num_classes:
+    :return: [-1, 4]
+    """
+    bbox_pred = tf.reshape(bbox_pred, [-1, num_classes, 4])
+    indices = tf.stack([tf.range(tf.shape(bbox_pred)[0]), tf.cast(tf.reshape(label, [-1]), tf.int32)], axis=1)
+    return tf.gather_nd(bbox_pred, indices)
+
+
 def smooth_l1_loss_rcnn(bbox_pred, bbox_targets, label, num_classes, sigma=1.0):
     """
     fast rcnn bbox loss
     :param bbox_pred: [-1, (cfgs.CLS_NUM +1) * 4]
-    :param bbox_targets:[-1, (cfgs.CLS_NUM +1) * 4]
+    :param bbox_targets:[-1, 4], regression target of the label class
     :param label:[-1]
     :param num_classes:
     :param sigma:
@@ -70,24 +83,16 @@ def smooth_l1_loss_rcnn(bbox_pred, bbox_targets, label, num_classes, sigma=1.0):
     """
     outside_mask = tf.stop_gradient(tf.cast(tf.greater(label, 0), dtype=tf.float32)) # get positive indices
 
-    bbox_pred = tf.reshape(bbox_pred, [-1, num_classes, 4])
-    bbox_targets = tf.reshape(bbox_targets, [-1, num_classes, 4])
+    # only the box of the label class is regressed
+    bbox_pred = gather_class_boxes(bbox_pred, label, num_classes)
 
     value = smooth_l1_loss_base(bbox_pred,
                                 bbox_targets,
                                 sigma=sigma)
-    value = tf.reduce_sum(value, axis=2)
-    value = tf.reshape(value, [-1, num_classes])
-
-    inside_mask = tf.one_hot(tf.reshape(label, [-1, 1]),
-                             depth=num_classes, axis=1)
-
-    inside_mask = tf.stop_gradient(
-        tf.to_float(tf.reshape(inside_mask, [-1, num_classes])))
+    value = tf.reduce_sum(value, axis=1)
 
     normalizer = tf.cast((tf.shape(bbox_pred)[0]), dtype=tf.float32)
-    bbox_loss = tf.reduce_sum(
-        tf.reduce_sum(value * inside_mask,  axis=1) * outside_mask) / normalizer
+    bbox_loss = tf.reduce_sum(value * outside_mask) / normalizer
 
     return bbox_loss
 
@@ -98,7 +103,7 @@ def sum_ohem_loss(cls_score, labels, bbox_pred, bbox_targets, num_classes, num_o
     :param cls_score: [-1, classes_num+1]
     :param label: [-1]
     :param bbox_pred: [-1, 4*(classes_num+1)]
-    :param bbox_targets: [-1, 4*(classes_num+1)]
+    :param bbox_targets: [-1, 4], regression target of the label class
     :param num_ohem_samples: 256 by default
     :param num_classes: classes_num+1
     :param sigma:
@@ -110,22 +115,14 @@ def sum_ohem_loss(cls_score, labels, bbox_pred, bbox_targets, num_classes, num_o
 
     # select object indices
     outside_mask = tf.stop_gradient(tf.cast(tf.greater(labels, 0), dtype=tf.float32))
-    bbox_pred = tf.reshape(bbox_pred, shape=[-1, num_classes, 4])
-    bbox_targets = tf.reshape(bbox_targets, shape=[-1, num_classes, 4])
+    bbox_pred = gather_class_boxes(bbox_pred, labels, num_classes)
 
     value = smooth_l1_loss_base(bbox_pred,
                                 bbox_targets,
                                 sigma=sigma)
-    value = tf.reduce_sum(value, axis=2)
-    value = tf.reshape(value, shape=[-1, num_classes])
-
-    inside_mask = tf.one_hot(tf.cast(tf.reshape(labels, shape=[-1, 1]), dtype=tf.float32),
-                             depth=num_classes,
-                             axis=1)
-    inside_mask = tf.stop_gradient(tf.cast(tf.reshape(inside_mask, shape=[-1, num_classes]), dtype=tf.float32))
 
     # localization loss
-    loc_loss = tf.reduce_sum(value*inside_mask, axis=1) * outside_mask
+    loc_loss = tf.reduce_sum(value, axis=1) * outside_mask
 
     # sum loss
     sum_loss = cls_loss + loc_loss
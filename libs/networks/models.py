@@ -13,19 +13,26 @@ import tensorflow.contrib.slim as slim
 
 from libs.configs import cfgs
 from libs.networks.resnet_util import ResNet
-from libs.box_utils.anchor_utils import make_anchors
+from libs.box_utils.anchor_utils import make_anchors, AnchorCache
 from libs.box_utils import boxes_utils
 from libs.box_utils import encode_and_decode
-from libs.detect_operations.anchor_target_layer import anchor_target_layer
-from libs.detect_operations.proposal_target_layer import proposal_target_layer
+from libs.detect_operations.anchor_target_layer import anchor_target_layer, anchor_target_layer_tf
+from libs.detect_operations.proposal_target_layer import proposal_target_layer, proposal_target_layer_tf
 from libs.losses import losses
 from libs.box_utils import show_box_in_tensor
+from libs.label_name_dict.label_dict import NAME_LABEL_MAP
 
 
 
 class FasterRCNN(object):
 
-    def __init__(self, base_network_name, is_training):
+    def __init__(self, base_network_name, is_training, inputs=None):
+        """
+        :param base_network_name:
+        :param is_training:
+        :param inputs: (images_batch, gtboxes_batch, num_objects_batch, img_size_batch) tensors of input pipeline used
+                       as network inputs, if None, placeholders are created and fed by fill_feed_dict
+        """
 
         self.base_network_name = base_network_name
         self.is_training = is_training
@@ -35,59 +42,100 @@ class FasterRCNN(object):
 
         self.resnet = ResNet(scope_name=self.base_network_name, weight_decay=cfgs.WEIGHT_DECAY)
         self.is_training = is_training
+        self.anchor_cache = AnchorCache(base_anchor_size=cfgs.BASE_ANCHOR_SIZE_LIST[0],
+                                        anchor_scales=cfgs.ANCHOR_SCALES,
+                                        anchor_ratios=cfgs.ANCHOR_RATIOS,
+                                        stride=cfgs.ANCHOR_STRIDE) if cfgs.ANCHOR_CACHE else None
 
         self.global_step = tf.train.get_or_create_global_step()
 
-        self.images_batch = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None, None, None, 3], name="input_images")
-        # y [None, upper_left_x, upper_left_y, down_right_x, down_right_y]
-        self.gtboxes_batch = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None, None, 5], name="gtboxes_label")
+        self.feed_inputs = inputs is None
+        if self.feed_inputs:
+            self.images_batch = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None, None, None, 3],
+                                                         name="input_images")
+            # y [None, upper_left_x, upper_left_y, down_right_x, down_right_y]
+            self.gtboxes_batch = tf.compat.v1.placeholder(dtype=tf.float32, shape=[None, None, 5], name="gtboxes_label")
+            # number of valid gtboxes of every image, gtboxes of batch are padded to the max number of objects
+            # default to all gtboxes are valid
+            self.num_objects_batch = tf.compat.v1.placeholder_with_default(
+                tf.fill([tf.shape(self.gtboxes_batch)[0]], tf.shape(self.gtboxes_batch)[1]), shape=[None],
+                name="num_objects")
+            # (height, width) of every image before padding, default to the padded size
+            self.img_size_batch = tf.compat.v1.placeholder_with_default(
+                tf.tile(tf.expand_dims(tf.shape(self.images_batch)[1:3], axis=0), [tf.shape(self.images_batch)[0], 1]),
+                shape=[None, 2], name="img_size")
+        else:
+            images_batch, gtboxes_batch, num_objects_batch, img_size_batch = inputs
+            self.images_batch = tf.cast(images_batch, tf.float32)
+            self.gtboxes_batch = tf.cast(gtboxes_batch, tf.float32)
+            self.num_objects_batch = tf.cast(num_objects_batch, tf.int32)
+            self.img_size_batch = tf.cast(img_size_batch, tf.int32)
+        # image index of every detection of batch
+        self.final_batch_index = None
 
     def inference(self):
         """
         inference function
-        :return:
+        :return: final_bbox, final_scores, final_category of all images in batch,
+                 the image index of detections is self.final_batch_index
         """
         if self.is_training:
         # list as many types of layers as possible, even if they are not used now
             with slim.arg_scope(self.faster_rcnn_arg_scope()):
                 final_bbox, final_scores, final_category = self.faster_rcnn(input_img_batch=self.images_batch,
-                                                                            gtboxes_batch=self.gtboxes_batch)
+                                                                            gtboxes_batch=self.gtboxes_batch,
+                                                                            num_objects_batch=self.num_objects_batch,
+                                                                            img_size_batch=self.img_size_batch)
             self.total_loss = self.losses()
             #------add detect summary----------------
-            gtboxes_and_label = tf.reshape(self.gtboxes_batch, [-1, 5])
-            gtboxes_in_img = show_box_in_tensor.draw_boxes_with_categories(img_batch=self.images_batch,
+            # only draw the first image of batch
+            gtboxes_and_label = self.gtboxes_batch[0, :self.num_objects_batch[0]]
+            gtboxes_in_img = show_box_in_tensor.draw_boxes_with_categories(img_batch=self.images_batch[:1],
                                                                            boxes=gtboxes_and_label[:, :-1],
                                                                            labels=gtboxes_and_label[:, -1])
             if cfgs.ADD_BOX_IN_TENSORBOARD:
-                detections_in_img = show_box_in_tensor.draw_boxes_with_categories_and_scores(img_batch=self.images_batch,
-                                                                                             boxes=final_bbox,
-                                                                                             labels=final_category,
-                                                                                             scores=final_scores)
+                first_indices = tf.reshape(tf.where(tf.equal(self.final_batch_index, 0)), [-1])
+                detections_in_img = show_box_in_tensor.draw_boxes_with_categories_and_scores(
+                    img_batch=self.images_batch[:1],
+                    boxes=tf.gather(final_bbox, first_indices),
+                    labels=tf.gather(final_category, first_indices),
+                    scores=tf.gather(final_scores, first_indices))
                 tf.summary.image('Compare/final_detection', detections_in_img)
             tf.summary.image('Compare/gtboxes', gtboxes_in_img)
         else:
             final_bbox, final_scores, final_category = self.faster_rcnn(input_img_batch=self.images_batch,
-                                                                        gtboxes_batch=self.gtboxes_batch)
+                                                                        gtboxes_batch=self.gtboxes_batch,
+                                                                        num_objects_batch=self.num_objects_batch,
+                                                                        img_size_batch=self.img_size_batch)
         return final_bbox, final_scores, final_category
 
 
-    def fill_feed_dict(self, image_feed, gtboxes_feed=None):
+    def fill_feed_dict(self, image_feed, gtboxes_feed=None, num_objects_feed=None, img_size_feed=None):
         """
         generate feed dict
-        :param image_feed:
-        :param gtboxes_feed:
-        :param is_training:
+        :param image_feed: [batch_size, h, w, 3]
+        :param gtboxes_feed: [batch_size, max_num_objects, 5]
+        :param num_objects_feed: [batch_size], all gtboxes are valid if None
+        :param img_size_feed: [batch_size, 2], (height, width) of every image before padding,
+                              all images fill the padded size if None
         :return:
         """
+        if not self.feed_inputs:
+            # the inputs are tensors of input pipeline, nothing to feed
+            return {}
         if self.is_training:
             feed_dict = {
                 self.images_batch: image_feed,
                 self.gtboxes_batch: gtboxes_feed
             }
+            if num_objects_feed is not None:
+                feed_dict[self.num_objects_batch] = num_objects_feed
         else:
             feed_dict = {
                 self.images_batch: image_feed
             }
+        if img_size_feed is not None:
+            feed_dict[self.img_size_batch] = img_size_feed
         return feed_dict
 
     def build_base_network(self, input_img_batch):
@@ -184,45 +232,74 @@ class FasterRCNN(object):
             bbox_ppred = tf.reshape(bbox_ppred, [-1, cfgs.CLASS_NUM + 1, 4])
             bbox_ppred = tf.stop_gradient(bbox_ppred)
 
-            bbox_pred_list = tf.unstack(bbox_ppred, axis=1)
-            score_list = tf.unstack(scores, axis=1)
-
-            allclasses_boxes = []
-            allclasses_scores = []
-            categories = []
+            num_rois = tf.shape(rois)[0]
             # remove background(index_num=0) just generate object boxes and label
-            for i in range(1, cfgs.CLASS_NUM + 1):
-                # 1. decode boxes in each class
-                tmp_encoded_box = bbox_pred_list[i]
-                tmp_score = score_list[i]
-                tmp_decoded_boxes = encode_and_decode.decode_boxes(encoded_boxes=tmp_encoded_box,
-                                                                   reference_boxes=rois,
-                                                                   scale_factors=cfgs.ROI_SCALE_FACTORS)
-                # tmp_decoded_boxes = encode_and_decode.decode_boxes(boxes=rois,
-                #                                                    deltas=tmp_encoded_box,
-                #                                                    scale_factor=cfgs.ROI_SCALE_FACTORS)
-
-                # 2. clip to img boundaries
-                tmp_decoded_boxes = boxes_utils.clip_boxes_to_img_boundaries(decode_boxes=tmp_decoded_boxes,
-                                                                             img_shape=img_shape)
-
-                # 3. NMS
-                keep = tf.image.non_max_suppression(
-                    boxes=tmp_decoded_boxes,
-                    scores=tmp_score,
-                    max_output_size=cfgs.FAST_RCNN_NMS_MAX_BOXES_PER_CLASS,
-                    iou_threshold=cfgs.FAST_RCNN_NMS_IOU_THRESHOLD)
-
-                perclass_boxes = tf.gather(tmp_decoded_boxes, keep)
-                perclass_scores = tf.gather(tmp_score, keep)
-
-                allclasses_boxes.append(perclass_boxes)
-                allclasses_scores.append(perclass_scores)
-                categories.append(tf.ones_like(perclass_scores) * i)
-
-            final_boxes = tf.concat(allclasses_boxes, axis=0)
-            final_scores = tf.concat(allclasses_scores, axis=0)
-            final_category = tf.concat(categories, axis=0)
+            # flatten the boxes of all classes, (num_rois * CLASS_NUM, 4) in roi major order
+            encoded_boxes = tf.reshape(bbox_ppred[:, 1:], [-1, 4])
+            reference_boxes = tf.reshape(tf.tile(tf.expand_dims(rois, axis=1), [1, cfgs.CLASS_NUM, 1]), [-1, 4])
+            class_scores = scores[:, 1:]
+
+            # 1. pre NMS top k of every class
+            if cfgs.FAST_RCNN_PRE_NMS_TOP_K_PER_CLASS > 0:
+                # (CLASS_NUM, k)
+                top_k_scores, top_k_indices = tf.nn.top_k(tf.transpose(class_scores),
+                                                          k=tf.minimum(cfgs.FAST_RCNN_PRE_NMS_TOP_K_PER_CLASS,
+                                                                       num_rois))
+                flat_indices = tf.reshape(top_k_indices * cfgs.CLASS_NUM +
+                                          tf.expand_dims(tf.range(cfgs.CLASS_NUM), axis=1), [-1])
+                flat_scores = tf.reshape(top_k_scores, [-1])
+                flat_category = tf.reshape(tf.tile(tf.expand_dims(tf.range(1, cfgs.CLASS_NUM + 1), axis=1),
+                                                   [1, tf.shape(top_k_indices)[1]]), [-1])
+                encoded_boxes = tf.gather(encoded_boxes, flat_indices)
+                reference_boxes = tf.gather(reference_boxes, flat_indices)
+            else:
+                flat_scores = tf.reshape(class_scores, [-1])
+                flat_category = tf.tile(tf.range(1, cfgs.CLASS_NUM + 1), [num_rois])
+
+            # 2. score threshold of every class
+            score_threshold = tf.gather(tf.constant(self.get_class_score_threshold(), dtype=tf.float32),
+                                        flat_category - 1)
+            kept_indices = tf.reshape(tf.where(tf.greater(flat_scores, score_threshold)), [-1])
+            encoded_boxes = tf.gather(encoded_boxes, kept_indices)
+            reference_boxes = tf.gather(reference_boxes, kept_indices)
+            flat_scores = tf.gather(flat_scores, kept_indices)
+            flat_category = tf.gather(flat_category, kept_indices)
+
+            # 3. decode and clip the kept boxes
+            decoded_boxes = encode_and_decode.decode_boxes(encoded_boxes=encoded_boxes,
+                                                           reference_boxes=reference_boxes,
+                                                           scale_factors=cfgs.ROI_SCALE_FACTORS)
+            decoded_boxes = boxes_utils.clip_boxes_to_img_boundaries(decode_boxes=decoded_boxes,
+                                                                     img_shape=img_shape)
+
+            # 4. class offset NMS, shift boxes of every class to a disjoint region so one NMS never suppresses
+            #    boxes of different classes
+            max_coordinate = tf.cast(tf.maximum(img_shape[1], img_shape[2]), tf.float32) + 1.
+            offset_boxes = decoded_boxes + tf.expand_dims(tf.cast(flat_category, tf.float32) * max_coordinate,
+                                                          axis=1)
+            keep = tf.image.non_max_suppression(
+                boxes=offset_boxes,
+                scores=flat_scores,
+                max_output_size=cfgs.FAST_RCNN_NMS_MAX_BOXES_PER_CLASS * cfgs.CLASS_NUM,
+                iou_threshold=cfgs.FAST_RCNN_NMS_IOU_THRESHOLD)
+            final_boxes = tf.gather(decoded_boxes, keep)
+            final_scores = tf.gather(flat_scores, keep)
+            final_category = tf.gather(flat_category, keep)
+
+            # keep at most FAST_RCNN_NMS_MAX_BOXES_PER_CLASS boxes of every class, keep is sorted by score
+            category_one_hot = tf.one_hot(final_category - 1, depth=cfgs.CLASS_NUM, dtype=tf.int32)
+            class_rank = tf.reduce_sum(tf.cumsum(category_one_hot, axis=0) * category_one_hot, axis=1)
+            kept_indices = tf.reshape(tf.where(tf.less_equal(class_rank, cfgs.FAST_RCNN_NMS_MAX_BOXES_PER_CLASS)),
+                                      [-1])
+            final_boxes = tf.gather(final_boxes, kept_indices)
+            final_scores = tf.gather(final_scores, kept_indices)
+            final_category = tf.cast(tf.gather(final_category, kept_indices), tf.float32)
+
+            # 5. keep the highest score detections of image, the NMS output is sorted by score
+            if cfgs.FAST_RCNN_MAX_DETECTIONS_PER_IMG > 0:
+                final_boxes = final_boxes[:cfgs.FAST_RCNN_MAX_DETECTIONS_PER_IMG]
+                final_scores = final_scores[:cfgs.FAST_RCNN_MAX_DETECTIONS_PER_IMG]
+                final_category = final_category[:cfgs.FAST_RCNN_MAX_DETECTIONS_PER_IMG]
 
             if self.is_training:
                 '''
@@ -236,13 +313,89 @@ class FasterRCNN(object):
 
         return final_boxes, final_scores, final_category
 
+    def get_class_score_threshold(self):
+        """
+        score threshold of every class before NMS, FAST_RCNN_CLASS_SCORE_THRESHOLD overrides FAST_RCNN_SCORE_THRESHOLD.
+        class names are looked up in the label map of cfgs.DATASET_NAME
+        :return: [CLASS_NUM], index i is the threshold of label i + 1
+        """
+        score_threshold = [cfgs.FAST_RCNN_SCORE_THRESHOLD] * cfgs.CLASS_NUM
+        for name, threshold in cfgs.FAST_RCNN_CLASS_SCORE_THRESHOLD.items():
+            label = NAME_LABEL_MAP.get(name)
+            if label is None or not 1 <= label <= cfgs.CLASS_NUM:
+                raise ValueError('FAST_RCNN_CLASS_SCORE_THRESHOLD: {0} is not an object class of dataset {1}, '
+                                 'classes are {2}'.format(name, cfgs.DATASET_NAME,
+                                                          sorted([class_name for class_name, class_label
+                                                                  in NAME_LABEL_MAP.items() if class_label > 0])))
+            score_threshold[label - 1] = threshold
+        return score_threshold
+
+    def postprocess_fastrcnn_batch(self, rois, batch_index, bbox_ppred, scores, img_size_batch, batch_size):
+        """
+        postprocess fastrcnn of every image in batch
+        :param rois: [-1, 4]
+        :param batch_index: [-1], image index of rois
+        :param bbox_ppred: [-1, (cfgs.Class_num+1) * 4]
+        :param scores: [-1, cfgs.Class_num + 1]
+        :param img_size_batch: [batch_size, 2], (height, width) of every image before padding
+        :param batch_size:
+        :return: final_boxes, final_scores, final_category, final_batch_index
+        """
+        def _postprocess_image(index):
+            image_indices = tf.reshape(tf.where(tf.equal(batch_index, index)), [-1])
+            final_boxes, final_scores, final_category = self.postprocess_fastrcnn(
+                rois=tf.gather(rois, image_indices),
+                bbox_ppred=tf.gather(bbox_ppred, image_indices),
+                scores=tf.gather(scores, image_indices),
+                img_shape=self.get_image_shape(img_size_batch, index))
+            return final_boxes, final_scores, final_category, tf.fill(tf.shape(final_scores), index)
+
+        final_boxes, final_scores, final_category, final_batch_index = \
+            self.map_images(_postprocess_image, batch_size, dtypes=[tf.float32, tf.float32, tf.float32, tf.int32],
+                            name='postprocess_fastrcnn_batch')
+        return tf.reshape(final_boxes, [-1, 4]), final_scores, final_category, final_batch_index
+
+    def get_image_shape(self, img_size_batch, index):
+        """
+        shape of the image at index without padding, in the layout of tf.shape(input_img_batch)
+        :param img_size_batch: [batch_size, 2], (height, width) of every image before padding
+        :param index:
+        :return: [1, height, width, 3]
+        """
+        return tf.stack([1, img_size_batch[index, 0], img_size_batch[index, 1], 3])
+
+    def map_images(self, fn, batch_size, dtypes, name='map_images'):
+        """
+        run fn on every image of batch and concat the outputs of all images,
+        the outputs of images can have different length, such as proposals after NMS
+        :param fn: fn(image_index) => list of tensors
+        :param batch_size: scalar tensor
+        :param dtypes: dtype of every output of fn
+        :param name:
+        :return: list of concated outputs
+        """
+        with tf.name_scope(name):
+            outputs = [tf.TensorArray(dtype=dtype, size=batch_size, infer_shape=False) for dtype in dtypes]
+
+            def _body(index, *outputs):
+                values = fn(index)
+                return [index + 1] + [output.write(index, value) for output, value in zip(outputs, values)]
 
-    def roi_pooling(self, feature_maps, rois, img_shape):
+            # the outputs are proposals, targets and detections, they do not need gradient
+            loop_vars = tf.while_loop(cond=lambda index, *outputs: tf.less(index, batch_size),
+                                      body=_body,
+                                      loop_vars=[tf.constant(0, dtype=tf.int32)] + outputs,
+                                      back_prop=False)
+            return [output.concat() for output in loop_vars[1:]]
+
+
+    def roi_pooling(self, feature_maps, rois, img_shape, batch_index=None):
         '''
         Here use roi warping as roi_pooling
 
         :param featuremaps_dict: feature map to crop
         :param rois: shape is [-1, 4]. [x1, y1, x2, y2]
+        :param batch_index: shape is [-1], image index of rois in batch
         :return:
         '''
 
@@ -262,9 +415,11 @@ class FasterRCNN(object):
             # Stops gradient computation
             normalized_rois = tf.stop_gradient(normalized_rois)
 
+            if batch_index is None:
+                batch_index = tf.zeros(shape=[N, ], dtype=tf.int32)
             cropped_roi_features = tf.image.crop_and_resize(image=feature_maps,
                                                             boxes=normalized_rois,
-                                                            box_ind=tf.zeros(shape=[N, ], dtype=tf.int32),
+                                                            box_ind=batch_index,
                                                             crop_size=[cfgs.ROI_SIZE, cfgs.ROI_SIZE],
                                                             name='CROP_AND_RESIZE'
                                                             )
@@ -275,19 +430,21 @@ class FasterRCNN(object):
             # cfgs.FAST_RCNN_MINIBATCH_SIZE x 7 x 7 x 1024
             return rois_features
 
-    def build_fastrcnn(self, feature_crop, rois, img_shape):
+    def build_fastrcnn(self, feature_crop, rois, img_shape, batch_index=None):
         """
         build fastrcnn
         !batch_size =  cfgs.FAST_RCNN_MINIBATCH_SIZE!
         :param feature_ro_crop: feature map
         :param rois:
         :param img_shape:
+        :param batch_index: image index of rois
         :return:
         """
         with tf.variable_scope('Fast-RCNN'):
             # step 5 ROI Pooling
             with tf.variable_scope('roi_pooling'):
-                pooled_feature = self.roi_pooling(feature_maps=feature_crop, rois=rois, img_shape=img_shape)
+                pooled_feature = self.roi_pooling(feature_maps=feature_crop, rois=rois, img_shape=img_shape,
+                                                  batch_index=batch_index)
             # step 6 Inference rois in Fast-RCNN to obtain fc_flatten features
             if self.base_network_name.startswith('resnet'):
                 # cfgs.FAST_RCNN_MINIBATCH_SIZE x 2048
@@ -364,7 +521,7 @@ class FasterRCNN(object):
         :param rpn_cls_score: [-1]
         :param rpn_labels: [-1]
         :param bbox_pred: [-1, 4*(cls_num+1)]
-        :param bbox_targets: [-1, 4*(cls_num+1)]
+        :param bbox_targets: [-1, 4], regression target of the label class
         :param cls_score: [-1, cls_num+1]
         :param labels: [-1]
         :return:
@@ -425,67 +582,140 @@ class FasterRCNN(object):
         return loss_dict
 
 
-    def faster_rcnn(self, input_img_batch, gtboxes_batch):
-
+    def faster_rcnn(self, input_img_batch, gtboxes_batch, num_objects_batch=None, img_size_batch=None):
+        """
+        :param input_img_batch: [batch_size, h, w, 3], images of batch are padded to the same size
+        :param gtboxes_batch: [batch_size, max_num_objects, 5]
+        :param num_objects_batch: [batch_size], number of valid gtboxes of every image
+        :param img_size_batch: [batch_size, 2], (height, width) of every image before padding, anchors and proposals
+                               of an image are restricted to it. default to the padded size
+        :return: final_bbox, final_scores, final_category of all images, image index is self.final_batch_index
+        """
         if self.is_training:
-            # ensure shape is [M, 5]
-            gtboxes_batch = tf.reshape(gtboxes_batch, [-1, 5])
             gtboxes_batch = tf.cast(gtboxes_batch, tf.float32)
+            if num_objects_batch is None:
+                num_objects_batch = tf.fill([tf.shape(gtboxes_batch)[0]], tf.shape(gtboxes_batch)[1])
+            num_objects_batch = tf.cast(num_objects_batch, tf.int32)
 
         img_shape = tf.shape(input_img_batch)
+        batch_size = img_shape[0]
+        if img_size_batch is None:
+            img_size_batch = tf.tile(tf.expand_dims(img_shape[1:3], axis=0), [batch_size, 1])
+        img_size_batch = tf.cast(img_size_batch, tf.int32)
         # step 1 build base network
         feature_cropped = self.build_base_network(input_img_batch)
         # step 2 build rpn
+        # (batch_size*img_height*img_width*mum_anchor, 4), the order is image major
         rpn_box_pred, rpn_cls_score = self.build_rpn_network(feature_cropped)
         rpn_cls_prob = slim.softmax(rpn_cls_score, scope='rpn_cls_prob')
         # step 3 make anchor
-        feature_height = tf.cast(tf.shape(feature_cropped)[1], dtype=tf.float32)
-        feature_width = tf.cast(tf.shape(feature_cropped)[2], dtype=tf.float32)
-        # step make anchor
-        # reference anchor coordinate
+        # reference anchor coordinate, shared by all images of batch
         # (img_height*img_width*mum_anchor, 4)
         #++++++++++++++++++++++++++++++++++++generate anchors+++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-        anchors = make_anchors(base_anchor_size=cfgs.BASE_ANCHOR_SIZE_LIST[0],
-                               anchor_scales=cfgs.ANCHOR_SCALES,
-                               anchor_ratios=cfgs.ANCHOR_RATIOS,
-                               feature_height=feature_height,
-                               feature_width=feature_width,
-                               stride=cfgs.ANCHOR_STRIDE,
-                               name='make_anchors_forRPN')
-        # step 4 postprocess rpn proposals. such as: decode, clip, NMS
-        with tf.variable_scope('postprocess_RPN'):
-            rois, roi_scores = self.postprocess_rpn_proposals(rpn_bbox_pred=rpn_box_pred,
-                                                               rpn_cls_prob=rpn_cls_prob,
-                                                               img_shape=img_shape,
-                                                               anchors=anchors,
-                                                               is_training=self.is_training)
-            # +++++++++++++++++++++++++++++++++++++add img summary++++++++++++++++++++++++++++++++++++++++++++++++++++
-            if self.is_training:
-                rois_in_img = show_box_in_tensor.draw_boxes_with_scores(img_batch=input_img_batch,
-                                                                        boxes=rois,
-                                                                        scores=roi_scores)
-                tf.summary.image('all_rpn_rois', rois_in_img)
-
-                score_gre_05 = tf.reshape(tf.where(tf.greater_equal(roi_scores, 0.5)), [-1])
-                score_gre_05_rois = tf.gather(rois, score_gre_05)
-                score_gre_05_score = tf.gather(roi_scores, score_gre_05)
-                score_gre_05_in_img = show_box_in_tensor.draw_boxes_with_scores(img_batch=input_img_batch,
-                                                                                boxes=score_gre_05_rois,
-                                                                                scores=score_gre_05_score)
-                tf.summary.image('score_greater_05_rois', score_gre_05_in_img)
-        #++++++++++++++++++++++++++++++++++++++++get rpn_lablel and rpn_bbox_target++++++++++++++++++++++++++++++++++++
-        if self.is_training:
+        if self.anchor_cache is not None:
+            # anchors are built once per feature shape
+            anchors = self.anchor_cache.lookup_op(feature_height=tf.shape(feature_cropped)[1],
+                                                  feature_width=tf.shape(feature_cropped)[2],
+                                                  name='make_anchors_forRPN')
+        else:
+            feature_height = tf.cast(tf.shape(feature_cropped)[1], dtype=tf.float32)
+            feature_width = tf.cast(tf.shape(feature_cropped)[2], dtype=tf.float32)
+            anchors = make_anchors(base_anchor_size=cfgs.BASE_ANCHOR_SIZE_LIST[0],
+                                   anchor_scales=cfgs.ANCHOR_SCALES,
+                                   anchor_ratios=cfgs.ANCHOR_RATIOS,
+                                   feature_height=feature_height,
+                                   feature_width=feature_width,
+                                   stride=cfgs.ANCHOR_STRIDE,
+                                   name='make_anchors_forRPN')
+        # (batch_size, img_height*img_width*mum_anchor, 4)
+        rpn_box_pred_batch = tf.reshape(rpn_box_pred, [batch_size, -1, 4])
+        rpn_cls_prob_batch = tf.reshape(rpn_cls_prob, [batch_size, -1, 2])
+
+        # step 4 postprocess rpn proposals of every image. such as: decode, clip, NMS
+        #        and sample the rpn and fast-rcnn minibatch of every image when training
+        def _proposals_and_targets(index):
+            # proposals, anchors and targets are restricted to the image without padding
+            image_shape = self.get_image_shape(img_size_batch, index)
+            with tf.variable_scope('postprocess_RPN'):
+                rpn_rois, rpn_roi_scores = self.postprocess_rpn_proposals(rpn_bbox_pred=rpn_box_pred_batch[index],
+                                                                          rpn_cls_prob=rpn_cls_prob_batch[index],
+                                                                          img_shape=image_shape,
+                                                                          anchors=anchors,
+                                                                          is_training=self.is_training)
+            if not self.is_training:
+                return rpn_rois, rpn_roi_scores, tf.fill(tf.shape(rpn_roi_scores), index)
+            # drop the padded gtboxes
+            gtboxes = gtboxes_batch[index, :num_objects_batch[index]]
+            # ++++++++++++++++++++++++++++++++++++get rpn_lablel and rpn_bbox_target++++++++++++++++++++++++++++++++++++
             with tf.variable_scope('sample_anchors_minibatch'):
-                rpn_labels, rpn_box_targets = tf.py_func(anchor_target_layer,
-                                                        [gtboxes_batch, img_shape, anchors],
-                                                        [tf.float32, tf.float32])
-                rpn_bbox_targets = tf.reshape(rpn_box_targets, shape=(-1, 4))
+                # the anchors inside image are selected from image_shape in the target layer
+                if cfgs.ANCHOR_TARGET_IN_GRAPH:
+                    rpn_labels, rpn_box_targets = anchor_target_layer_tf(gtboxes, image_shape, anchors,
+                                                                         seed=cfgs.TARGET_SAMPLE_SEED)
+                else:
+                    rpn_labels, rpn_box_targets = tf.py_func(anchor_target_layer,
+                                                             [gtboxes, image_shape, anchors],
+                                                             [tf.float32, tf.float32])
+                rpn_labels = tf.reshape(tf.cast(rpn_labels, dtype=tf.int32, name='to_int32'), shape=[-1])
+                rpn_box_targets = tf.reshape(rpn_box_targets, shape=(-1, 4))
+            # +++++++++++++++++++++++++++++++++++generate target boxes and labels++++++++++++++++++++++++++++++++++++++
+            # independent of the anchor targets, the two target stages run concurrently
+            with tf.variable_scope('sample_RCNN_minibatch'):
+                if cfgs.PROPOSAL_TARGET_IN_GRAPH:
+                    # offset the seed from the anchor sampling ops
+                    seed = None if cfgs.TARGET_SAMPLE_SEED is None else cfgs.TARGET_SAMPLE_SEED + 2
+                    rois, labels, bbox_targets = proposal_target_layer_tf(rpn_rois, gtboxes, seed=seed)
+                else:
+                    rois, labels, bbox_targets = tf.py_func(proposal_target_layer,
+                                                            [rpn_rois, gtboxes],
+                                                            [tf.float32, tf.float32, tf.float32])
+                    labels = tf.reshape(tf.cast(labels, dtype=tf.int32), [-1])
+                    # keep the regression target of the label class only
+                    bbox_targets = losses.gather_class_boxes(bbox_targets, labels, num_classes=cfgs.CLASS_NUM + 1)
+                rois = tf.reshape(rois, [-1, 4])
+                bbox_targets = tf.reshape(bbox_targets, [-1, 4])
+            return rpn_rois, rpn_roi_scores, tf.fill(tf.shape(rpn_roi_scores), index), \
+                   rpn_labels, rpn_box_targets, rois, labels, bbox_targets, tf.fill(tf.shape(labels), index)
 
-                rpn_labels = tf.cast(rpn_labels, dtype=tf.int32, name='to_int32')
-                rpn_labels = tf.reshape(rpn_labels, shape=[-1])
-                self.add_anchor_img_smry(input_img_batch, anchors, rpn_labels)
+        if not self.is_training:
+            rois, roi_scores, roi_batch_index = self.map_images(_proposals_and_targets, batch_size,
+                                                                dtypes=[tf.float32, tf.float32, tf.int32],
+                                                                name='proposals')
+            rois = tf.reshape(rois, [-1, 4])
+        else:
+            rpn_rois, rpn_roi_scores, rpn_roi_batch_index, rpn_labels, rpn_bbox_targets, rois, labels, bbox_targets, \
+            roi_batch_index = self.map_images(_proposals_and_targets, batch_size,
+                                              dtypes=[tf.float32, tf.float32, tf.int32, tf.int32, tf.float32,
+                                                      tf.float32, tf.int32, tf.float32, tf.int32],
+                                              name='proposals_and_targets')
+            rpn_rois = tf.reshape(rpn_rois, [-1, 4])
+            rpn_bbox_targets = tf.reshape(rpn_bbox_targets, [-1, 4])
+            rois = tf.reshape(rois, [-1, 4])
+            bbox_targets = tf.reshape(bbox_targets, [-1, 4])
+
+            # +++++++++++++++++++++++++++++++++++++add img summary of the first image+++++++++++++++++++++++++++++++++
+            first_img = input_img_batch[:1]
+            first_indices = tf.reshape(tf.where(tf.equal(rpn_roi_batch_index, 0)), [-1])
+            first_rpn_rois = tf.gather(rpn_rois, first_indices)
+            first_rpn_scores = tf.gather(rpn_roi_scores, first_indices)
+            rois_in_img = show_box_in_tensor.draw_boxes_with_scores(img_batch=first_img,
+                                                                    boxes=first_rpn_rois,
+                                                                    scores=first_rpn_scores)
+            tf.summary.image('all_rpn_rois', rois_in_img)
+
+            score_gre_05 = tf.reshape(tf.where(tf.greater_equal(first_rpn_scores, 0.5)), [-1])
+            score_gre_05_rois = tf.gather(first_rpn_rois, score_gre_05)
+            score_gre_05_score = tf.gather(first_rpn_scores, score_gre_05)
+            score_gre_05_in_img = show_box_in_tensor.draw_boxes_with_scores(img_batch=first_img,
+                                                                            boxes=score_gre_05_rois,
+                                                                            scores=score_gre_05_score)
+            tf.summary.image('score_greater_05_rois', score_gre_05_in_img)
+
+            # rpn labels are image major, the labels of the first image are the first num_anchors
+            self.add_anchor_img_smry(first_img, anchors, rpn_labels[:tf.shape(anchors)[0]])
+            first_indices = tf.reshape(tf.where(tf.equal(roi_batch_index, 0)), [-1])
+            self.add_roi_batch_img_smry(first_img, tf.gather(rois, first_indices), tf.gather(labels, first_indices))
 
-            #+++++++++++++++++++++++++++++++++++generate target boxes and labels++++++++++++++++++++++++++++++++++++++++
             rpn_cls_category = tf.argmax(rpn_cls_prob, axis=1)
             # get positive and negative indices and ignore others where rpn label value equal to -1
             kept_rpn_indices = tf.reshape(tf.where(tf.not_equal(rpn_labels, -1)), shape=[-1])
@@ -495,23 +725,13 @@ class FasterRCNN(object):
             acc = tf.reduce_mean(tf.cast(tf.equal(rpn_cls_category, rpn_cls_labels), dtype=tf.float32))
             tf.summary.scalar('ACC/rpn_accuracy', acc)
 
-            with tf.control_dependencies([rpn_labels]):
-                with tf.variable_scope('sample_RCNN_minibatch'):
-                    rois, labels, bbox_targets = tf.py_func(proposal_target_layer,
-                                                            [rois, gtboxes_batch],
-                                                            [tf.float32, tf.float32, tf.float32])
-                    rois = tf.reshape(rois, [-1, 4])
-                    labels = tf.cast(labels, dtype=tf.int32)
-                    labels = tf.reshape(labels, [-1])
-                    bbox_targets = tf.reshape(bbox_targets, [-1, 4*(cfgs.CLASS_NUM + 1)])
-                    self.add_roi_batch_img_smry(input_img_batch, rois, labels)
-
         # -------------------------------------------------------------------------------------------------------------#
         #                                            Fast-RCNN                                                         #
         # -------------------------------------------------------------------------------------------------------------#
 
         # step 5 build fast-RCNN
-        bbox_pred, cls_score = self.build_fastrcnn(feature_crop=feature_cropped, rois=rois, img_shape=img_shape)
+        bbox_pred, cls_score = self.build_fastrcnn(feature_crop=feature_cropped, rois=rois, img_shape=img_shape,
+                                                   batch_index=roi_batch_index)
 
         cls_prob = slim.softmax(cls_score, 'cls_prob')
 
@@ -522,13 +742,7 @@ class FasterRCNN(object):
             fast_acc = tf.reduce_mean(tf.to_float(tf.equal(cls_category, tf.to_int64(labels))))
             tf.summary.scalar('ACC/fast_acc', fast_acc)
 
-        #  6. postprocess_fastrcnn
-        if not self.is_training:
-            return self.postprocess_fastrcnn(rois=rois, bbox_ppred=bbox_pred, scores=cls_prob, img_shape=img_shape)
-        else:
-            '''
-            when trian. We need build Loss
-            '''
+            # when trian. We need build Loss
             self.loss_dict = self.build_loss(rpn_box_pred=rpn_box_pred,
                                         rpn_bbox_targets=rpn_bbox_targets,
                                         rpn_cls_score=rpn_cls_score,
@@ -538,11 +752,11 @@ class FasterRCNN(object):
                                         cls_score=cls_score,
                                         labels=labels)
 
-            final_bbox, final_scores, final_category = self.postprocess_fastrcnn(rois=rois,
-                                                                                 bbox_ppred=bbox_pred,
-                                                                                 scores=cls_prob,
-                                                                                 img_shape=img_shape)
-            return final_bbox, final_scores, final_category
+        #  6. postprocess_fastrcnn of every image
+        final_bbox, final_scores, final_category, self.final_batch_index = \
+            self.postprocess_fastrcnn_batch(rois=rois, batch_index=roi_batch_index, bbox_ppred=bbox_pred,
+                                            scores=cls_prob, img_size_batch=img_size_batch, batch_size=batch_size)
+        return final_bbox, final_scores, final_category
 
     def losses(self):
         """
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : benchmark_input_pipeline.py
+# @ Description: per stage latency and throughput of dataset_tfrecord without the model
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 PM 21:50
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import json
+import time
+import tensorflow as tf
+
+from libs.configs import cfgs
+from data.pascal.read_tfrecord import INPUT_STAGES, build_dataset
+from data.sample_cache import get_sample_cache
+
+
+tf.app.flags.DEFINE_string('record_dir', cfgs.TFRECORD_DIR, 'shards to benchmark')
+tf.app.flags.DEFINE_integer('num_samples', 500, 'number of images timed at every stage')
+tf.app.flags.DEFINE_integer('warmup', 50, 'number of images read before timing')
+tf.app.flags.DEFINE_integer('batch_size', cfgs.BATCH_SIZE, 'batch size of batch stage')
+tf.app.flags.DEFINE_boolean('is_training', True, 'benchmark the training pipeline(shuffle, augmentation, sample cache)')
+tf.app.flags.DEFINE_string('save_path', '', 'save benchmark result as json')
+FLAGS = tf.app.flags.FLAGS
+
+
+def build_stage_dataset(record_dir, stage, batch_size=1, is_training=True, sample_cache=None):
+    """
+    the input pipeline of dataset_tfrecord up to stage, built by the same build_dataset as training
+    :param record_dir:
+    :param stage: one of INPUT_STAGES
+    :param batch_size:
+    :param is_training:
+    :param sample_cache:
+    :return: dataset, number of images of every element
+    """
+    dataset = build_dataset(record_dir, shortside_len=cfgs.IMG_SHORT_SIDE_LEN, length_limitation=cfgs.IMG_MAX_LENGTH,
+                            batch_size=batch_size, epoch=None, shuffle=is_training, is_training=is_training,
+                            sample_cache=sample_cache, stop_after=stage)
+    return dataset, batch_size if stage == 'batch' else 1
+
+
+def benchmark_stage(record_dir, stage, num_samples, warmup=50, batch_size=1, is_training=True, sample_cache=None):
+    """
+    time the pipeline up to stage
+    :param record_dir:
+    :param stage:
+    :param num_samples:
+    :param warmup:
+    :param batch_size:
+    :param is_training:
+    :param sample_cache:
+    :return: images per second
+    """
+    with tf.Graph().as_default():
+        dataset, images_per_element = build_stage_dataset(record_dir, stage, batch_size=batch_size,
+                                                          is_training=is_training, sample_cache=sample_cache)
+        # produce the element without copying it to numpy
+        next_element = tf.group(*tf.nest.flatten(tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()))
+        with tf.Session() as sess:
+            for _ in range(max(warmup // images_per_element, 1)):
+                sess.run(next_element)
+            num_elements = max(num_samples // images_per_element, 1)
+            start_time = time.perf_counter()
+            for _ in range(num_elements):
+                sess.run(next_element)
+            end_time = time.perf_counter()
+    return num_elements * images_per_element / (end_time - start_time)
+
+
+def benchmark_input_pipeline(record_dir, num_samples, warmup=50, batch_size=1, is_training=True):
+    """
+    benchmark the cumulative pipeline up to every stage. the latency of a stage is the increase of per image time
+    over the previous stage, the stage with the largest latency bounds the pipeline
+    :param record_dir:
+    :param num_samples:
+    :param warmup:
+    :param batch_size:
+    :param is_training:
+    :return: list of {'stage':, 'images_per_sec':, 'cumulative_ms_per_image':, 'stage_ms_per_image':}
+    """
+    # the sample cache of training, shared by the stages
+    sample_cache = get_sample_cache(record_file=record_dir) if is_training else None
+    results = []
+    previous_ms = 0.
+    for stage in INPUT_STAGES:
+        images_per_sec = benchmark_stage(record_dir, stage, num_samples, warmup=warmup, batch_size=batch_size,
+                                         is_training=is_training, sample_cache=sample_cache)
+        cumulative_ms = 1000. / images_per_sec
+        result = {
+            'stage': stage,
+            'images_per_sec': images_per_sec,
+            'cumulative_ms_per_image': cumulative_ms,
+            'stage_ms_per_image': max(cumulative_ms - previous_ms, 0.)
+        }
+        previous_ms = cumulative_ms
+        print('{0:<15}| {1:>9.1f} img/s | cumulative: {2:>8.3f} ms/img | stage: {3:>8.3f} ms/img'.format(
+            stage, result['images_per_sec'], result['cumulative_ms_per_image'], result['stage_ms_per_image']))
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    results = benchmark_input_pipeline(FLAGS.record_dir, FLAGS.num_samples, warmup=FLAGS.warmup,
+                                       batch_size=FLAGS.batch_size, is_training=FLAGS.is_training)
+    if FLAGS.save_path:
+        with open(FLAGS.save_path, 'w') as fw:
+            json.dump({'record_dir': FLAGS.record_dir,
+                       'num_samples': FLAGS.num_samples,
+                       'batch_size': FLAGS.batch_size,
+                       'is_training': FLAGS.is_training,
+                       'sample_cache_mode': cfgs.SAMPLE_CACHE_MODE,
+                       'short_side_range': cfgs.TRAIN_SHORT_SIDE_RANGE,
+                       'num_parallel_reads': cfgs.NUM_PARALLEL_READS,
+                       'num_parallel_calls': cfgs.NUM_PARALLEL_CALLS,
+                       'parse_batch_size': cfgs.PARSE_BATCH_SIZE,
+                       'stages': results}, fw, indent=2)
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#------------------------------------------------------
+# @ File       : benchmark_record_compression.py
+# @ Description: compare read throughput of uncompressed, GZIP and ZLIB shards
+# @ Author     : Alex Chung
+# @ Contact    : yonganzhong@outlook.com
+# @ License    : Copyright (c) 2017-2018
+# @ Time       : 2026/10/17 AM 10:40
+# @ Software   : PyCharm
+#-------------------------------------------------------
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import tensorflow as tf
+
+from libs.configs import cfgs
+from data.tfrecord_utils import get_record_list, get_compression_type, COMPRESSION_TYPES
+from data.pascal.read_tfrecord import read_parse_single_example
+
+
+tf.app.flags.DEFINE_string('record_dir', cfgs.TFRECORD_DIR, 'shards to benchmark')
+tf.app.flags.DEFINE_integer('num_samples', 500, 'number of samples to benchmark')
+tf.app.flags.DEFINE_integer('num_parallel_calls', 4, 'number of parallel parse call')
+tf.app.flags.DEFINE_string('save_path', '', 'save benchmark result as json')
+FLAGS = tf.app.flags.FLAGS
+
+
+def copy_samples(record_dir, save_dir, num_samples):
+    """
+    copy the first samples of record dir to one shard per compression type
+    :param record_dir:
+    :param save_dir:
+    :param num_samples:
+    :return: {compression_type: record_file}
+    """
+    source_options = tf.io.TFRecordOptions(compression_type=get_compression_type(record_dir))
+    records = []
+    for record_file in get_record_list(record_dir):
+        for record in tf.compat.v1.io.tf_record_iterator(record_file, options=source_options):
+            records.append(record)
+            if len(records) >= num_samples:
+                break
+        if len(records) >= num_samples:
+            break
+
+    record_files = {}
+    for compression_type in COMPRESSION_TYPES:
+        record_file = os.path.join(save_dir, '{0}.record'.format(compression_type or 'NONE'))
+        writer = tf.io.TFRecordWriter(record_file, options=tf.io.TFRecordOptions(compression_type=compression_type))
+        for record in records:
+            writer.write(record)
+        writer.close()
+        record_files[compression_type] = record_file
+    return record_files, len(records)
+
+
+def benchmark_read(record_file, compression_type, num_samples, parse=False, num_parallel_calls=4):
+    """
+    read all samples of record file once, and get images per second
+    :param record_file:
+    :param compression_type:
+    :param num_samples:
+    :param parse: if True, parse, decode and resize sample after read
+    :param num_parallel_calls:
+    :return: images per second
+    """
+    with tf.Graph().as_default():
+        dataset = tf.data.TFRecordDataset([record_file], compression_type=compression_type)
+        if parse:
+            dataset = dataset.map(lambda record: read_parse_single_example(record,
+                                                                           shortside_len=cfgs.IMG_SHORT_SIDE_LEN,
+                                                                           length_limitation=cfgs.IMG_MAX_LENGTH),
+                                  num_parallel_calls=num_parallel_calls)
+            dataset = dataset.map(lambda image, filename, gtboxes_and_label, num_objects: tf.shape(image))
+        dataset = dataset.batch(32)
+        next_batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+        with tf.Session() as sess:
+            start_time = time.perf_counter()
+            try:
+                while True:
+                    sess.run(next_batch)
+            except tf.errors.OutOfRangeError:
+                pass
+            end_time = time.perf_counter()
+    return num_samples / (end_time - start_time)
+
+
+def benchmark_compression(record_dir, num_samples, num_parallel_calls=4):
+    """
+    benchmark bytes read per image and images per second of every compression type.
+    the copied shards are in page cache, so images per second is the decompression bound, combine bytes per image
+    with the bandwidth of storage to choose codec
+    :param record_dir:
+    :param num_samples:
+    :param num_parallel_calls:
+    :return:
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='record_compression_')
+    results = []
+    try:
+        record_files, num_samples = copy_samples(record_dir, tmp_dir, num_samples)
+        for compression_type, record_file in record_files.items():
+            result = {
+                'compression': compression_type or 'NONE',
+                'bytes_per_image': os.path.getsize(record_file) / num_samples,
+                'read_images_per_sec': benchmark_read(record_file, compression_type, num_samples),
+                'parse_images_per_sec': benchmark_read(record_file, compression_type, num_samples, parse=True,
+                                                       num_parallel_calls=num_parallel_calls)
+            }
+            print('{0:<6}| bytes/image: {1:>12.1f} | read: {2:>8.1f} img/s | read+parse: {3:>8.1f} img/s'.format(
+                result['compression'], result['bytes_per_image'], result['read_images_per_sec'],
+                result['parse_images_per_sec']))
+            results.append(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+if __name__ == "__main__":
+    results = benchmark_compression(FLAGS.record_dir, FLAGS.num_samples, num_parallel_calls=FLAGS.num_parallel_calls)
+    if FLAGS.save_path:
+        with open(FLAGS.save_path, 'w') as fw:
+            json.dump(results, fw, indent=2)
@@ -31,23 +31,21 @@ class ObjectInference():
         # self._G_MEAN = 116.779
         # self._B_MEAN = 103.939
 
-    def exucute_detect(self, image_path, save_path):
+    def exucute_detect(self, image_path, save_path, batch_size=1):
         """
         execute object detect
         :param detect_net:
         :param image_path:
+        :param batch_size: number of images detected in one sess.run, the resized images are padded to the same size
         :return:
         """
         input_image = tf.placeholder(dtype=tf.uint8, shape=(None, None, 3), name='inputs_images')
 
         resize_img = self.image_process(input_image)
-        # expend dimension
-        image_batch = tf.expand_dims(input=resize_img, axis=0)  # (1, None, None, 3)
 
-        self.detect_net.images_batch = image_batch
-        # img_shape = tf.shape(inputs_img)
-        # load detect network
+        # load detect network, the resized images are fed to self.detect_net.images_batch
         detection_boxes, detection_scores, detection_category = self.detect_net.inference()
+        detection_batch_index = self.detect_net.final_batch_index
 
         # restore pretrain weight
         restorer, restore_ckpt = self.detect_net.get_restorer()
@@ -69,7 +67,8 @@ class ObjectInference():
             # construct image path list
             format_list = ('.jpg', '.png', '.jpeg', '.tif', '.tiff')
             if os.path.isfile(image_path):
-                image_name_list = [image_path]
+                image_name_list = [os.path.basename(image_path)]
+                image_path = os.path.dirname(image_path)
             else:
                 image_name_list = [img_name for img_name in os.listdir(image_path)
                               if img_name.endswith(format_list) and os.path.isfile(os.path.join(image_path, img_name))]
@@ -80,59 +79,68 @@ class ObjectInference():
             makedir(save_path)
             fw = open(os.path.join(save_path, 'detect_bbox.txt'), 'w')
 
-            for index, img_name in enumerate(image_name_list):
-
-                detect_dict = {}
-                bgr_img = cv.imread(os.path.join(image_path, img_name))
-                rgb_img = cv.cvtColor(bgr_img, cv.COLOR_BGR2RGB) # convert channel from BGR to RGB (cv is BGR)
+            for batch_start in range(0, len(image_name_list), batch_size):
+                batch_name_list = image_name_list[batch_start: batch_start + batch_size]
 
                 start_time = time.perf_counter()
                 # image resize and white process
-                # construct feed_dict
-                feed_dict = {input_image: rgb_img}
-                resized_img, detected_boxes, detected_scores, detected_categories = \
-                    sess.run([resize_img, detection_boxes, detection_scores, detection_category],
+                rgb_img_list, resized_img_list = [], []
+                for img_name in batch_name_list:
+                    bgr_img = cv.imread(os.path.join(image_path, img_name))
+                    rgb_img = cv.cvtColor(bgr_img, cv.COLOR_BGR2RGB) # convert channel from BGR to RGB (cv is BGR)
+                    rgb_img_list.append(rgb_img)
+                    resized_img_list.append(sess.run(resize_img, feed_dict={input_image: rgb_img}))
+                # pad images to the same size (batch_size, max_h, max_w, 3)
+                max_h = max([img.shape[0] for img in resized_img_list])
+                max_w = max([img.shape[1] for img in resized_img_list])
+                image_batch = np.zeros((len(resized_img_list), max_h, max_w, 3), dtype=np.float32)
+                for i, img in enumerate(resized_img_list):
+                    image_batch[i, :img.shape[0], :img.shape[1]] = img
+
+                img_size_batch = np.array([img.shape[:2] for img in resized_img_list], dtype=np.int32)
+                feed_dict = self.detect_net.fill_feed_dict(image_feed=image_batch, img_size_feed=img_size_batch)
+                detected_boxes, detected_scores, detected_categories, detected_batch_index = \
+                    sess.run([detection_boxes, detection_scores, detection_category, detection_batch_index],
                              feed_dict=feed_dict)
                 end_time = time.perf_counter()
 
-                # select object according to threshold
-                object_indices = detected_scores >= cfgs.SHOW_SCORE_THRSHOLD
-                object_scores = detected_scores[object_indices]
-                object_boxes = detected_boxes[object_indices]
-                object_categories = detected_categories[object_indices]
-
-                final_detections_img = draw_box_in_img.draw_boxes_with_label_and_scores(resized_img,
+                for i, img_name in enumerate(batch_name_list):
+                    rgb_img, resized_img = rgb_img_list[i], resized_img_list[i]
+                    resized_h, resized_w = resized_img.shape[0], resized_img.shape[1]
+                    # select object of image according to threshold
+                    object_indices = np.logical_and(detected_batch_index == i,
+                                                    detected_scores >= cfgs.SHOW_SCORE_THRSHOLD)
+                    object_scores = detected_scores[object_indices]
+                    object_boxes = detected_boxes[object_indices]
+                    object_categories = detected_categories[object_indices]
+
+                    final_detections_img = draw_box_in_img.draw_boxes_with_label_and_scores(resized_img,
                                                                                     boxes=object_boxes,
                                                                                     labels=object_categories,
                                                                                     scores=object_scores)
-                final_detections_img = cv.cvtColor(final_detections_img, cv.COLOR_RGB2BGR)
-                cv.imwrite(os.path.join(save_path, img_name), final_detections_img)
-                # resize boxes and image according to raw input image
-                raw_h, raw_w = rgb_img.shape[0], rgb_img.shape[1]
-                resized_h, resized_w = resized_img.shape[1], resized_img.shape[2]
-                x_min, y_min, x_max, y_max = object_boxes[:, 0], object_boxes[:, 1], object_boxes[:, 2], \
-                                             object_boxes[:, 3]
-                x_min = x_min * raw_w / resized_w
-                y_min = y_min * raw_h / resized_h
-                x_max = x_max * raw_w / resized_w
-                y_max = y_max * raw_h / resized_h
-
-                object_boxes = np.stack([x_min, y_min, x_max, y_max], axis=1)
-                # final_detections= cv.resize(final_detections[:, :, ::-1], (raw_w, raw_h))
-
-                # recover to raw size
-                detect_dict['score'] = object_scores
-                detect_dict['boxes'] = object_boxes
-                detect_dict['categories'] = object_categories
-                # convert from RGB to BG
-                fw.write(f'\n{img_name}')
-                for score, boxes, categories in zip(object_scores, object_boxes, object_categories):
-                    fw.write('\n\tscore:' + str(score))
-                    fw.write('\tbboxes:' + str(boxes))
-                    fw.write('\tcategories:' + str(categories))
-
-                view_bar('{} image cost {} second'.format(img_name, (end_time - start_time)), index + 1,
-                               len(image_name_list))
+                    final_detections_img = cv.cvtColor(final_detections_img, cv.COLOR_RGB2BGR)
+                    cv.imwrite(os.path.join(save_path, img_name), final_detections_img)
+                    # resize boxes and image according to raw input image
+                    raw_h, raw_w = rgb_img.shape[0], rgb_img.shape[1]
+                    x_min, y_min, x_max, y_max = object_boxes[:, 0], object_boxes[:, 1], object_boxes[:, 2], \
+                                                 object_boxes[:, 3]
+                    x_min = x_min * raw_w / resized_w
+                    y_min = y_min * raw_h / resized_h
+                    x_max = x_max * raw_w / resized_w
+                    y_max = y_max * raw_h / resized_h
+
+                    object_boxes = np.stack([x_min, y_min, x_max, y_max], axis=1)
+                    # final_detections= cv.resize(final_detections[:, :, ::-1], (raw_w, raw_h))
+
+                    # convert from RGB to BG
+                    fw.write(f'\n{img_name}')
+                    for score, boxes, categories in zip(object_scores, object_boxes, object_categories):
+                        fw.write('\n\tscore:' + str(score))
+                        fw.write('\tbboxes:' + str(boxes))
+                        fw.write('\tcategories:' + str(categories))
+
+                view_bar('{} images cost {} second'.format(len(batch_name_list), (end_time - start_time)),
+                         batch_start + len(batch_name_list), len(image_name_list))
 
             fw.close()
 
@@ -195,7 +203,7 @@ if __name__ == "__main__":
     inference = ObjectInference(base_network_name=base_network_name,
                                 pretrain_model_dir=cfgs.TRAINED_CKPT)
 
-    inference.exucute_detect(image_path='./demos', save_path=cfgs.INFERENCE_SAVE_PATH)
+    inference.exucute_detect(image_path='./demos', save_path=cfgs.INFERENCE_SAVE_PATH, batch_size=cfgs.BATCH_SIZE)
 
     # for img_name, detect_info in img_detections.items():
     #     print(img_name)
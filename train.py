@@ -21,7 +21,8 @@ import tensorflow.contrib.slim as slim
 
 from libs.configs import cfgs
 from libs.networks import models
-from data.pascal.read_tfrecord import dataset_tfrecord
+from data.pascal.read_tfrecord import dataset_tfrecord, stage_batch, get_num_epochs
+from data.sample_cache import get_sample_cache
 from utils.tools import makedir
 from libs.box_utils import show_box_in_tensor
 
@@ -31,16 +32,51 @@ os.environ["CUDA_VISIBLE_DEVICES"] = cfgs.GPU_GROUP
 
 def train():
 
-    faster_rcnn = models.FasterRCNN(base_network_name=cfgs.NET_NAME,
-                                                       is_training=True)
-
-    with tf.name_scope('get_batch'):
-        img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch = \
-            dataset_tfrecord(batch_size=cfgs.BATCH_SIZE,
-                             shortside_len=cfgs.IMG_SHORT_SIDE_LEN,
-                             length_limitation=cfgs.IMG_MAX_LENGTH,
-                             record_file=cfgs.TFRECORD_DIR,
-                             is_training=True)
+    host_loader = None
+    stage_op = None
+    if cfgs.INPUT_SOURCE == 'host':
+        # decode with numpy/opencv in worker processes, the batch is fed to placeholders
+        from data.host_loader import HostDataLoader, get_voc_samples
+        samples = get_voc_samples(cfgs.VOC_IMAGE_DIR, cfgs.VOC_ANNOTATION_DIR)
+        host_loader = HostDataLoader(samples,
+                                     shortside_len=cfgs.IMG_SHORT_SIDE_LEN,
+                                     length_limitation=cfgs.IMG_MAX_LENGTH,
+                                     batch_size=cfgs.BATCH_SIZE,
+                                     num_workers=cfgs.HOST_LOADER_WORKERS,
+                                     epoch=int(np.ceil(cfgs.MAX_ITERATION * cfgs.BATCH_SIZE / len(samples))) + 1,
+                                     is_training=True)
+        sample_cache = None
+        faster_rcnn = models.FasterRCNN(base_network_name=cfgs.NET_NAME, is_training=True)
+    else:
+        # cache decoded and resized samples, epochs after the first skip most of parse and resize
+        sample_cache = get_sample_cache()
+        # latency of every input stage, written with the other summaries
+        stats_aggregator = tf.data.experimental.StatsAggregator() if cfgs.INPUT_STAGE_STATS else None
+        with tf.name_scope('get_batch'):
+            img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch, img_size_batch = \
+                dataset_tfrecord(batch_size=cfgs.BATCH_SIZE,
+                                 shortside_len=cfgs.IMG_SHORT_SIDE_LEN,
+                                 length_limitation=cfgs.IMG_MAX_LENGTH,
+                                 record_file=cfgs.TFRECORD_DIR,
+                                 epoch=get_num_epochs(cfgs.TFRECORD_DIR, cfgs.MAX_ITERATION, cfgs.BATCH_SIZE),
+                                 is_training=True,
+                                 sample_cache=sample_cache,
+                                 saveable=cfgs.SAVE_INPUT_STATE,
+                                 stats_aggregator=stats_aggregator)
+            if stats_aggregator is not None:
+                tf.add_to_collection(tf.GraphKeys.SUMMARIES, stats_aggregator.get_summary())
+            if cfgs.INPUT_MODE == 'staging':
+                stage_op, (img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch, img_size_batch) = \
+                    stage_batch([img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch,
+                                 img_size_batch])
+
+        if cfgs.INPUT_MODE == 'feed_dict':
+            faster_rcnn = models.FasterRCNN(base_network_name=cfgs.NET_NAME, is_training=True)
+        else:
+            # the batch tensors are the network inputs, no numpy round trip between input pipeline and network
+            faster_rcnn = models.FasterRCNN(base_network_name=cfgs.NET_NAME, is_training=True,
+                                            inputs=(img_batch, gtboxes_and_label_batch, num_objects_batch,
+                                                    img_size_batch))
     # construct net work
     faster_rcnn.inference()
     # ----------------------------------------------------------------------------------------------------build loss
@@ -96,6 +132,9 @@ def train():
     # train_op
     train_op = optimizer.apply_gradients(grads_and_vars=gradients,
                                          global_step=global_step)
+    if stage_op is not None:
+        # put the next batch into staging area with every step
+        train_op = tf.group(train_op, stage_op)
     summary_op = tf.summary.merge_all()
 
     restorer, restore_ckpt = faster_rcnn.get_restorer()
@@ -113,7 +152,12 @@ def train():
         sess.run(init_op)
 
         if not restorer is None:
-            restorer.restore(sess, save_path=restore_ckpt)
+            try:
+                restorer.restore(sess, save_path=restore_ckpt)
+            except tf.errors.NotFoundError:
+                # checkpoint saved without input iterator state, restore the variables only
+                print('input state not found in {0}, input restarts from the beginning'.format(restore_ckpt))
+                tf.train.Saver(var_list=tf.global_variables()).restore(sess, save_path=restore_ckpt)
             print('*' * 80 + '\nSuccessful restore model from {0}\n'.format(restore_ckpt) + '*' * 80)
         # model_variables = slim.get_model_variables()
         # for var in model_variables:
@@ -124,17 +168,44 @@ def train():
 
         coord = tf.train.Coordinator()
         threads = tf.train.start_queue_runners(sess, coord)
+        if stage_op is not None:
+            # fill staging area with the first batch
+            sess.run(stage_op)
         try:
             if not coord.should_stop():
                 # ++++++++++++++++++++++++++++++++++++++++start training+++++++++++++++++++++++++++++++++++++++++++++++++++++
-                for step in range(cfgs.MAX_ITERATION):
+                # input counters of every SHOW_TRAIN_INFO_INTE steps
+                interval_start = time.time()
+                interval_steps = 0
+                interval_images = 0
+                interval_input_wait = 0.
+                # continue from the restored global step
+                for step in range(sess.run(global_step), cfgs.MAX_ITERATION):
                     training_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(time.time()))
 
-                    img_name, image, gtboxes_and_label, num_objects = \
-                        sess.run([img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch])
-
-                    feed_dict = faster_rcnn.fill_feed_dict(image_feed=image,
-                                                           gtboxes_feed=gtboxes_and_label)
+                    input_start = time.time()
+                    if host_loader is not None:
+                        img_name, image, gtboxes_and_label, num_objects, img_size = host_loader.next_batch()
+
+                        feed_dict = faster_rcnn.fill_feed_dict(image_feed=image,
+                                                               gtboxes_feed=gtboxes_and_label,
+                                                               num_objects_feed=num_objects,
+                                                               img_size_feed=img_size)
+                    elif faster_rcnn.feed_inputs:
+                        img_name, image, gtboxes_and_label, num_objects, img_size = \
+                            sess.run([img_name_batch, img_batch, gtboxes_and_label_batch, num_objects_batch,
+                                      img_size_batch])
+
+                        feed_dict = faster_rcnn.fill_feed_dict(image_feed=image,
+                                                               gtboxes_feed=gtboxes_and_label,
+                                                               num_objects_feed=num_objects,
+                                                               img_size_feed=img_size)
+                    else:
+                        feed_dict = None
+                    # only measurable when the batch is fetched to numpy, otherwise the wait is inside the step
+                    interval_input_wait += time.time() - input_start
+                    interval_steps += 1
+                    interval_images += cfgs.BATCH_SIZE if feed_dict is None else len(image)
 
                     if step % cfgs.SHOW_TRAIN_INFO_INTE != 0 and step % cfgs.SMRY_ITER != 0:
                         _, globalStep = sess.run([train_op, global_step], feed_dict=feed_dict)
@@ -142,11 +213,16 @@ def train():
                         if step % cfgs.SHOW_TRAIN_INFO_INTE == 0 and step % cfgs.SMRY_ITER != 0:
                             start_time = time.time()
 
+                            fetches = [train_op, global_step, rpn_location_loss, rpn_cls_loss, rpn_total_loss,
+                                       fastrcnn_loc_loss, fastrcnn_cls_loss, fastrcnn_total_loss, total_loss]
+                            if not faster_rcnn.feed_inputs:
+                                # image name of the batch consumed by this step
+                                fetches.append(img_name_batch)
+                            outputs = sess.run(fetches, feed_dict=feed_dict)
                             _, globalStep, rpnLocLoss, rpnClsLoss, rpnTotalLoss, \
-                            fastrcnnLocLoss, fastrcnnClsLoss, fastrcnnTotalLoss, totalLoss = \
-                                sess.run([train_op, global_step, rpn_location_loss, rpn_cls_loss, rpn_total_loss,
-                                         fastrcnn_loc_loss, fastrcnn_cls_loss, fastrcnn_total_loss, total_loss],
-                                         feed_dict=feed_dict)
+                            fastrcnnLocLoss, fastrcnnClsLoss, fastrcnnTotalLoss, totalLoss = outputs[:9]
+                            if not faster_rcnn.feed_inputs:
+                                img_name = outputs[9]
 
                             end_time = time.time()
                             print(""" {}: step {}\t\timage_name:{} |\t
@@ -156,6 +232,18 @@ def train():
                                   .format(training_time, globalStep, str(img_name[0]), rpnLocLoss, rpnClsLoss,
                                           rpnTotalLoss, fastrcnnLocLoss, fastrcnnClsLoss, fastrcnnTotalLoss, totalLoss,
                                           (end_time - start_time)))
+                            interval_time = time.time() - interval_start
+                            input_info = ' input: {0:.1f} images/s'.format(interval_images / interval_time)
+                            if feed_dict is not None:
+                                input_info += ' | input wait: {0:.1f} ms/step ({1:.1%} of time)'.format(
+                                    1000 * interval_input_wait / interval_steps, interval_input_wait / interval_time)
+                            print(input_info)
+                            interval_start = time.time()
+                            interval_steps = 0
+                            interval_images = 0
+                            interval_input_wait = 0.
+                            if sample_cache is not None:
+                                print(' sample cache: {0}'.format(sample_cache.get_stats()))
                         else:
                             if step % cfgs.SMRY_ITER == 0:
                                 _, globalStep, summary_str = sess.run([train_op, global_step, summary_op],
@@ -176,6 +264,8 @@ def train():
         finally:
             coord.request_stop()
             coord.join(threads)
+            if host_loader is not None:
+                host_loader.close()
             print('all threads are asked to stop!')
 
 